@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+'''Measure every route of the API end to end: per route, the latency
+percentiles, the throughput and (with --allocations) the memory the
+application allocates.
+
+Through the WSGI application in this process, against the redis and the
+minio of the tests (see README.md, the bucket must exist):
+
+    python -m benchmarks.api_routes --users 50 --files-per-user 200 --concurrency 8
+
+With nothing to run: the memory cache, and the files in a temporary
+directory:
+
+    python -m benchmarks.api_routes --in-process
+
+Or against a server started with the same --config (that must not
+whitelist the users), e.g. piggy-store-asgi.py under uvicorn:
+
+    python -m benchmarks.api_routes --url http://localhost:5000
+
+The users are named "bench-<run id>-<n>", their files are added through
+the file storage, and they are deleted at the end. Write the results
+with --output, and compare a later run with them with --compare.
+'''
+
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+ANSWER = 'a' * 32
+
+
+def _headers(token):
+    return {'Authorization': 'Bearer ' + token} if token else {}
+
+
+class AppClient:
+    '''Call the application of this process, with a test client per thread.'''
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, params=None, token=None):
+        cli = getattr(self.local, 'cli', None)
+        if cli is None:
+            cli = self.local.cli = self.app.test_client()
+
+        r = cli.open(path, method=method, json=body, query_string=params, headers=_headers(token))
+        return r.status_code, r.get_json(silent=True)
+
+
+class HTTPClient:
+    '''Call a running server, with a session per thread.'''
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, params=None, token=None):
+        import requests
+
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+
+        r = session.request(method, self.url + path, json=body, params=params, headers=_headers(token))
+        return r.status_code, r.json() if r.content else None
+
+
+def use_in_process_storage(config, path):
+    config['storage']['cache'].update(
+        module='piggy_store.storage.cache.memory_storage',
+        async_module='piggy_store.storage.cache.async_memory_storage'
+    )
+    config['storage']['files'].update(
+        module='piggy_store.storage.files.local_storage',
+        async_module='piggy_store.storage.files.async_local_storage',
+        params={
+            'path': path,
+            'base_url': 'http://localhost',
+            'download_url_expire_after': timedelta(days=1)
+        }
+    )
+
+
+def add_files(usernames, files_per_user, concurrency):
+    '''Add the files of the users to the file storage directly.'''
+
+    from piggy_store.storage.files import access_user_storage
+
+    def add_user_files(username):
+        file_storage = access_user_storage(username)
+        for i in range(files_per_user):
+            filename = 'photos/IMG_{:05d}.jpg'.format(i)
+            file_storage.add_file(file_storage.build_file(filename, dict(
+                content='content of {}'.format(filename).encode('utf-8')
+            )))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(add_user_files, usernames))
+
+
+def percentile(sorted_values, p):
+    # nearest rank
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def run_route(client, calls, concurrency, allocations):
+    '''Make the calls, concurrency at a time. Return the summary of the route.'''
+
+    def timed(call):
+        start = time.perf_counter()
+        status, _ = client.request(*call)
+        return time.perf_counter() - start, status
+
+    if allocations:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, calls))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(duration for duration, status in results if status < 400)
+    summary = {
+        'requests': len(results),
+        'errors': len(results) - len(latencies),
+        'throughput': len(results) / elapsed if elapsed else None,
+        'latency_ms': {
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'mean': sum(latencies) / len(latencies) if latencies else None,
+            'max': latencies[-1] if latencies else None
+        }
+    }
+    summary['latency_ms'] = {k: v * 1000 if v is not None else None for k, v in summary['latency_ms'].items()}
+
+    if allocations:
+        current, peak = tracemalloc.get_traced_memory()
+        summary['allocations'] = {
+            'peak_bytes': peak - before,
+            'retained_bytes': current - before
+        }
+
+    return summary
+
+
+def login(client, usernames):
+    tokens = {}
+    for username in usernames:
+        status, body = client.request('POST', '/auth/answer-challenge', {'username': username, 'answer': ANSWER})
+        if status == 200:
+            tokens[username] = body['content']['token']
+    return tokens
+
+
+def run(client, args):
+    run_id = uuid4().hex[:8]
+    usernames = ['bench-{}-{}'.format(run_id, i) for i in range(args.users)]
+    filenames = ['photos/IMG_{:05d}.jpg'.format(i) for i in range(args.files_per_user)]
+    routes = {}
+
+    def measure(route, calls):
+        routes[route] = run_route(client, calls, args.concurrency, args.allocations)
+
+    def user_of(i):
+        return usernames[i % len(usernames)]
+
+    # once, unmeasured, what is done only once per worker (e.g. deriving
+    # the key of the tokens)
+    warm_up_user = 'bench-{}-warm-up'.format(run_id)
+    client.request('POST', '/users/', {'username': warm_up_user, 'challenge': 'challenge', 'answer': ANSWER})
+    for token in login(client, [warm_up_user]).values():
+        client.request('GET', '/files/', None, None, token)
+        client.request('DELETE', '/users/', None, None, token)
+
+    try:
+        measure('signup', [
+            ('POST', '/users/', {'username': username, 'challenge': 'challenge of ' + username, 'answer': ANSWER})
+            for username in usernames
+        ])
+        add_files(usernames, args.files_per_user, args.concurrency)
+
+        measure('challenge', [
+            ('GET', '/auth/request-challenge', None, {'username': user_of(i)})
+            for i in range(args.requests)
+        ])
+        measure('login', [
+            ('POST', '/auth/answer-challenge', {'username': user_of(i), 'answer': ANSWER})
+            for i in range(args.requests)
+        ])
+
+        # the tokens given last by the concurrent logins may not be the valid ones
+        tokens = login(client, usernames)
+
+        measure('list', [
+            ('GET', '/files/', None, None, tokens.get(user_of(i)))
+            for i in range(args.requests)
+        ])
+        measure('upload-url', [
+            ('POST', '/files/request-upload-url', {'filename': 'upload-{}'.format(i)}, None, tokens.get(user_of(i)))
+            for i in range(args.requests)
+        ])
+        # every file at most once
+        measure('delete-file', [
+            ('DELETE', '/files/', {'filename': filenames[i // len(usernames)]}, None, tokens.get(user_of(i)))
+            for i in range(min(args.requests, len(usernames) * len(filenames)))
+        ])
+        measure('delete-user', [
+            ('DELETE', '/users/', None, None, tokens.get(username))
+            for username in usernames
+        ])
+    finally:
+        # whatever is left of a run that failed
+        for username, token in login(client, usernames).items():
+            client.request('DELETE', '/users/', None, None, token)
+
+    return routes
+
+
+def git_version():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _ms(value):
+    return '{:8.2f}'.format(value) if value is not None else '       -'
+
+
+def print_results(results, previous=None):
+    print('{:<12} {:>8} {:>6} {:>9} {:>8} {:>8} {:>8}'.format(
+        'route', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'
+    ))
+    for route, summary in results['routes'].items():
+        latency = summary['latency_ms']
+        print('{:<12} {:>8} {:>6} {:9.1f} {} {} {}'.format(
+            route, summary['requests'], summary['errors'], summary['throughput'] or 0,
+            _ms(latency['p50']), _ms(latency['p95']), _ms(latency['p99'])
+        ))
+
+        before = previous and previous['routes'].get(route)
+        if before:
+            print('{:<12} {:>8} {:>6} {:>9} {:>8} {:>8} {:>8}'.format('', '', '', *[
+                '{:+.0%}'.format(now / then - 1) if now and then else '-'
+                for now, then in [
+                    (summary['throughput'], before['throughput']),
+                    (latency['p50'], before['latency_ms']['p50']),
+                    (latency['p95'], before['latency_ms']['p95']),
+                    (latency['p99'], before['latency_ms']['p99'])
+                ]
+            ]))
+
+        if 'allocations' in summary:
+            print('{:<12} peak {} KiB, retained {} KiB'.format(
+                '', summary['allocations']['peak_bytes'] // 1024, summary['allocations']['retained_bytes'] // 1024
+            ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default=os.path.join(ROOT, 'tests', 'config.tests.yml'))
+    parser.add_argument('--in-process', action='store_true', help='no redis nor S3, see above')
+    parser.add_argument('--url', help='the running server to measure, instead of the application')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--files-per-user', type=int, default=100)
+    parser.add_argument(
+        '--requests', type=int, default=500, help='per route, but signup and delete-user (one per user)'
+    )
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument(
+        '--allocations', action='store_true', help='trace the allocations (slows everything down, Python 3.9+)'
+    )
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='the JSON file of a previous run')
+    args = parser.parse_args()
+    if args.allocations and not hasattr(tracemalloc, 'reset_peak'):
+        # the peak of each route is measured from its start
+        parser.error('--allocations needs Python 3.9 or later')
+
+    if args.url and args.allocations:
+        parser.error('the allocations of a running server cannot be traced')
+
+    from piggy_store.config import load as load_config
+    from piggy_store.json_backend import current_json_backend
+
+    config = load_config(args.config)
+
+    with tempfile.TemporaryDirectory(prefix='piggy-store-benchmark-') as tmp_path:
+        if args.in_process:
+            use_in_process_storage(config, tmp_path)
+
+        if args.url:
+            client = HTTPClient(args.url)
+        else:
+            from piggy_store.app import create_app
+
+            # the users of the benchmark aren't whitelisted
+            config['users_whitelist'] = []
+            client = AppClient(create_app(config))
+
+        if args.allocations:
+            tracemalloc.start()
+
+        routes = run(client, args)
+
+    results = {
+        'version': git_version(),
+        'date': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'target': args.url or ('in-process' if args.in_process else 'wsgi'),
+        # the one of the server is unknown, only the configured one
+        'json_backend': config['json_backend'] if args.url else current_json_backend().name,
+        'settings': {
+            'users': args.users,
+            'files_per_user': args.files_per_user,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'allocations': args.allocations
+        },
+        'routes': routes
+    }
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as fp:
+            previous = json.load(fp)
+
+    print_results(results, previous)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+'''Compare the redis commands issued by the signup and login flows, as
+they were sent one by one and as they are sent now (in a Lua script or
+a pipeline).
+
+Run it against a local redis, e.g.
+
+    python -m benchmarks.redis_round_trips --host localhost --iterations 5000
+
+It only writes keys prefixed by "benchmark:" and deletes them on exit.
+'''
+
+import argparse
+import time
+
+import redis
+
+from piggy_store.storage.cache.redis_storage import ADD_USER_SCRIPT
+from piggy_store.storage.cache.authtoken_storage import INVALIDATION_CHANNEL
+
+PREFIX = 'benchmark:'
+TOKEN = 'x' * 140
+
+
+# each flow sends the same commands in both variants, only the round trips differ
+
+def signup_sequential(conn, scripts, i):
+    username = PREFIX + 'user-{}'.format(i)
+    conn.hsetnx(username, 'challenge', 'challenge')
+    conn.hset(username, 'answer', 'answer')
+    conn.setex(PREFIX + 'token-{}'.format(i), 60, TOKEN)
+    conn.publish(INVALIDATION_CHANNEL, username)
+
+
+def signup_pipelined(conn, scripts, i):
+    username = PREFIX + 'user-{}'.format(i)
+    scripts['add_user'](keys=[username], args=['challenge', 'answer'])
+
+    pipe = conn.pipeline(transaction=False)
+    pipe.setex(PREFIX + 'token-{}'.format(i), 60, TOKEN)
+    pipe.publish(INVALIDATION_CHANNEL, username)
+    pipe.execute()
+
+
+# a login of a user that isn't cached yet (the user is read from the bucket)
+def login_sequential(conn, scripts, i):
+    username = PREFIX + 'user-{}'.format(i)
+    conn.hgetall(username)
+    conn.hsetnx(username, 'challenge', 'challenge')
+    conn.hset(username, 'answer', 'answer')
+    conn.setex(PREFIX + 'token-{}'.format(i), 60, TOKEN)
+    conn.publish(INVALIDATION_CHANNEL, username)
+
+
+def login_pipelined(conn, scripts, i):
+    username = PREFIX + 'user-{}'.format(i)
+    conn.hgetall(username)
+    scripts['add_user'](keys=[username], args=['challenge', 'answer'])
+
+    pipe = conn.pipeline(transaction=False)
+    pipe.setex(PREFIX + 'token-{}'.format(i), 60, TOKEN)
+    pipe.publish(INVALIDATION_CHANNEL, username)
+    pipe.execute()
+
+
+def cleanup(conn):
+    keys = list(conn.scan_iter(PREFIX + '*', count=1000))
+    for i in range(0, len(keys), 1000):
+        conn.delete(*keys[i:i + 1000])
+
+
+def measure(conn, scripts, func, iterations):
+    cleanup(conn)
+    start = time.perf_counter()
+    for i in range(iterations):
+        func(conn, scripts, i)
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--database', type=int, default=15)
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    conn = redis.Redis(host=args.host, port=args.port, db=args.database, decode_responses=True)
+    scripts = {'add_user': conn.register_script(ADD_USER_SCRIPT)}
+    # load the script upfront, so the first call isn't penalized
+    scripts['add_user'](keys=[PREFIX + 'warmup'], args=['challenge', 'answer'])
+
+    try:
+        for flow, sequential, pipelined in [
+            ('signup', signup_sequential, signup_pipelined),
+            ('login', login_sequential, login_pipelined),
+        ]:
+            before = measure(conn, scripts, sequential, args.iterations)
+            after = measure(conn, scripts, pipelined, args.iterations)
+            print('{:<8} sequential {:8.1f}us   pipelined {:8.1f}us   ({:+.0%})'.format(
+                flow, before * 1e6, after * 1e6, after / before - 1
+            ))
+    finally:
+        cleanup(conn)
+
+
+if __name__ == '__main__':
+    main()
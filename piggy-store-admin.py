@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+
+import os, sys
+from piggy_store.admin import main
+from piggy_store.config import load as load_config
+
+config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'config.yml')
+
+if __name__ == "__main__":
+    config = load_config(config_path)
+    sys.exit(main(sys.argv[1:], config))
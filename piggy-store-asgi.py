@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+
+import os
+from piggy_store.asgi import create_asgi_app
+from piggy_store.config import load as load_config
+
+config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'config.yml')
+config = load_config(config_path)
+
+# the bucket is checked when the server starts the application
+application = create_asgi_app(config)
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        application,
+        host = config['server']['host'],
+        port = config['server']['port'],
+        log_level = 'debug' if config['debug'] else 'info'
+    )
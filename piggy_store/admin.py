@@ -0,0 +1,115 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import sys
+
+from piggy_store.exceptions import FileExistsError
+from piggy_store.storage import EasyStorage, _list_challenge_files
+from piggy_store.storage.cache import get_users_filter
+from piggy_store.storage.cache.authtoken_storage import derive_token_key
+from piggy_store.storage.files import access_admin_storage, compose_user_record, compose_user_record_filename
+from piggy_store.storage.user_entity import User
+from piggy_store.warmup import warm_cache
+
+
+def derive_token_key_command(config, args):
+    # to be copied in the configuration as auth_token_key
+    print(derive_token_key(config['secret']).decode('ascii'))
+
+
+def migrate_users_command(config, args):
+    # copy every challenge_<username>_<answer> file into a user record
+    file_storage = access_admin_storage()
+
+    def migrate(challenge_file_entry):
+        filename, parsed = challenge_file_entry
+        challenge_file = file_storage.build_file(filename)
+        challenge = file_storage.get_file_content(challenge_file).decode('utf-8')
+        user = User(parsed['username'], challenge, parsed['answer'])
+
+        record_file = file_storage.build_file(compose_user_record_filename(user.username), dict(
+            content=compose_user_record(user)
+        ))
+        try:
+            file_storage.add_file(record_file)
+            migrated = True
+        except FileExistsError:
+            migrated = False
+
+        if args.delete_old:
+            file_storage.remove_file(challenge_file)
+
+        return migrated
+
+    # the files that don't name a user are skipped (and kept) with a warning
+    challenge_files = _list_challenge_files(file_storage)
+
+    num_migrated = num_existing = 0
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for migrated in executor.map(migrate, challenge_files):
+            if migrated:
+                num_migrated += 1
+            else:
+                num_existing += 1
+
+    print('{} users migrated, {} already had a record'.format(num_migrated, num_existing))
+
+
+def warm_cache_command(config, args):
+    def report(num_read, num_added, elapsed):
+        print('{} users read, {} added ({:.0f} users/s)'.format(
+            num_read, num_added, num_read / elapsed if elapsed else 0
+        ), file=sys.stderr)
+
+    num_read, num_added, elapsed = warm_cache(args.concurrency, report)
+    print('{} users read, {} added to the cache in {:.1f}s ({:.0f} users/s)'.format(
+        num_read, num_added, elapsed, num_read / elapsed if elapsed else 0
+    ))
+
+
+def rebuild_users_filter_command(config, args):
+    users_filter = get_users_filter()
+    if users_filter is None:
+        print('The users filter is not enabled (see users_filter.enabled)', file=sys.stderr)
+        return 1
+
+    num_users = users_filter.rebuild(EasyStorage().list_usernames())
+    print('{} users in the filter'.format(num_users))
+
+
+def main(argv, config):
+    parser = argparse.ArgumentParser(
+        prog='piggy-store-admin.py',
+        description='Maintenance tasks for piggy-store, using the settings in config.yml'
+    )
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+
+    subparser = subparsers.add_parser(
+        'derive-token-key',
+        help='print the key used to encrypt the auth tokens, derived from the secret'
+    )
+    subparser.set_defaults(func=derive_token_key_command)
+
+    subparser = subparsers.add_parser(
+        'migrate-users',
+        help='store the users kept as challenge files as user records (see legacy_challenge_files)'
+    )
+    subparser.add_argument('--delete-old', action='store_true', help='delete the challenge files once copied')
+    subparser.add_argument('--concurrency', type=int, default=8, help='users migrated in parallel')
+    subparser.set_defaults(func=migrate_users_command)
+
+    subparser = subparsers.add_parser(
+        'warm-cache',
+        help='load every user in the cache (e.g. after redis restarted)'
+    )
+    subparser.add_argument('--concurrency', type=int, default=8, help='user records read in parallel')
+    subparser.set_defaults(func=warm_cache_command)
+
+    subparser = subparsers.add_parser(
+        'rebuild-users-filter',
+        help='build the filter of the usernames anew (see users_filter)'
+    )
+    subparser.set_defaults(func=rebuild_users_filter_command)
+
+    args = parser.parse_args(argv)
+    return args.func(config, args) or 0
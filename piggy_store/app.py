@@ -1,13 +1,16 @@
-from time import time
 from flask import Flask, g
 from flask_json import FlaskJSON
 import sentry_sdk
 from sentry_sdk.integrations.flask import FlaskIntegration
 from sentry_sdk.integrations.redis import RedisIntegration
 
+from piggy_store import server_timing
 from piggy_store.controller import blueprint
 from piggy_store.exception_handlers import register_default_exceptions
-from piggy_store.storage.files import access_admin_storage
+from piggy_store.json_backend import JSONEncoder, use_json_backend
+from piggy_store.local_files import blueprint as local_files_blueprint
+from piggy_store.storage.files import access_admin_storage, files_served_by_the_app
+from piggy_store.warmup import warm_cache_in_background
 
 
 def add_preflight_request_headers(response):
@@ -18,23 +21,27 @@ def add_preflight_request_headers(response):
     return response
 
 def start_request_timer():
-    g.start = time()
+    g.timings = server_timing.start()
 
 def stop_and_collect_request_timer(response):
-    # time as float, in milliseconds
-    diff = 1000 * (time() - g.start)
-    response.headers['Server-Timing'] = 'total;dur={:.3f}'.format(diff)
+    # times as floats, in milliseconds
+    response.headers['Server-Timing'] = server_timing.stop(g.timings)
     return response
 
 def create_app(config):
     access_admin_storage().check_bucket()
 
+    if config['warm_cache_on_startup']:
+        warm_cache_in_background()
+
     app = Flask(__name__)
     app.config['TRAP_HTTP_EXCEPTIONS'] = True
     app.config['MAX_CONTENT_LENGTH'] = config['uploads']['max_content_length']
     app.config['DEBUG'] = config['debug']
 
     app.register_blueprint(blueprint)
+    if files_served_by_the_app():
+        app.register_blueprint(local_files_blueprint)
     # Note: after_requests are called in reverse order
     app.after_request(stop_and_collect_request_timer)
     app.after_request(add_preflight_request_headers)
@@ -45,6 +52,8 @@ def create_app(config):
     register_default_exceptions(app)
 
     FlaskJSON(app)
+    use_json_backend(config['json_backend'])
+    app.json_encoder = JSONEncoder
 
     sentry_sdk.init(
         config['sentry']['dsn'],
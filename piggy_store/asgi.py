@@ -0,0 +1,497 @@
+'''The async application, for an ASGI server (e.g. uvicorn).
+
+It serves the same API as piggy_store.app, with the same validators,
+errors and responses, but redis and S3 are reached without blocking: a
+single process can wait on thousands of requests at once instead of one
+per worker thread.
+
+It needs the optional dependencies starlette and httpx (and an ASGI
+server), see `pip install piggy_store[asgi]`.
+'''
+
+from contextlib import asynccontextmanager
+import logging
+from functools import lru_cache, partial, wraps
+import os
+
+import sentry_sdk
+from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
+from sentry_sdk.integrations.redis import RedisIntegration
+from starlette.applications import Starlette
+from starlette.datastructures import MutableHeaders
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, JSONResponse as StarletteJSONResponse, Response, StreamingResponse
+from starlette.routing import Route, Router
+from werkzeug.http import HTTP_STATUS_CODES
+
+from piggy_store.authentication import (
+    assert_is_valid_authorization_header,
+    assert_is_valid_events_authorization_header,
+    assert_is_valid_status_authorization_header,
+    get_access_token_from_authorization_header
+)
+from piggy_store import json_backend, responses, server_timing
+from piggy_store.jobs import run_in_background
+from piggy_store.exceptions import PiggyStoreError, TokenExpiredError
+from piggy_store.storage.cache import (
+    get_async_cache_storage,
+    get_async_job_storage,
+    get_async_token_storage,
+    get_cache_storage
+)
+from piggy_store.storage.cache.connection import close_async_connections, get_async_pool_stats
+from piggy_store.storage.files import (
+    async_access_admin_storage,
+    async_access_user_storage,
+    close_async_files_clients,
+    files_served_by_the_app,
+    parse_user_object_name
+)
+from piggy_store.storage.files.local_storage import FILES_PATH, MAX_UPLOAD_REQUEST_SIZE, MAX_UPLOAD_SIZE, get_bucket
+from piggy_store.storage.user_entity import User
+from piggy_store.warmup import warm_cache_in_background
+from piggy_store.validators import (
+    new_user_validator,
+    auth_user_request_challenge_validator,
+    auth_user_answer_challenge_validator,
+    request_upload_url_validator,
+    list_user_files_validator,
+    file_delete_validator,
+    s3_events_validator
+)
+
+logger = logging.getLogger('errors')
+
+
+class JSONResponse(StarletteJSONResponse):
+    '''Encoded by the json backend of the process.'''
+
+    def render(self, content):
+        return json_backend.encode_response(content)
+
+
+# Errors, as in exception_handlers
+
+def make_error_response(json_content, status):
+    return JSONResponse(json_content, status_code=status)
+
+
+async def on_http_exception(request, e):
+    status = e.status_code
+    return make_error_response(*responses.error(status, status, HTTP_STATUS_CODES.get(status, 'Unknown Error')))
+
+
+def json_endpoint(func):
+    '''The counterpart of flask_json.as_json plus the app's error handlers.'''
+
+    @wraps(func)
+    async def wrapper(request, *args):
+        try:
+            response = await func(request, *args)
+        except PiggyStoreError as e:
+            return make_error_response(*responses.piggy_store_error(links(request), e))
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.exception(e)
+            return make_error_response(*responses.internal_server_error())
+
+        if isinstance(response, dict):
+            response = JSONResponse({**response, 'status': 200})
+        return response
+    return wrapper
+
+
+# Requests
+
+def authentication(func):
+    @wraps(func)
+    async def pass_valid_token(request):
+        authorization_header = request.headers.get('Authorization', '')
+        assert_is_valid_authorization_header(authorization_header)
+        token = get_access_token_from_authorization_header(authorization_header)
+        tokenDb = request.app.state.tokenDb
+        tokenBag = tokenDb.decode_token(token)
+        if not await tokenDb.has_user_token(tokenBag['username'], token):
+            raise TokenExpiredError()
+        return await func(request, tokenBag)
+    return pass_valid_token
+
+
+def _content_length(request):
+    try:
+        return int(request.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return None
+
+
+def limit_content_length(max_length):
+    def decorator(f):
+        @wraps(f)
+        async def wrapper(request, *args):
+            responses.assert_content_length(max_length, _content_length(request))
+            return await f(request, *args)
+        return wrapper
+    return decorator
+
+
+async def get_json(request):
+    '''Like flask.Request.get_json: None unless the body is json.'''
+
+    content_type = request.headers.get('Content-Type', '').split(';')[0].strip()
+    if content_type != 'application/json' and not content_type.endswith('+json'):
+        return None
+
+    cl = _content_length(request)
+    if cl is not None and cl > request.app.state.config['uploads']['max_content_length']:
+        raise HTTPException(413)
+
+    try:
+        return json_backend.loads(await request.body())
+    except ValueError:
+        raise HTTPException(400)
+
+
+# Endpoints, as in controller
+
+@json_endpoint
+async def root(request):
+    return responses.root(links(request))
+
+
+@json_endpoint
+@authentication
+async def list_user_files(request, tokenBag):
+    db = request.app.state.db
+    payload = list_user_files_validator(request.query_params)
+    user = await db.find_user_by_username(tokenBag['username'])
+    files = db.get_user_files(user, start_after=payload['cursor'], limit=payload['limit'] + 1)
+
+    # Start the listing before the response does, so that an error
+    # talking with the storage can still become an error response
+    first_file = await _next_file(files)
+
+    return StreamingResponse(
+        stream_files_list(request, first_file, files, payload['limit']),
+        media_type='application/json'
+    )
+
+
+async def stream_files_list(request, first_file, files, limit):
+    yield responses.files_list_start()
+
+    f = first_file
+    last_file = None
+    num_files = 0
+    delete_link = responses.hateoas_file_delete(links(request))
+
+    try:
+        while f is not None and num_files < limit:
+            if num_files:
+                yield ', '
+
+            yield responses.files_list_entry(f, delete_link)
+
+            last_file = f
+            num_files += 1
+            f = await _next_file(files)
+    finally:
+        await files.aclose()
+
+    yield responses.files_list_end(links(request), last_file, limit, f is not None)
+
+
+async def _next_file(files):
+    try:
+        return await files.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+@json_endpoint
+@limit_content_length(512)
+async def new_user(request):
+    db = request.app.state.db
+    tokenDb = request.app.state.tokenDb
+    unsafe_payload = await get_json(request) or {}
+    payload = new_user_validator(unsafe_payload)
+    user = User(payload['username'], payload['challenge'], payload['answer'])
+    stored_challenge = await db.add_user(user)
+    token = tokenDb.generate_token({ 'username': user.username })
+    await tokenDb.refresh_user_token(user.username, token)
+
+    return responses.new_user(links(request), token, stored_challenge)
+
+
+@json_endpoint
+@authentication
+async def delete_user(request, tokenBag):
+    db = request.app.state.db
+    user = await db.find_user_by_username(tokenBag['username'])
+    await request.app.state.tokenDb.remove_user_token(user.username)
+
+    background_after = request.app.state.config['delete_user_in_background_after']
+    if background_after and await db.count_user_files(user, background_after + 1) > background_after:
+        # the job runs in a thread, with the storage of the sync app
+        token = get_access_token_from_authorization_header(request.headers['Authorization'])
+        job_id = await request.app.state.jobDb.create('delete-user', token)
+        storage = get_cache_storage()
+        run_in_background(job_id, lambda progress: storage.remove_user(user, progress))
+
+        return JSONResponse({**responses.delete_user(links(request), job_id), 'status': 202}, status_code=202)
+
+    await db.remove_user(user)
+
+    return responses.delete_user(links(request))
+
+
+@json_endpoint
+async def auth_user_request_challenge(request):
+    payload = auth_user_request_challenge_validator(request.query_params)
+    user = await request.app.state.db.find_user_by_username(payload['username'])
+
+    return responses.auth_user_request_challenge(links(request), user)
+
+
+@json_endpoint
+@limit_content_length(512)
+async def auth_user_answer_challenge(request):
+    tokenDb = request.app.state.tokenDb
+    unsafe_payload = await get_json(request) or {}
+    payload = auth_user_answer_challenge_validator(unsafe_payload)
+    user = await request.app.state.db.find_user_by_username(payload['username'])
+    responses.assert_answer_matches(user, payload)
+
+    token = tokenDb.generate_token({ 'username': user.username })
+    await tokenDb.refresh_user_token(user.username, token)
+
+    return responses.auth_user_answer_challenge(links(request), token)
+
+
+@json_endpoint
+@authentication
+async def file_delete(request, tokenBag):
+    db = request.app.state.db
+    unsafe_payload = await get_json(request) or {}
+    payload = file_delete_validator(unsafe_payload)
+    user = await db.find_user_by_username(tokenBag['username'])
+    await db.remove_file_by_filename(user, payload['filename'])
+    return {}
+
+
+@json_endpoint
+@authentication
+async def request_upload_url(request, tokenBag):
+    db = request.app.state.db
+    unsafe_payload = await get_json(request) or {}
+    payload = request_upload_url_validator(unsafe_payload)
+    user = await db.find_user_by_username(tokenBag['username'])
+    upload_url, form_data, retrieve_url = await db.get_presigned_upload(user, payload['filename'])
+
+    return responses.request_upload_url(upload_url, form_data, retrieve_url)
+
+
+@json_endpoint
+@limit_content_length(256 * 1024)
+async def ingest_s3_events(request):
+    config = request.app.state.config
+    if not config['events']['enabled']:
+        raise HTTPException(404)
+
+    assert_is_valid_events_authorization_header(request.headers.get('Authorization', ''))
+
+    if request.method == 'HEAD':
+        return {}
+
+    unsafe_payload = await get_json(request) or {}
+    events = s3_events_validator(unsafe_payload, config['storage']['files']['params']['bucket'])
+    for event in events:
+        await request.app.state.db.apply_file_event(event)
+
+    return {}
+
+
+@json_endpoint
+async def connection_pools_status(request):
+    if not request.app.state.config['status']['auth_token']:
+        raise HTTPException(404)
+
+    assert_is_valid_status_authorization_header(request.headers.get('Authorization', ''))
+
+    return responses.connection_pools_status(get_async_pool_stats())
+
+
+@json_endpoint
+async def job_status(request):
+    authorization_header = request.headers.get('Authorization', '')
+    assert_is_valid_authorization_header(authorization_header)
+    token = get_access_token_from_authorization_header(authorization_header)
+    job = await request.app.state.jobDb.get(request.path_params['job_id'], token)
+    if job is None:
+        raise HTTPException(404)
+
+    return responses.job_status(job)
+
+
+# Files of the local storage, as in local_files
+
+async def download_local_file(request):
+    local_bucket = get_bucket(request.app.state.config['storage']['files']['params'])
+    object_name = request.query_params.get('key', '')
+
+    if not local_bucket.is_valid_download(
+        object_name, request.query_params.get('expires', ''), request.query_params.get('signature', '')
+    ):
+        raise HTTPException(403)
+
+    if local_bucket.x_accel_redirect:
+        return Response(media_type='application/octet-stream', headers={
+            'X-Accel-Redirect': local_bucket.x_accel_redirect + local_bucket.relative_object_path(object_name)
+        })
+
+    path = local_bucket.object_path(object_name)
+    if not os.path.isfile(path):
+        raise HTTPException(404)
+    return FileResponse(path, media_type='application/octet-stream')
+
+
+async def upload_local_file(request):
+    # as in local_files: the size of the request, the policy, then the file
+    cl = _content_length(request)
+    if cl is None:
+        raise HTTPException(411)
+    if cl > MAX_UPLOAD_REQUEST_SIZE:
+        raise HTTPException(413)
+
+    # reading the form needs python-multipart
+    local_bucket = get_bucket(request.app.state.config['storage']['files']['params'])
+    form = await request.form()
+    policy = local_bucket.get_upload_policy(form)
+    parsed = policy and parse_user_object_name(policy['key'])
+    if not parsed:
+        raise HTTPException(403)
+
+    uploaded_file = form.get('file')
+    if uploaded_file is None or isinstance(uploaded_file, str):
+        raise HTTPException(400)
+
+    content = await uploaded_file.read(MAX_UPLOAD_SIZE + 1)
+    if not local_bucket.allows_size(policy, len(content)):
+        raise HTTPException(403)
+
+    username, filename = parsed
+    file_storage = async_access_user_storage(username)
+    f = await file_storage.put_file(file_storage.build_file(filename, dict(content=content)))
+
+    return Response(status_code=204, headers={'ETag': '"{}"'.format(f.checksum)})
+
+
+# Links, as in controller
+
+@lru_cache(maxsize=256)
+def _cached_url_for(base_url, endpoint):
+    return Router(routes).url_path_for(endpoint).make_absolute_url(base_url=base_url)
+
+
+def external_url(request, endpoint, **params):
+    path_params = {name: params.pop(name) for name in _path_params(endpoint) if name in params}
+    if path_params:
+        url = request.url_for(endpoint, **path_params)
+    else:
+        # built once per host, as in controller
+        url = _cached_url_for(str(request.base_url), endpoint)
+    if params:
+        url = url.include_query_params(**params)
+    return str(url)
+
+
+@lru_cache(maxsize=None)
+def _path_params(endpoint):
+    return next(route.param_convertors for route in routes if route.name == endpoint)
+
+
+def links(request):
+    '''The url_for of responses, for the host the request reached.'''
+    return partial(external_url, request)
+
+
+# The application
+
+routes = [
+    Route('/', root, methods=['GET']),
+    Route('/files/', list_user_files, methods=['GET']),
+    Route('/files/', file_delete, methods=['DELETE']),
+    Route('/users/', new_user, methods=['POST']),
+    Route('/users/', delete_user, methods=['DELETE']),
+    Route('/auth/request-challenge', auth_user_request_challenge, methods=['GET']),
+    Route('/auth/answer-challenge', auth_user_answer_challenge, methods=['POST']),
+    Route('/files/request-upload-url', request_upload_url, methods=['POST']),
+    Route('/events/s3', ingest_s3_events, methods=['HEAD', 'POST']),
+    Route('/status/connection-pools', connection_pools_status, methods=['GET']),
+    Route('/jobs/{job_id}', job_status, methods=['GET']),
+]
+
+local_files_routes = [
+    Route(FILES_PATH, download_local_file, methods=['GET']),
+    Route(FILES_PATH, upload_local_file, methods=['POST']),
+]
+
+
+class ResponseHeadersMiddleware:
+    '''Add the CORS and Server-Timing headers, as app does after every request.'''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        timings = server_timing.start()
+
+        async def send_with_headers(message):
+            if message['type'] == 'http.response.start':
+                headers = MutableHeaders(scope=message)
+                headers['Access-Control-Allow-Origin'] = '*'
+                headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+                headers['Access-Control-Max-Age'] = '86400'
+                headers['Access-Control-Allow-Methods'] = 'HEAD, OPTIONS, GET, POST, PUT, DELETE'
+                headers['Server-Timing'] = server_timing.stop(timings)
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # the storages hold connections bound to the event loop of the server
+    await async_access_admin_storage().check_bucket()
+
+    if app.state.config['warm_cache_on_startup']:
+        # with the sync storages, in a thread
+        warm_cache_in_background()
+    app.state.db = get_async_cache_storage()
+    app.state.tokenDb = get_async_token_storage()
+    app.state.jobDb = get_async_job_storage()
+
+    yield
+
+    await close_async_files_clients()
+    await close_async_connections()
+
+
+def create_asgi_app(config):
+    app = Starlette(
+        routes=routes + local_files_routes if files_served_by_the_app() else routes,
+        exception_handlers={HTTPException: on_http_exception},
+        lifespan=lifespan
+    )
+    app.state.config = config
+    json_backend.use_json_backend(config['json_backend'])
+    app.add_middleware(ResponseHeadersMiddleware)
+
+    sentry_sdk.init(
+        config['sentry']['dsn'],
+        integrations=[RedisIntegration()],
+    )
+    return SentryAsgiMiddleware(app)
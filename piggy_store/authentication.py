@@ -22,3 +22,14 @@ def assert_is_valid_authorization_header(header):
 
 def get_access_token_from_authorization_header(header):
     return header.split(' ')[1]
+
+def assert_is_valid_events_authorization_header(header):
+    # the token configured for the webhook target in the S3 server
+    expected_header = 'Bearer ' + config['events']['auth_token']
+    if not compare_digest(header.encode('utf-8'), expected_header.encode('utf-8')):
+        raise TokenInvalidError()
+
+def assert_is_valid_status_authorization_header(header):
+    expected_header = 'Bearer ' + config['status']['auth_token']
+    if not compare_digest(header.encode('utf-8'), expected_header.encode('utf-8')):
+        raise TokenInvalidError()
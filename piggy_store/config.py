@@ -43,6 +43,17 @@ def _time_delta_from_human_to_timedelta(humandelta):
     return timedelta(**kwargs)
 
 
+# the async counterparts of the cache and the file storages
+ASYNC_CACHE_MODULES = {
+    'piggy_store.storage.cache.redis_storage': 'piggy_store.storage.cache.async_redis_storage',
+    'piggy_store.storage.cache.memory_storage': 'piggy_store.storage.cache.async_memory_storage'
+}
+ASYNC_FILES_MODULES = {
+    'piggy_store.storage.files.s3_storage': 'piggy_store.storage.files.async_s3_storage',
+    'piggy_store.storage.files.local_storage': 'piggy_store.storage.files.async_local_storage'
+}
+
+
 def load(config_path):
     global config
 
@@ -63,6 +74,27 @@ def _sanitize_config(config):
     config.setdefault('uploads', {})
     config.setdefault('users_whitelist', [])
     config.setdefault('auth_token_expire_after', '2 hours')
+    config.setdefault('auth_token_key', None)
+    config.setdefault('auth_token_key_file', None)
+    config.setdefault('auth_token_key_cache_dir', None)
+    config.setdefault('auth_token_cache_size', 10000)
+    config.setdefault('auth_token_check_cache_ttl', '5s')
+    config.setdefault('delete_user_in_background_after', 10000)
+    config.setdefault('legacy_challenge_files', True)
+    config.setdefault('warm_cache_on_startup', False)
+    config.setdefault('unknown_users_cache_ttl', '1m')
+    config.setdefault('users_filter', {})
+    config['users_filter'].setdefault('enabled', False)
+    config['users_filter'].setdefault('capacity', 1000000)
+    config['users_filter'].setdefault('error_rate', 0.01)
+    config.setdefault('json_backend', 'auto')
+    config.setdefault('events', {})
+    config['events'].setdefault('enabled', False)
+    config['events'].setdefault('auth_token', None)
+    config.setdefault('status', {})
+    config['status'].setdefault('auth_token', None)
+    config.setdefault('server_timing', {})
+    config['server_timing'].setdefault('breakdown', True)
     config['uploads'].setdefault('max_content_length', '1M')
 
     try:
@@ -88,6 +120,9 @@ def _sanitize_config(config):
     except KeyError as e:
         raise ConfigError('A config key is missing: {}'.format(e.args[0]))
 
+    if config['events']['enabled'] and not config['events']['auth_token']:
+        raise ConfigError('events.auth_token is required when events are enabled')
+
     config['uploads']['max_content_length'] = _size_from_human_to_bytes(
         config['uploads']['max_content_length']
     )
@@ -96,8 +131,36 @@ def _sanitize_config(config):
         config['storage']['files']['params'].get('download_url_expire_after', '1 day')
     )
 
+    # the modules used by the async app (see piggy_store.asgi)
+    config['storage']['cache'].setdefault('async_module', ASYNC_CACHE_MODULES.get(
+        config['storage']['cache']['module'], 'piggy_store.storage.cache.async_redis_storage'
+    ))
+    config['storage']['files'].setdefault('async_module', ASYNC_FILES_MODULES.get(
+        config['storage']['files']['module'], 'piggy_store.storage.files.async_s3_storage'
+    ))
+
+    config['storage']['cache']['params'].setdefault('unix_socket_path', None)
+    config['storage']['cache']['params'].setdefault('max_connections', 20)
+    config['storage']['cache']['params'].setdefault('pool_timeout', 5)
+    config['storage']['cache']['params'].setdefault('socket_timeout', None)
+    config['storage']['cache']['params'].setdefault('socket_connect_timeout', None)
+    config['storage']['cache']['params'].setdefault('socket_keepalive', True)
+    config['storage']['cache']['params'].setdefault('health_check_interval', 30)
+
+    config['storage']['files']['params'].setdefault('connection_pool_size', 10)
+    config['storage']['files']['params'].setdefault('connection_timeout', None)
+    config['storage']['files']['params'].setdefault('tcp_keepalive', True)
+    config['storage']['files']['params'].setdefault('stat_concurrency', 8)
+    config['storage']['files']['params'].setdefault('delete_concurrency', 4)
+
     config['auth_token_expire_after'] = _time_delta_from_human_to_timedelta(
         config['auth_token_expire_after']
     )
+    config['auth_token_check_cache_ttl'] = _time_delta_from_human_to_timedelta(
+        str(config['auth_token_check_cache_ttl'])
+    )
+    config['unknown_users_cache_ttl'] = _time_delta_from_human_to_timedelta(
+        str(config['unknown_users_cache_ttl'])
+    )
 
     return config
@@ -1,7 +1,7 @@
-from flask import Blueprint, abort, request, url_for
+from flask import Blueprint, Response, abort, request, stream_with_context, url_for
 from flask_json import FlaskJSON, as_json
 from werkzeug.local import LocalProxy
-from functools import wraps
+from functools import lru_cache, wraps
 
 from piggy_store.storage.user_entity import User
 from piggy_store.validators import (
@@ -9,23 +9,27 @@ from piggy_store.validators import (
     auth_user_request_challenge_validator,
     auth_user_answer_challenge_validator,
     request_upload_url_validator,
-    file_delete_validator
+    list_user_files_validator,
+    file_delete_validator,
+    s3_events_validator
 )
 from piggy_store.authentication import (
     assert_is_valid_authorization_header,
+    assert_is_valid_events_authorization_header,
+    assert_is_valid_status_authorization_header,
     get_access_token_from_authorization_header
 )
-from piggy_store.storage.cache import get_cache_storage, get_token_storage
-from piggy_store.exceptions import (
-    UserExistsError,
-    ChallengeMismatchError,
-    MaxRequestSizeExceededError,
-    TokenExpiredError
-)
+from piggy_store import responses
+from piggy_store.config import config
+from piggy_store.jobs import run_in_background
+from piggy_store.storage.cache import get_cache_storage, get_job_storage, get_token_storage
+from piggy_store.storage.cache.connection import get_pool_stats
+from piggy_store.exceptions import TokenExpiredError
 
 bp = blueprint = Blueprint('controller', __name__)
 db = LocalProxy(get_cache_storage)
 tokenDb = LocalProxy(get_token_storage)
+jobDb = LocalProxy(get_job_storage)
 
 def authentication(func):
     @wraps(func)
@@ -43,9 +47,7 @@ def limit_content_length(max_length):
     def decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            cl = request.content_length
-            if cl is not None and cl > max_length:
-                raise MaxRequestSizeExceededError(max_length, cl)
+            responses.assert_content_length(max_length, request.content_length)
             return f(*args, **kwargs)
         return wrapper
     return decorator
@@ -53,32 +55,51 @@ def limit_content_length(max_length):
 @bp.route('/', methods=['GET'])
 @as_json
 def root():
-    return {
-        'links': {
-            **hateoas_auth_user_request_challenge(),
-            **hateoas_new_user()
-        }
-    }
+    return responses.root(external_url)
 
 
 @bp.route('/files/', methods=['GET'])
 @as_json
 @authentication
 def list_user_files(tokenBag):
+    payload = list_user_files_validator(request.args)
     user = db.find_user_by_username(tokenBag['username'])
-    files = db.get_user_files(user)
+    # fetch one file more than requested, to know if there is a next page
+    files = iter(db.get_user_files(user, start_after=payload['cursor'], limit=payload['limit'] + 1))
+
+    # Start the listing before the response does, so that an error
+    # talking with the storage can still become an error response
+    first_file = next(files, None)
+
+    return Response(
+        stream_with_context(stream_files_list(first_file, files, payload['limit'])),
+        mimetype='application/json'
+    )
+
+
+def stream_files_list(first_file, files, limit):
+    # The response is written as it is produced, a file at a time, so
+    # that the time to the first byte does not depend on the page size
+    yield responses.files_list_start()
+
+    f = first_file
+    last_file = None
+    num_files = 0
+    # the same for every file
+    delete_link = responses.hateoas_file_delete(external_url)
+
+    while f is not None and num_files < limit:
+        if num_files:
+            yield ', '
+
+        yield responses.files_list_entry(f, delete_link)
+
+        last_file = f
+        num_files += 1
+        f = next(files, None)
 
-    return {
-        'content': [
-            {
-                'content': f.as_dict(),
-                'links': {
-                    **hateoas_file_read(f),
-                    **hateoas_file_delete()
-                }
-            } for f in files
-        ]
-    }
+    # if there are more files than fitted in this page, a link to the next
+    yield responses.files_list_end(external_url, last_file, limit, f is not None)
 
 
 @bp.route('/users/', methods=['POST'])
@@ -92,16 +113,7 @@ def new_user():
     token = tokenDb.generate_token({ 'username': user.username })
     tokenDb.refresh_user_token(user.username, token)
 
-    return {
-        'content': {
-            'token': token,
-            'challenge': stored_challenge
-        },
-        'links': {
-            **hateoas_list_user_files(),
-            **hateoas_request_upload_url()
-        }
-    }
+    return responses.new_user(external_url, token, stored_challenge)
 
 
 @bp.route('/users/', methods=['DELETE'])
@@ -110,13 +122,20 @@ def new_user():
 def delete_user(tokenBag):
     user = db.find_user_by_username(tokenBag['username'])
     tokenDb.remove_user_token(user.username)
+
+    # too many files to remove them while the client waits
+    background_after = config['delete_user_in_background_after']
+    if background_after and db.count_user_files(user, background_after + 1) > background_after:
+        token = get_access_token_from_authorization_header(request.headers['Authorization'])
+        job_id = jobDb.create('delete-user', token)
+        storage = db._get_current_object()
+        run_in_background(job_id, lambda progress: storage.remove_user(user, progress))
+
+        return responses.delete_user(external_url, job_id), 202
+
     db.remove_user(user)
 
-    return {
-        'links': {
-            **hateoas_new_user()
-        }
-    }
+    return responses.delete_user(external_url)
 
 
 @bp.route('/auth/request-challenge', methods=['GET'])
@@ -126,15 +145,7 @@ def auth_user_request_challenge():
     payload = auth_user_request_challenge_validator(unsafe_payload)
     user = db.find_user_by_username(payload['username'])
 
-    return {
-        'content': {
-            'challenge': user.challenge
-        },
-        'links': {
-            **hateoas_new_user(),
-            **hateoas_auth_user_answer_challenge()
-        }
-    }
+    return responses.auth_user_request_challenge(external_url, user)
 
 
 @bp.route('/auth/answer-challenge', methods=['POST'])
@@ -144,23 +155,12 @@ def auth_user_answer_challenge():
     unsafe_payload = request.get_json() or {}
     payload = auth_user_answer_challenge_validator(unsafe_payload)
     user = db.find_user_by_username(payload['username'])
-    correct_answer = user.answer
-
-    if payload['answer'] != correct_answer:
-        raise ChallengeMismatchError()
+    responses.assert_answer_matches(user, payload)
 
     token = tokenDb.generate_token({ 'username': user.username })
     tokenDb.refresh_user_token(user.username, token)
 
-    return {
-        'content': {
-            'token': token
-        },
-        'links': {
-            **hateoas_list_user_files(),
-            **hateoas_request_upload_url()
-        }
-    }
+    return responses.auth_user_answer_challenge(external_url, token)
 
 
 @bp.route('/files/', methods=['DELETE'])
@@ -181,82 +181,68 @@ def request_upload_url(tokenBag):
     unsafe_payload = request.get_json() or {}
     payload = request_upload_url_validator(unsafe_payload)
     user = db.find_user_by_username(tokenBag['username'])
-    upload_url, form_data = db.get_presigned_post_policy(user, payload['filename'])
-    retrieve_url = db.get_presigned_retrieve_url(user, payload['filename'])
-
-    return {
-        'links': {
-            'upload_url': {
-                'rel': 'file',
-                'href': upload_url,
-                'form_data': form_data
-            },
-            'retrieve_url': {
-                'rel': 'file',
-                'href': retrieve_url
-            }
-        }
-    }
-
-
-def hateoas_auth_user_request_challenge():
-    return {
-        'request_auth_challenge': {
-            'rel': 'auth',
-            'href': url_for('controller.auth_user_request_challenge', _external=True)
-        }
-    }
-
-
-def hateoas_auth_user_answer_challenge():
-    return {
-        'answer_auth_challenge': {
-            'rel': 'auth',
-            'href': url_for('controller.auth_user_answer_challenge', _external=True)
-        }
-    }
-
-
-def hateoas_new_user():
-    return {
-        'create_user': {
-            'rel': 'user',
-            'href': url_for('controller.new_user', _external=True)
-        }
-    }
-
-
-def hateoas_list_user_files():
-    return {
-        'files_list': {
-            'rel': 'file',
-            'href': url_for('controller.list_user_files', _external=True)
-        }
-    }
-
-
-def hateoas_file_delete():
-    return {
-        'delete': {
-            'rel': 'file',
-            'href': url_for('controller.file_delete', _external=True)
-        }
-    }
-
-
-def hateoas_file_read(f):
-    return {
-        'read': {
-            'rel': 'file',
-            'href': f.url
-        }
-    }
-
-
-def hateoas_request_upload_url():
-    return {
-        'request_upload_url': {
-            'rel': 'file',
-            'href': url_for('controller.request_upload_url', _external=True)
-        }
-    }
+    upload_url, form_data, retrieve_url = db.get_presigned_upload(user, payload['filename'])
+
+    return responses.request_upload_url(upload_url, form_data, retrieve_url)
+
+
+@bp.route('/events/s3', methods=['HEAD', 'POST'])
+@limit_content_length(256 * 1024)
+@as_json
+def ingest_s3_events():
+    # Webhook for the bucket's notifications (e.g. a minio webhook
+    # target), so that the cached file lists follow the uploads done
+    # straight to the bucket without rescanning it.
+    if not config['events']['enabled']:
+        abort(404)
+
+    assert_is_valid_events_authorization_header(request.headers.get('Authorization', ''))
+
+    if request.method == 'HEAD':
+        # minio checks that the endpoint is reachable
+        return {}
+
+    unsafe_payload = request.get_json() or {}
+    events = s3_events_validator(unsafe_payload, config['storage']['files']['params']['bucket'])
+    for event in events:
+        db.apply_file_event(event)
+
+    return {}
+
+
+@bp.route('/status/connection-pools', methods=['GET'])
+@as_json
+def connection_pools_status():
+    # for the operators, to tune the pools of the workers
+    if not config['status']['auth_token']:
+        abort(404)
+
+    assert_is_valid_status_authorization_header(request.headers.get('Authorization', ''))
+
+    return responses.connection_pools_status(get_pool_stats())
+
+
+@bp.route('/jobs/<job_id>', methods=['GET'])
+@as_json
+def job_status(job_id):
+    # only for the token that started the job
+    authorization_header = request.headers.get('Authorization', '')
+    assert_is_valid_authorization_header(authorization_header)
+    job = jobDb.get(job_id, get_access_token_from_authorization_header(authorization_header))
+    if job is None:
+        abort(404)
+
+    return responses.job_status(job)
+
+
+@lru_cache(maxsize=256)
+def _cached_external_url(url_root, endpoint):
+    return url_for(endpoint, _external=True)
+
+
+def external_url(endpoint, **params):
+    if params:
+        return url_for('controller.' + endpoint, _external=True, **params)
+    # The links to the endpoints only change with the host (and scheme)
+    # the client reached, so they are built once per host, not per link
+    return _cached_external_url(request.url_root, 'controller.' + endpoint)
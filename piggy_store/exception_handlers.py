@@ -3,85 +3,42 @@ import logging
 from flask_json import as_json
 import werkzeug
 
-from piggy_store.exceptions import (
-    PiggyStoreError,
-    UserDoesNotExistError,
-    MultipleFilesRemoveError,
-    ChallengeMismatchError,
-    UserNotAllowedError
-)
-
-from piggy_store.controller import hateoas_new_user
+from piggy_store import responses
+from piggy_store.controller import external_url
+from piggy_store.exceptions import PiggyStoreError
 
 logger = logging.getLogger('errors')
 
 
-def handle_unhautorized_errors(e):
-    return make_error_response(401, e.code, e.message, links=hateoas_new_user())
-
-
-def handle_forbidden_errors(e):
-    return make_error_response(403, e.code, e.message)
-
-
 def handle_piggy_store_errors(e):
-    return make_error_response(409, e.code, e.message)
-
-
-def handle_external_errors(e):
-    return make_error_response(500, e.code, e.message)
+    # 401, 403, 500 caused by errors in external communications, or 409
+    return make_error_response(*responses.piggy_store_error(external_url, e))
 
 
 def on_flask_http_exception(e):
     if isinstance(e, werkzeug.exceptions.HTTPException):
-        return make_error_response(e.code, e.code, e.name)
+        return make_error_response(*responses.error(e.code, e.code, e.name))
     else:
         # XXX can't remember how to reproduce it, I swear it can happen
         logger.exception(e)
-        return make_error_response(500, 500, 'Internal Server Error')
+        return make_error_response(*responses.internal_server_error())
 
 
 def on_error(e):
     logger.exception(e)
-    return make_error_response(500, 500, 'Internal Server Error')
+    return make_error_response(*responses.internal_server_error())
 
 
 @as_json
-def make_error_response(status, subcode, message, links=None):
-    json_content = {
-        'error': {
-            'code': subcode,
-            'message': message
-        },
-        'status': status
-    }
-
-    if links:
-        json_content['links'] = {
-            **links
-        }
-
+def make_error_response(json_content, status):
     return json_content, status
 
 
 def register_default_exceptions(app):
     app.register_error_handler(Exception, on_error)
 
-    # 401s
-    for exc_class in (UserDoesNotExistError, ):
-        app.register_error_handler(exc_class, handle_unhautorized_errors)
-
-    # 403s
-    for exc_class in (ChallengeMismatchError, UserNotAllowedError):
-        app.register_error_handler(exc_class, handle_forbidden_errors)
-
-    # 500 caused by errors in external communications
-    for exc_class in (MultipleFilesRemoveError, ):
-        app.register_error_handler(exc_class, handle_external_errors)
-
-    # 409, generic error
-    for exc_class in (PiggyStoreError, ):
-        app.register_error_handler(exc_class, handle_piggy_store_errors)
+    # the status depends on the error, see responses.piggy_store_error
+    app.register_error_handler(PiggyStoreError, handle_piggy_store_errors)
 
     for werkzeugException in werkzeug.exceptions.default_exceptions:
         app.register_error_handler(werkzeugException, on_flask_http_exception)
@@ -142,3 +142,14 @@ class FieldMaxLengthError(PiggyStoreError):
 
     def __init__(self, field_name, length):
         super().__init__(self.CODE, self.MESSAGE.format(field_name, length))
+
+class FieldRangeError(PiggyStoreError):
+    CODE = 1021
+    MESSAGE = 'Expected {} to be between {} and {}'
+
+    def __init__(self, field_name, min_value, max_value):
+        super().__init__(self.CODE, self.MESSAGE.format(field_name, min_value, max_value))
+
+class CursorInvalidError(PiggyStoreError):
+    CODE = 1022
+    MESSAGE = 'The cursor is not valid'
@@ -0,0 +1,63 @@
+'''Tasks too long for a request, run by a thread of the worker.
+
+Their state is kept by the JobStorage, so that any worker can answer
+GET /jobs/<job_id>. The thread records a heartbeat while the job runs: a
+job that dies with its worker is reported failed once its heartbeat is
+stale.
+'''
+
+import logging
+import threading
+
+from piggy_store.exceptions import PiggyStoreError
+from piggy_store.storage.cache import get_job_storage
+
+logger = logging.getLogger('errors')
+
+# well under JobStorage.stale_after
+HEARTBEAT_INTERVAL = 10
+
+
+def run_in_background(job_id, func):
+    '''Call func(progress) in a new thread.
+
+    progress(n) records that n units of work are done.
+    '''
+
+    def run():
+        job_storage = get_job_storage()
+
+        def progress(n):
+            job_storage.update(job_id, progress=n)
+
+        finished = threading.Event()
+        # a daemon: it must not keep alive a worker that's killed
+        threading.Thread(
+            target=heartbeat, args=(job_storage, job_id, finished), name='job-heartbeat-' + job_id, daemon=True
+        ).start()
+
+        try:
+            func(progress)
+        except PiggyStoreError as e:
+            job_storage.update(job_id, state='failed', error=e.message)
+        except Exception as e:
+            logger.exception(e)
+            job_storage.update(job_id, state='failed', error='Internal Error')
+        else:
+            job_storage.update(job_id, state='done')
+        finally:
+            finished.set()
+
+    # not a daemon: a worker that's stopped gracefully completes its jobs
+    thread = threading.Thread(target=run, name='job-' + job_id)
+    thread.start()
+    return thread
+
+
+def heartbeat(job_storage, job_id, finished):
+    # between the progresses, that may be far apart
+    while not finished.wait(HEARTBEAT_INTERVAL):
+        try:
+            job_storage.update(job_id)
+        except Exception as e:
+            logger.exception(e)
@@ -0,0 +1,68 @@
+'''Uploads and downloads of the files of the local storage, at the urls
+it signs: what S3 does for the s3 storage.
+
+Registered by create_app when the files module is local_storage.
+'''
+
+from flask import Blueprint, Response, abort, request, send_file
+
+from piggy_store.config import config
+from piggy_store.storage.files import access_user_storage, parse_user_object_name
+from piggy_store.storage.files.local_storage import FILES_PATH, MAX_UPLOAD_REQUEST_SIZE, MAX_UPLOAD_SIZE, get_bucket
+
+bp = blueprint = Blueprint('local_files', __name__)
+
+
+@bp.route(FILES_PATH, methods=['GET'])
+def download_file():
+    local_bucket = get_bucket(config['storage']['files']['params'])
+    object_name = request.args.get('key', '')
+
+    expires = request.args.get('expires', '')
+    if not local_bucket.is_valid_download(object_name, expires, request.args.get('signature', '')):
+        abort(403)
+
+    if local_bucket.x_accel_redirect:
+        # nginx sends the file, from its internal location of the directory
+        response = Response(mimetype='application/octet-stream')
+        relative_path = local_bucket.relative_object_path(object_name)
+        response.headers['X-Accel-Redirect'] = local_bucket.x_accel_redirect + relative_path
+        return response
+
+    try:
+        # sent with sendfile by the WSGI servers that offer wsgi.file_wrapper
+        return send_file(local_bucket.object_path(object_name), mimetype='application/octet-stream', conditional=True)
+    except FileNotFoundError:
+        abort(404)
+
+
+@bp.route(FILES_PATH, methods=['POST'])
+def upload_file():
+    # the form is only parsed if the request is small enough, and the
+    # file only read if the policy is valid
+    if request.content_length is None:
+        abort(411)
+    if request.content_length > MAX_UPLOAD_REQUEST_SIZE:
+        abort(413)
+
+    local_bucket = get_bucket(config['storage']['files']['params'])
+    policy = local_bucket.get_upload_policy(request.form)
+    parsed = policy and parse_user_object_name(policy['key'])
+    if not parsed:
+        abort(403)
+
+    uploaded_file = request.files.get('file')
+    if uploaded_file is None:
+        abort(400)
+
+    content = uploaded_file.read(MAX_UPLOAD_SIZE + 1)
+    if not local_bucket.allows_size(policy, len(content)):
+        abort(403)
+
+    username, filename = parsed
+    file_storage = access_user_storage(username)
+    f = file_storage.put_file(file_storage.build_file(filename, dict(content=content)))
+
+    response = Response(status=204)
+    response.headers['ETag'] = '"{}"'.format(f.checksum)
+    return response
@@ -0,0 +1,20 @@
+import base64
+import binascii
+
+from piggy_store.exceptions import CursorInvalidError
+
+# S3 doesn't return more than 1000 keys per LIST request, so a page of
+# this size costs a single round trip
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(filename):
+    return base64.urlsafe_b64encode(filename.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        return base64.urlsafe_b64decode(cursor + padding).decode('utf-8')
+    except (binascii.Error, UnicodeError, ValueError):
+        raise CursorInvalidError()
@@ -0,0 +1,260 @@
+'''The responses of the API, for both piggy_store.app and piggy_store.asgi.
+
+The links are built with the `url_for(endpoint, **params)` of the
+application: the absolute url of an endpoint, by the name of its function
+in controller, with the params that are not part of its path as query.
+'''
+
+from piggy_store import json_backend
+from piggy_store.exceptions import (
+    ChallengeMismatchError,
+    MaxRequestSizeExceededError,
+    MultipleFilesRemoveError,
+    UserDoesNotExistError,
+    UserNotAllowedError
+)
+from piggy_store.pagination import encode_cursor
+from piggy_store.storage.files import parse_user_object_name
+
+
+# Requests
+
+def assert_content_length(max_length, content_length):
+    if content_length is not None and content_length > max_length:
+        raise MaxRequestSizeExceededError(max_length, content_length)
+
+
+def assert_answer_matches(user, payload):
+    if payload['answer'] != user.answer:
+        raise ChallengeMismatchError()
+
+
+# Errors
+
+def error(status, subcode, message, links=None):
+    content = {
+        'error': {
+            'code': subcode,
+            'message': message
+        },
+        'status': status
+    }
+
+    if links:
+        content['links'] = {
+            **links
+        }
+
+    return content, status
+
+
+def piggy_store_error(url_for, e):
+    if isinstance(e, UserDoesNotExistError):
+        return error(401, e.code, e.message, links=hateoas_new_user(url_for))
+    if isinstance(e, (ChallengeMismatchError, UserNotAllowedError)):
+        return error(403, e.code, e.message)
+    if isinstance(e, MultipleFilesRemoveError):
+        # caused by errors in external communications
+        return error(500, e.code, e.message)
+    # generic error
+    return error(409, e.code, e.message)
+
+
+def internal_server_error():
+    return error(500, 500, 'Internal Server Error')
+
+
+# Endpoints
+
+def root(url_for):
+    return {
+        'links': {
+            **hateoas_auth_user_request_challenge(url_for),
+            **hateoas_new_user(url_for)
+        }
+    }
+
+
+def files_list_start():
+    return '{"status": 200, "content": ['
+
+
+def files_list_entry(f, delete_link):
+    return json_backend.dumps({
+        'content': f.as_dict(),
+        'links': {
+            **hateoas_file_read(f),
+            **delete_link
+        }
+    })
+
+
+def files_list_end(url_for, last_file, limit, has_next_page):
+    if not has_next_page:
+        return ']}'
+
+    # the listing resumes after the key of the file in the user's
+    # directory: its filename is only the last part of it
+    _, last_key = parse_user_object_name(last_file.object_name)
+    next_page_link = hateoas_list_user_files_next_page(url_for, last_key, limit)
+    return '], "links": ' + json_backend.dumps(next_page_link) + '}'
+
+
+def new_user(url_for, token, stored_challenge):
+    return {
+        'content': {
+            'token': token,
+            'challenge': stored_challenge
+        },
+        'links': {
+            **hateoas_list_user_files(url_for),
+            **hateoas_request_upload_url(url_for)
+        }
+    }
+
+
+def delete_user(url_for, job_id=None):
+    links = hateoas_new_user(url_for)
+    if job_id is not None:
+        links.update(hateoas_job_status(url_for, job_id))
+
+    return {
+        'links': links
+    }
+
+
+def auth_user_request_challenge(url_for, user):
+    return {
+        'content': {
+            'challenge': user.challenge
+        },
+        'links': {
+            **hateoas_new_user(url_for),
+            **hateoas_auth_user_answer_challenge(url_for)
+        }
+    }
+
+
+def auth_user_answer_challenge(url_for, token):
+    return {
+        'content': {
+            'token': token
+        },
+        'links': {
+            **hateoas_list_user_files(url_for),
+            **hateoas_request_upload_url(url_for)
+        }
+    }
+
+
+def request_upload_url(upload_url, form_data, retrieve_url):
+    return {
+        'links': {
+            'upload_url': {
+                'rel': 'file',
+                'href': upload_url,
+                'form_data': form_data
+            },
+            'retrieve_url': {
+                'rel': 'file',
+                'href': retrieve_url
+            }
+        }
+    }
+
+
+def connection_pools_status(redis_pool_stats):
+    return {
+        'content': {
+            'redis': redis_pool_stats
+        }
+    }
+
+
+def job_status(job):
+    return {
+        'content': job
+    }
+
+
+# Links
+
+def hateoas_auth_user_request_challenge(url_for):
+    return {
+        'request_auth_challenge': {
+            'rel': 'auth',
+            'href': url_for('auth_user_request_challenge')
+        }
+    }
+
+
+def hateoas_auth_user_answer_challenge(url_for):
+    return {
+        'answer_auth_challenge': {
+            'rel': 'auth',
+            'href': url_for('auth_user_answer_challenge')
+        }
+    }
+
+
+def hateoas_new_user(url_for):
+    return {
+        'create_user': {
+            'rel': 'user',
+            'href': url_for('new_user')
+        }
+    }
+
+
+def hateoas_list_user_files(url_for):
+    return {
+        'files_list': {
+            'rel': 'file',
+            'href': url_for('list_user_files')
+        }
+    }
+
+
+def hateoas_list_user_files_next_page(url_for, last_key, limit):
+    return {
+        'next': {
+            'rel': 'file',
+            'href': url_for('list_user_files', cursor=encode_cursor(last_key), limit=limit)
+        }
+    }
+
+
+def hateoas_file_delete(url_for):
+    return {
+        'delete': {
+            'rel': 'file',
+            'href': url_for('file_delete')
+        }
+    }
+
+
+def hateoas_file_read(f):
+    return {
+        'read': {
+            'rel': 'file',
+            'href': f.url
+        }
+    }
+
+
+def hateoas_request_upload_url(url_for):
+    return {
+        'request_upload_url': {
+            'rel': 'file',
+            'href': url_for('request_upload_url')
+        }
+    }
+
+
+def hateoas_job_status(url_for, job_id):
+    return {
+        'job_status': {
+            'rel': 'job',
+            'href': url_for('job_status', job_id=job_id)
+        }
+    }
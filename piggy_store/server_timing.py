@@ -0,0 +1,84 @@
+'''The Server-Timing header of the responses: the total time of the
+request, after the time spent in each dependency and the number of
+calls to it, e.g.
+
+    redis;dur=1.204;desc="3 calls", s3;dur=20.551;desc="1 call", total;dur=25.310
+
+The metrics are redis, s3, disk (the local file storage), presign (the
+urls signed for the files), token (encrypting and decrypting the auth
+tokens) and json (encoding the responses).
+
+They are collected in a context variable, so that the same timers serve
+the sync app (a request per thread) and the async one (a request per
+task). Nothing is timed outside of a request, e.g. in the jobs run in
+background or while a response is streamed, once its headers are sent.
+'''
+
+from contextvars import ContextVar
+import threading
+from time import perf_counter
+
+from piggy_store.config import config
+
+_timings = ContextVar('server_timings', default=None)
+
+
+class Timings:
+    '''The time spent by a request, in total and in each dependency.'''
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.metrics = {}
+        # the threads of an executor, run in a copy of the context of
+        # the request that waits for them, add to its timings
+        self._lock = threading.Lock()
+
+    def add(self, metric, duration):
+        with self._lock:
+            total, count = self.metrics.get(metric, (0, 0))
+            self.metrics[metric] = (total + duration, count + 1)
+
+    def header(self):
+        metrics = [
+            '{};dur={:.3f};desc="{} call{}"'.format(metric, 1000 * total, count, '' if count == 1 else 's')
+            for metric, (total, count) in self.metrics.items()
+        ]
+        metrics.append('total;dur={:.3f}'.format(1000 * (perf_counter() - self.start)))
+        return ', '.join(metrics)
+
+
+def start():
+    '''Start timing the current request, return its Timings.'''
+
+    timings = Timings()
+    _timings.set(timings if config['server_timing']['breakdown'] else None)
+    return timings
+
+
+def stop(timings):
+    '''Stop timing the current request, return its Server-Timing header.'''
+
+    _timings.set(None)
+    return timings.header()
+
+
+class timed:
+    '''Add the time spent in the block to the metric of the current request.
+
+    A class rather than a generator: it's entered for every redis command
+    and every JSON document, timed or not.
+    '''
+
+    __slots__ = ('metric', 'timings', 'start')
+
+    def __init__(self, metric):
+        self.metric = metric
+
+    def __enter__(self):
+        self.timings = _timings.get()
+        if self.timings is not None:
+            self.start = perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self.timings is not None:
+            self.timings.add(self.metric, perf_counter() - self.start)
@@ -1,22 +1,72 @@
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from itertools import islice
+import logging
+import re
 
 from piggy_store.storage.user_entity import User
 from piggy_store.storage.files import (
+    CHALLENGE_FILES_PREFIX,
+    USER_RECORDS_PREFIX,
     access_admin_storage,
     access_user_storage,
+    async_access_admin_storage,
+    async_access_user_storage,
     compose_challenge_file_filename,
-    parse_challenge_file_filename
+    compose_user_record,
+    compose_user_record_filename,
+    parse_challenge_file_filename,
+    parse_user_record,
+    parse_user_record_filename
 )
-from piggy_store.exceptions import UserNotAllowedError
+from piggy_store.exceptions import FileExistsError, UserNotAllowedError
 from piggy_store.config import config
 
+logger = logging.getLogger(__name__)
+
+# what the validators accept at signup
+USERNAME_RE = re.compile('^[a-z0-9][a-z0-9_-]*$')
+ANSWER_RE = re.compile('^[0-9a-fA-F]{32}$')
+
+
+def _list_challenge_files(file_storage):
+    '''Yield (filename, parsed filename) for every challenge file.
+
+    A file that doesn't name a user (e.g. uploaded by hand) is skipped,
+    rather than taken for a user with a wrong username or answer.
+    '''
+
+    for filename, _, _ in file_storage.list_file_keys(prefix=CHALLENGE_FILES_PREFIX):
+        try:
+            parsed = parse_challenge_file_filename(filename)
+        except ValueError:
+            # no answer at all
+            parsed = None
+
+        if parsed and USERNAME_RE.match(parsed['username']) and ANSWER_RE.match(parsed['answer']):
+            yield filename, parsed
+        else:
+            logger.warning('Skipping %s, not the challenge file of a user', filename)
+
+
+def _is_etag_of(etag, content):
+    # the etag of an object uploaded in a single part, unencrypted, is the
+    # MD5 of its content, that S3 checked against the one sent with it
+    return bool(etag) and etag.strip('"') == hashlib.md5(content).hexdigest()
+
+
 class EasyStorageABC(metaclass=ABCMeta):
     @abstractmethod
     def find_user_by_username(self, username):
         raise NotImplementedError()
 
     @abstractmethod
-    def remove_user(self, user):
+    def remove_user(self, user, progress=None):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def count_user_files(self, user, up_to):
         raise NotImplementedError()
 
     @abstractmethod
@@ -24,7 +74,7 @@ class EasyStorageABC(metaclass=ABCMeta):
         raise NotImplementedError()
 
     @abstractmethod
-    def get_user_files(self, user):
+    def get_user_files(self, user, start_after='', limit=None):
         raise NotImplementedError()
 
     @abstractmethod
@@ -35,50 +85,133 @@ class EasyStorageABC(metaclass=ABCMeta):
     def get_presigned_post_policy(self, user, filename):
         raise NotImplementedError()
 
+    @abstractmethod
+    def get_presigned_upload(self, user, filename):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def apply_file_event(self, event):
+        raise NotImplementedError()
+
 
 class EasyStorage(EasyStorageABC):
     def find_user_by_username(self, username):
+        # a single GET, the record's name is known
         file_storage = access_admin_storage()
-        challenge_file = file_storage.get_first_matching_file(compose_challenge_file_filename(username, ''))
+        content = file_storage.get_file_content_if_exists(
+            file_storage.build_file(compose_user_record_filename(username))
+        )
+
+        if content is not None:
+            return parse_user_record(username, content)
+
+        if config['legacy_challenge_files']:
+            return self._find_legacy_user(file_storage, username)
 
-        user = None
-        if challenge_file:
-            challenge = file_storage.get_file_content(challenge_file).decode('utf-8')
-            answer = parse_challenge_file_filename(challenge_file.get_filename())['answer']
-            user = User(username, challenge, answer)
+        return None
 
-        return user
+    def _find_legacy_user(self, file_storage, username):
+        # the layout before the user records: the answer is in the name of
+        # the challenge file, that has to be searched for. The prefix of
+        # foo's files is also the one of foo_bar's, the name must match
+        prefix = compose_challenge_file_filename(username, '')
+        for filename, size, etag in file_storage.list_file_keys(prefix=prefix):
+            parsed = parse_challenge_file_filename(filename)
+            if parsed['username'] == username:
+                challenge_file = file_storage.build_file(filename, dict(size=size, checksum=etag))
+                challenge = file_storage.get_file_content(challenge_file).decode('utf-8')
+                return User(username, challenge, parsed['answer'])
 
-    def remove_user(self, user):
-        user_file_storage = access_user_storage(user.username)
-        user_file_storage.remove_multiple((user_file_storage.get_files_list()))
+        return None
+
+    def list_usernames(self):
+        '''Yield every username, from the names of the records only.'''
+
+        file_storage = access_admin_storage()
+
+        for filename, _, _ in file_storage.list_file_keys(prefix=USER_RECORDS_PREFIX):
+            yield parse_user_record_filename(filename)
+
+        if config['legacy_challenge_files']:
+            for filename, parsed in _list_challenge_files(file_storage):
+                yield parsed['username']
+
+    def list_users(self, concurrency=8):
+        '''Yield every user, reading up to concurrency records at once.'''
+
+        file_storage = access_admin_storage()
+
+        def read_record(filename):
+            content = file_storage.get_file_content(file_storage.build_file(filename))
+            return parse_user_record(parse_user_record_filename(filename), content)
+
+        def read_challenge_file(entry):
+            filename, parsed = entry
+            challenge = file_storage.get_file_content(file_storage.build_file(filename)).decode('utf-8')
+            return User(parsed['username'], challenge, parsed['answer'])
+
+        listings = [(
+            (filename for filename, _, _ in file_storage.list_file_keys(prefix=USER_RECORDS_PREFIX)),
+            read_record
+        )]
+        if config['legacy_challenge_files']:
+            listings.append((_list_challenge_files(file_storage), read_challenge_file))
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for filenames, read in listings:
+                while True:
+                    # a page at a time, not to queue a read per user
+                    batch = list(islice(filenames, 1000))
+                    if not batch:
+                        break
+                    yield from executor.map(read, batch)
+
+    def remove_user(self, user, progress=None):
+        # the files go first: while the user record exists nobody else
+        # can sign up with this username and upload files to be removed
+        access_user_storage(user.username).remove_all(progress)
 
         admin_file_storage = access_admin_storage()
-        challenge_file_filename = compose_challenge_file_filename(user.username, user.answer)
-        f = admin_file_storage.build_file(challenge_file_filename)
-        admin_file_storage.remove_file(f)
+        admin_file_storage.remove_file(admin_file_storage.build_file(compose_user_record_filename(user.username)))
+
+        if config['legacy_challenge_files']:
+            challenge_file_filename = compose_challenge_file_filename(user.username, user.answer)
+            admin_file_storage.remove_file(admin_file_storage.build_file(challenge_file_filename))
 
     def add_user(self, user):
         if config['users_whitelist'] and not user.username in config['users_whitelist']:
             raise UserNotAllowedError(user.username)
 
         file_storage = access_admin_storage()
-        filename = compose_challenge_file_filename(user.username, user.answer)
-        challenge_file = file_storage.build_file(filename, dict(
-            content=user.challenge
+
+        if config['legacy_challenge_files'] and self._find_legacy_user(file_storage, user.username):
+            raise FileExistsError()
+
+        record_file = file_storage.build_file(compose_user_record_filename(user.username), dict(
+            content=compose_user_record(user)
         ))
-        file_storage.add_file(challenge_file)
+        stored_file = file_storage.add_file(record_file)
+
+        if not _is_etag_of(stored_file.checksum, record_file.content):
+            # e.g. an encrypted object, whose etag isn't its MD5
+            if file_storage.get_file_content(record_file) != record_file.content:
+                raise RuntimeError('XXX we wrongly stored the challenge')
+
+        return user.challenge
 
-        stored_challenge = file_storage.get_file_content(challenge_file).decode('utf-8')
+    def count_user_files(self, user, up_to):
+        return access_user_storage(user.username).count_files(up_to)
 
-        if stored_challenge != user.challenge:
-            # it would be better if we could send a checksum client side
-            raise Error('XXX we wrongly stored the challenge')
+    def get_user_files(self, user, start_after='', limit=None):
+        files = access_user_storage(user.username).get_files_list(start_after=start_after)
+        return islice(files, limit) if limit is not None else files
 
-        return stored_challenge
+    def list_user_file_keys(self, user):
+        '''Yield (filename, size, checksum) for every file of the user.'''
+        return access_user_storage(user.username).list_file_keys(backfill_etags=True)
 
-    def get_user_files(self, user):
-        return access_user_storage(user.username).get_files_list()
+    def build_user_files(self, user, entries):
+        return access_user_storage(user.username).build_files(entries)
 
     def remove_file_by_filename(self, user, filename):
         file_storage = access_user_storage(user.username)
@@ -90,7 +223,126 @@ class EasyStorage(EasyStorageABC):
         f = file_storage.build_file(filename)
         return file_storage.get_presigned_post_policy(f)
 
+    def apply_file_event(self, event):
+        # the bucket is where the event happened, nothing to update
+        pass
+
     def get_presigned_retrieve_url(self, user, filename):
         file_storage = access_user_storage(user.username)
         f = file_storage.build_file(filename)
         return file_storage.get_presigned_retrieve_url(f)
+
+    def get_presigned_upload(self, user, filename):
+        '''Return (upload url, form data, retrieve url), signed together.'''
+        file_storage = access_user_storage(user.username)
+        f = file_storage.build_file(filename)
+        return file_storage.get_presigned_upload(f)
+
+
+class AsyncEasyStorage:
+    '''The async counterpart of EasyStorage, for the async app.'''
+
+    async def find_user_by_username(self, username):
+        file_storage = async_access_admin_storage()
+        content = await file_storage.get_file_content_if_exists(
+            file_storage.build_file(compose_user_record_filename(username))
+        )
+
+        if content is not None:
+            return parse_user_record(username, content)
+
+        if config['legacy_challenge_files']:
+            return await self._find_legacy_user(file_storage, username)
+
+        return None
+
+    async def _find_legacy_user(self, file_storage, username):
+        keys = file_storage.list_file_keys(prefix=compose_challenge_file_filename(username, ''))
+        try:
+            async for filename, size, etag in keys:
+                parsed = parse_challenge_file_filename(filename)
+                if parsed['username'] == username:
+                    challenge_file = file_storage.build_file(filename, dict(size=size, checksum=etag))
+                    challenge = (await file_storage.get_file_content(challenge_file)).decode('utf-8')
+                    return User(username, challenge, parsed['answer'])
+        finally:
+            await keys.aclose()
+
+        return None
+
+    async def remove_user(self, user, progress=None):
+        await async_access_user_storage(user.username).remove_all(progress)
+
+        admin_file_storage = async_access_admin_storage()
+        await admin_file_storage.remove_file(admin_file_storage.build_file(compose_user_record_filename(user.username)))
+
+        if config['legacy_challenge_files']:
+            challenge_file_filename = compose_challenge_file_filename(user.username, user.answer)
+            await admin_file_storage.remove_file(admin_file_storage.build_file(challenge_file_filename))
+
+    async def add_user(self, user):
+        if config['users_whitelist'] and not user.username in config['users_whitelist']:
+            raise UserNotAllowedError(user.username)
+
+        file_storage = async_access_admin_storage()
+
+        if config['legacy_challenge_files'] and await self._find_legacy_user(file_storage, user.username):
+            raise FileExistsError()
+
+        record_file = file_storage.build_file(compose_user_record_filename(user.username), dict(
+            content=compose_user_record(user)
+        ))
+        stored_file = await file_storage.add_file(record_file)
+
+        if not _is_etag_of(stored_file.checksum, record_file.content):
+            if await file_storage.get_file_content(record_file) != record_file.content:
+                raise RuntimeError('XXX we wrongly stored the challenge')
+
+        return user.challenge
+
+    async def count_user_files(self, user, up_to):
+        return await async_access_user_storage(user.username).count_files(up_to)
+
+    async def get_user_files(self, user, start_after='', limit=None):
+        if limit is not None and limit <= 0:
+            return
+
+        files = async_access_user_storage(user.username).get_files_list(start_after=start_after)
+        num_files = 0
+        try:
+            async for f in files:
+                yield f
+                num_files += 1
+                if num_files == limit:
+                    break
+        finally:
+            await files.aclose()
+
+    def list_user_file_keys(self, user):
+        return async_access_user_storage(user.username).list_file_keys(backfill_etags=True)
+
+    def build_user_files(self, user, entries):
+        return async_access_user_storage(user.username).build_files(entries)
+
+    async def remove_file_by_filename(self, user, filename):
+        file_storage = async_access_user_storage(user.username)
+        f = file_storage.build_file(filename)
+        await file_storage.remove_file(f)
+
+    def get_presigned_post_policy(self, user, filename):
+        file_storage = async_access_user_storage(user.username)
+        f = file_storage.build_file(filename)
+        return file_storage.get_presigned_post_policy(f)
+
+    async def apply_file_event(self, event):
+        pass
+
+    def get_presigned_retrieve_url(self, user, filename):
+        file_storage = async_access_user_storage(user.username)
+        f = file_storage.build_file(filename)
+        return file_storage.get_presigned_retrieve_url(f)
+
+    def get_presigned_upload(self, user, filename):
+        file_storage = async_access_user_storage(user.username)
+        f = file_storage.build_file(filename)
+        return file_storage.get_presigned_upload(f)
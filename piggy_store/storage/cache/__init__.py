@@ -1,17 +1,89 @@
 from importlib import import_module
 
 from piggy_store.config import config
-from piggy_store.storage.cache.authtoken_storage import AuthTokenStorage
+
+# Besides its Storage, a cache module provides the AuthTokenStorage,
+# ETagStorage, JobStorage and UsersFilter (None if it has no filter) kept
+# in the same place
+
+
+def _cache_module():
+    return import_module(config['storage']['cache']['module'])
+
+
+def _async_cache_module():
+    return import_module(config['storage']['cache']['async_module'])
 
 
 def get_cache_storage():
-    cache_storage_module = import_module(config['storage']['cache']['module'])
-    return cache_storage_module.Storage(config['storage']['cache']['params'])
+    return _cache_module().Storage(config['storage']['cache']['params'])
 
 
-def get_token_storage():
-    return AuthTokenStorage({
+def _token_storage_options():
+    return {
         **config['storage']['cache']['params'],
         'timeout': config['auth_token_expire_after'],
-        'secret': config['secret']
-    })
+        'secret': config['secret'],
+        'key': config['auth_token_key'],
+        'key_file': config['auth_token_key_file'],
+        'key_cache_dir': config['auth_token_key_cache_dir'],
+        'cache_size': config['auth_token_cache_size'],
+        'check_cache_ttl': config['auth_token_check_cache_ttl']
+    }
+
+
+def get_token_storage():
+    return _cache_module().AuthTokenStorage(_token_storage_options())
+
+
+def get_etag_storage():
+    return _cache_module().ETagStorage(config['storage']['cache']['params'])
+
+
+def get_job_storage():
+    return _cache_module().JobStorage(config['storage']['cache']['params'])
+
+
+def get_users_filter():
+    '''Return the UsersFilter, None if it's not enabled.'''
+
+    UsersFilter = _cache_module().UsersFilter
+    if not config['users_filter']['enabled'] or UsersFilter is None:
+        return None
+
+    return UsersFilter(
+        config['storage']['cache']['params'],
+        config['users_filter']['capacity'],
+        config['users_filter']['error_rate']
+    )
+
+
+# The async app's storages use the connections of the running event loop,
+# they must be created from a coroutine
+
+def get_async_cache_storage():
+    return _async_cache_module().Storage(config['storage']['cache']['params'])
+
+
+def get_async_token_storage():
+    return _async_cache_module().AuthTokenStorage.from_options(_token_storage_options())
+
+
+def get_async_etag_storage():
+    return _async_cache_module().ETagStorage.from_options(config['storage']['cache']['params'])
+
+
+def get_async_job_storage():
+    return _async_cache_module().JobStorage.from_options(config['storage']['cache']['params'])
+
+
+def get_async_users_filter():
+    UsersFilter = _async_cache_module().UsersFilter
+    if not config['users_filter']['enabled'] or UsersFilter is None:
+        return None
+
+    return UsersFilter.from_options(
+        config['storage']['cache']['params'],
+        config['users_filter']['capacity'],
+        config['users_filter']['error_rate']
+    )
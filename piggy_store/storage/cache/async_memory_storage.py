@@ -0,0 +1,148 @@
+'''The memory cache for the async app.
+
+The same store as memory_storage's: reading and writing it never waits,
+only the bucket is awaited.
+'''
+
+from piggy_store.exceptions import (
+    UserExistsError,
+    UserDoesNotExistError,
+    FileExistsError
+)
+from piggy_store.storage import AsyncEasyStorage
+from piggy_store.storage.cache.memory_storage import (
+    AuthTokenStorage as SyncAuthTokenStorage,
+    ETagStorage as SyncETagStorage,
+    JobStorage as SyncJobStorage,
+    cache_user,
+    forget_unknown_user,
+    read_cached_user,
+    remember_unknown_user,
+    uncache_user
+)
+from piggy_store.storage.cache.single_flight import AsyncSingleFlight
+
+UsersFilter = None
+
+
+class Storage:
+    def __init__(self, options):
+        self.user_lookups = AsyncSingleFlight()
+        self.es = AsyncEasyStorage()
+
+    async def add_user(self, user):
+        if not cache_user(user):
+            raise UserExistsError()
+        forget_unknown_user(user.username)
+
+        try:
+            return await self.es.add_user(user)
+        except FileExistsError:
+            # see redis_storage.Storage.add_user
+            cache_user(await self.es.find_user_by_username(user.username), replace=True)
+            raise UserExistsError()
+
+    async def remove_user(self, user, progress=None):
+        uncache_user(user.username)
+        await self.es.remove_user(user, progress)
+        uncache_user(user.username)
+
+    async def count_user_files(self, user, up_to):
+        return await self.es.count_user_files(user, up_to)
+
+    async def find_user_by_username(self, username):
+        user, unknown = read_cached_user(username)
+
+        if user is None and not unknown:
+            user = await self.user_lookups.do(username, lambda: self._find_uncached_user(username))
+
+        if user is None:
+            raise UserDoesNotExistError()
+
+        return user
+
+    async def _find_uncached_user(self, username):
+        user = await self.es.find_user_by_username(username)
+        if user:
+            cache_user(user)
+        else:
+            remember_unknown_user(username)
+
+        return user
+
+    def get_user_files(self, user, start_after='', limit=None):
+        return self.es.get_user_files(user, start_after, limit)
+
+    async def remove_file_by_filename(self, user, filename):
+        return await self.es.remove_file_by_filename(user, filename)
+
+    async def get_presigned_post_policy(self, user, filename):
+        return self.es.get_presigned_post_policy(user, filename)
+
+    async def apply_file_event(self, event):
+        pass
+
+    def get_presigned_retrieve_url(self, user, filename):
+        return self.es.get_presigned_retrieve_url(user, filename)
+
+    async def get_presigned_upload(self, user, filename):
+        return self.es.get_presigned_upload(user, filename)
+
+
+class AuthTokenStorage:
+    '''The tokens of memory_storage.AuthTokenStorage, for the async app.'''
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    @classmethod
+    def from_options(cls, options):
+        return cls(SyncAuthTokenStorage(options))
+
+    def generate_token(self, dataBag):
+        return self.tokens.generate_token(dataBag)
+
+    def decode_token(self, token):
+        return self.tokens.decode_token(token)
+
+    async def refresh_user_token(self, username, token):
+        return self.tokens.refresh_user_token(username, token)
+
+    async def remove_user_token(self, username):
+        return self.tokens.remove_user_token(username)
+
+    async def has_user_token(self, username, token):
+        return self.tokens.has_user_token(username, token)
+
+
+class ETagStorage:
+    def __init__(self, etags):
+        self.etags = etags
+
+    @classmethod
+    def from_options(cls, options):
+        return cls(SyncETagStorage(options))
+
+    async def get_many(self, objects):
+        return self.etags.get_many(objects)
+
+    async def set_many(self, objects):
+        self.etags.set_many(objects)
+
+
+class JobStorage:
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    @classmethod
+    def from_options(cls, options):
+        return cls(SyncJobStorage(options))
+
+    async def create(self, kind, token):
+        return self.jobs.create(kind, token)
+
+    async def update(self, job_id, **fields):
+        self.jobs.update(job_id, **fields)
+
+    async def get(self, job_id, token):
+        return self.jobs.get(job_id, token)
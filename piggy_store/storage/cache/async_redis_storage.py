@@ -0,0 +1,314 @@
+'''The redis cache for the async app.
+
+It stores exactly what redis_storage does, with the same keys and
+scripts, so the sync and the async app can share the same redis.
+'''
+
+import asyncio
+import json
+import time
+from uuid import uuid4
+
+import redis
+
+from piggy_store.storage.user_entity import User
+from piggy_store.exceptions import (
+    UserExistsError,
+    UserDoesNotExistError,
+    FileExistsError
+)
+from piggy_store.config import config
+from piggy_store.storage import AsyncEasyStorage
+from piggy_store.storage.cache import get_async_users_filter
+from piggy_store.storage.cache.authtoken_storage import AsyncAuthTokenStorage as AuthTokenStorage
+from piggy_store.storage.cache.connection import get_async_connection
+from piggy_store.storage.cache.etag_storage import AsyncETagStorage as ETagStorage
+from piggy_store.storage.cache.job_storage import AsyncJobStorage as JobStorage
+from piggy_store.storage.cache.users_filter import AsyncUsersFilter as UsersFilter
+from piggy_store.storage.cache.redis_storage import (
+    ADD_USER_SCRIPT,
+    APPLY_FILE_EVENT_SCRIPT,
+    FILES_INDEX_CHUNK_SIZE,
+    FILES_INDEX_LOCK_TIMEOUT,
+    READ_FILES_INDEX_SCRIPT,
+    RELEASE_LOCK_SCRIPT,
+    USER_LOOKUP_LOCK_TIMEOUT,
+    USER_LOOKUP_POLL_INTERVAL,
+    Storage as SyncStorage
+)
+from piggy_store.storage.cache.single_flight import AsyncSingleFlight
+from piggy_store.storage.files import UPLOAD_URL_EXPIRE_AFTER
+
+
+class Storage:
+    files_index_timeout = SyncStorage.files_index_timeout
+
+    def __init__(self, options):
+        self.conn = get_async_connection(options)
+        self.add_user_to_cache = self.conn.register_script(ADD_USER_SCRIPT)
+        self.read_files_index = self.conn.register_script(READ_FILES_INDEX_SCRIPT)
+        self.update_files_index = self.conn.register_script(APPLY_FILE_EVENT_SCRIPT)
+        self.release_lock = self.conn.register_script(RELEASE_LOCK_SCRIPT)
+        self.user_lookups = AsyncSingleFlight()
+        self.es = AsyncEasyStorage()
+
+    async def add_user(self, user):
+        await self._add_user_to_cache(user)
+        await self._forget_unknown_user(user.username)
+
+        try:
+            return await self.es.add_user(user)
+        except FileExistsError:
+            # see redis_storage.Storage.add_user
+            await self._update_user_cache(await self.es.find_user_by_username(user.username))
+            raise UserExistsError()
+
+    async def _add_user_to_cache(self, user):
+        added = await self.add_user_to_cache(keys=[user.username], args=[user.challenge, user.answer])
+        if added == 0:
+            raise UserExistsError()
+
+    async def _update_user_cache(self, user):
+        await self.conn.hset(user.username, mapping={
+            'challenge': user.challenge,
+            'answer': user.answer
+        })
+
+    async def remove_user(self, user, progress=None):
+        await self.conn.delete(user.username)
+        await self.es.remove_user(user, progress)
+        await self.conn.delete(user.username)
+        await self._invalidate_files_index(user.username)
+
+    async def count_user_files(self, user, up_to):
+        return await self.es.count_user_files(user, up_to)
+
+    async def find_user_by_username(self, username):
+        user, unknown = await self._read_cached_user(username)
+
+        if user is None and not unknown:
+            user = await self.user_lookups.do(username, lambda: self._find_uncached_user(username))
+
+        if user is None:
+            raise UserDoesNotExistError()
+
+        return user
+
+    async def _read_cached_user(self, username):
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.hgetall(username)
+        pipe.exists('nouser:' + username)
+        data, unknown = await pipe.execute()
+
+        return (User(username, data['challenge'], data['answer']) if data else None), bool(unknown)
+
+    async def _find_uncached_user(self, username):
+        # see redis_storage.Storage._find_uncached_user
+        users_filter = get_async_users_filter()
+        if users_filter and not await users_filter.might_exist(username):
+            return None
+
+        lock_key = 'user-lookup:' + username
+        lock_token = uuid4().hex
+        deadline = time.monotonic() + USER_LOOKUP_LOCK_TIMEOUT
+
+        while not await self.conn.set(lock_key, lock_token, nx=True, ex=USER_LOOKUP_LOCK_TIMEOUT):
+            await asyncio.sleep(USER_LOOKUP_POLL_INTERVAL)
+
+            user, unknown = await self._read_cached_user(username)
+            if user or unknown:
+                return user
+
+            if time.monotonic() > deadline:
+                lock_token = None
+                break
+
+        try:
+            user = await self.es.find_user_by_username(username)
+            if user:
+                await self.add_user_to_cache(keys=[user.username], args=[user.challenge, user.answer])
+            else:
+                await self._remember_unknown_user(username)
+        finally:
+            if lock_token:
+                await self.release_lock(keys=[lock_key], args=[lock_token])
+
+        return user
+
+    async def _remember_unknown_user(self, username):
+        ttl = int(config['unknown_users_cache_ttl'].total_seconds())
+        if ttl > 0:
+            await self.conn.setex('nouser:' + username, ttl, 1)
+
+    async def _forget_unknown_user(self, username):
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.delete('nouser:' + username)
+        users_filter = get_async_users_filter()
+        if users_filter:
+            await users_filter.add(username, pipe)
+        await pipe.execute()
+
+    async def get_user_files(self, user, start_after='', limit=None):
+        page = await self.read_files_index(
+            keys=self._files_index_keys(user.username),
+            args=['(' + start_after if start_after else '-', limit if limit is not None else -1]
+        )
+
+        if page == -1:
+            files = self.es.get_user_files(user, start_after, limit)
+            try:
+                async for f in files:
+                    yield f
+            finally:
+                await files.aclose()
+            return
+
+        if page is None:
+            chunks = self._index_user_files(user, start_after, limit)
+            try:
+                async for entries in chunks:
+                    for f in self.es.build_user_files(user, entries):
+                        yield f
+            finally:
+                await chunks.aclose()
+            return
+
+        entries = [
+            (filename, *json.loads(metadata))
+            for filename, metadata in zip(page[::2], page[1::2])
+        ]
+        for f in self.es.build_user_files(user, entries):
+            yield f
+
+    def _files_index_keys(self, username):
+        return [
+            'files-index:' + username,
+            'files-meta:' + username,
+            'files-uploading:' + username
+        ]
+
+    async def _index_user_files(self, user, start_after='', limit=None):
+        # see redis_storage.Storage._index_user_files, but for the entries
+        # of the page being yielded in lists, a list per chunk
+        index_key, meta_key, _ = self._files_index_keys(user.username)
+        lock_key = 'files-lock:' + user.username
+
+        lock_token = uuid4().hex
+        await self.conn.set(lock_key, lock_token, ex=FILES_INDEX_LOCK_TIMEOUT)
+        partial_index_key = index_key + ':' + lock_token
+        partial_meta_key = meta_key + ':' + lock_token
+
+        entries = self.es.list_user_file_keys(user)
+        num_indexed = num_listed = 0
+        last_entry = None
+        indexed = False
+        try:
+            while True:
+                chunk = []
+                async for entry in entries:
+                    chunk.append(entry)
+                    if len(chunk) == FILES_INDEX_CHUNK_SIZE:
+                        break
+                if not chunk:
+                    break
+
+                pipe = self.conn.pipeline(transaction=False)
+                pipe.zadd(partial_index_key, {filename: 0 for filename, _, _ in chunk})
+                pipe.hset(partial_meta_key, mapping={
+                    filename: json.dumps([size, checksum]) for filename, size, checksum in chunk
+                })
+                for key in (partial_index_key, partial_meta_key, lock_key):
+                    pipe.expire(key, FILES_INDEX_LOCK_TIMEOUT)
+                await pipe.execute()
+                num_indexed += len(chunk)
+
+                page_entries = []
+                for entry in chunk:
+                    if entry[0] <= start_after or (limit is not None and num_listed >= limit):
+                        continue
+                    num_listed += 1
+                    if num_listed == limit:
+                        last_entry = entry
+                    else:
+                        page_entries.append(entry)
+                if page_entries:
+                    yield page_entries
+
+            indexed = await self._replace_files_index(
+                user.username, lock_token, partial_index_key, partial_meta_key, num_indexed
+            )
+        finally:
+            await entries.aclose()
+            if not indexed:
+                await self.conn.delete(partial_index_key, partial_meta_key)
+
+        if last_entry is not None:
+            yield [last_entry]
+
+    async def _replace_files_index(self, username, lock_token, partial_index_key, partial_meta_key, num_indexed):
+        index_key, meta_key, _ = self._files_index_keys(username)
+        lock_key = 'files-lock:' + username
+
+        async with self.conn.pipeline() as pipe:
+            try:
+                await pipe.watch(lock_key)
+                if await pipe.get(lock_key) != lock_token:
+                    return False
+
+                pipe.multi()
+                if num_indexed:
+                    pipe.rename(partial_index_key, index_key)
+                    pipe.rename(partial_meta_key, meta_key)
+                else:
+                    pipe.delete(index_key, meta_key)
+                pipe.hset(meta_key, '', '')
+                pipe.expire(index_key, self.files_index_timeout)
+                pipe.expire(meta_key, self.files_index_timeout)
+                pipe.delete(lock_key)
+                await pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    async def _invalidate_files_index(self, username):
+        index_key, meta_key, _ = self._files_index_keys(username)
+        await self.conn.delete(index_key, meta_key, 'files-lock:' + username)
+
+    async def _mark_files_uploading(self, username):
+        index_key, meta_key, uploading_key = self._files_index_keys(username)
+
+        pipe = self.conn.pipeline()
+        pipe.setex(uploading_key, UPLOAD_URL_EXPIRE_AFTER, 1)
+        pipe.delete(index_key, meta_key, 'files-lock:' + username)
+        await pipe.execute()
+
+    async def remove_file_by_filename(self, user, filename):
+        result = await self.es.remove_file_by_filename(user, filename)
+        await self._invalidate_files_index(user.username)
+        return result
+
+    async def get_presigned_post_policy(self, user, filename):
+        if not config['events']['enabled']:
+            await self._mark_files_uploading(user.username)
+        return self.es.get_presigned_post_policy(user, filename)
+
+    async def apply_file_event(self, event):
+        index_key, meta_key, _ = self._files_index_keys(event['username'])
+
+        if event['action'] == 'created':
+            metadata = json.dumps([event['size'], event['checksum']])
+        else:
+            metadata = ''
+
+        await self.update_files_index(
+            keys=[index_key, meta_key, 'files-lock:' + event['username']],
+            args=[event['action'], event['filename'], metadata]
+        )
+
+    def get_presigned_retrieve_url(self, user, filename):
+        return self.es.get_presigned_retrieve_url(user, filename)
+
+    async def get_presigned_upload(self, user, filename):
+        if not config['events']['enabled']:
+            await self._mark_files_uploading(user.username)
+        return self.es.get_presigned_upload(user, filename)
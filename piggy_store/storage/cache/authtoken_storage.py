@@ -1,7 +1,12 @@
 import os
-import json
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import base64
+import hashlib
+import logging
+import tempfile
+import threading
+import time
 
 from cryptography import fernet
 from cryptography.hazmat.backends import default_backend
@@ -9,17 +14,180 @@ from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 import redis
 
+from piggy_store import json_backend
 from piggy_store.exceptions import (
     TokenInvalidError
 )
+from piggy_store.server_timing import timed
+from piggy_store.storage.cache.connection import get_async_connection, get_connection
+
+logger = logging.getLogger(__name__)
+
+# every worker drops its cached token checks for the usernames published here
+INVALIDATION_CHANNEL = 'token-invalidations'
+
+
+def derive_token_key(secret):
+    '''Derive the Fernet key from the secret (slow on purpose).'''
+
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        iterations=100000,
+        salt=b'not important in this use case',
+        backend=default_backend()
+    )
+    return base64.urlsafe_b64encode(kdf.derive(secret.encode('utf-8')))
+
+
+def _secret_fingerprint(secret):
+    return hashlib.sha256(b'piggy-store token key\0' + secret.encode('utf-8')).hexdigest()
+
+
+def load_token_key(options):
+    '''Return the Fernet key, avoiding to derive it when possible.
+
+    In order of preference the key is taken from the configuration, read
+    from a file, read from the cache directory (where it's stored the first
+    time it's derived, under the fingerprint of the secret) or derived.
+    '''
+
+    if options.get('key'):
+        return options['key'].encode('utf-8')
+
+    if options.get('key_file'):
+        with open(options['key_file'], 'rb') as fp:
+            return fp.read().strip()
+
+    if not options.get('key_cache_dir'):
+        return derive_token_key(options['secret'])
+
+    cache_path = os.path.join(
+        options['key_cache_dir'],
+        'token-key-' + _secret_fingerprint(options['secret'])
+    )
+
+    try:
+        with open(cache_path, 'rb') as fp:
+            return fp.read().strip()
+    except FileNotFoundError:
+        pass
+
+    key = derive_token_key(options['secret'])
+
+    # write and rename, so that a concurrent worker never reads half a key
+    fd, tmp_path = tempfile.mkstemp(dir=options['key_cache_dir'])
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(key)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    return key
+
+
+def _to_seconds(timeout):
+    if isinstance(timeout, timedelta):
+        return timeout.total_seconds()
+    return timeout
+
+
+class ExpiringLRUCache:
+    '''A thread-safe mapping that holds up to `size` entries, each one
+    expiring at the time given when it's set (monotonic clock).'''
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._set(key, value, expires_at)
+
+    def _set(self, key, value, expires_at):
+        # the lock is held
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TokenChecksCache(ExpiringLRUCache):
+    '''The token last found in redis for each username.
+
+    A check reads redis and then caches what it read: an invalidation in
+    between (e.g. a logout) must win, or the old token would be trusted
+    until it expires. Every invalidation is numbered, and what a check
+    read is cached only if its username wasn't invalidated after the
+    check started (see generation and set_unless_invalidated).
+    '''
+
+    def __init__(self, size):
+        super().__init__(size)
+        self._generation = 0
+        # username -> generation of its last invalidation, the most recent ones
+        self._invalidated = OrderedDict()
+        # the invalidations forgotten to keep the above small are no later
+        self._forgotten_generation = 0
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(key, None)
+            self._invalidated[key] = self._generation
+            self._invalidated.move_to_end(key)
+            while len(self._invalidated) > self.size:
+                _, self._forgotten_generation = self._invalidated.popitem(last=False)
+
+    def set_unless_invalidated(self, key, value, expires_at, generation):
+        '''Set the key, unless it was invalidated after generation.'''
+
+        if self.size <= 0:
+            return
+        with self._lock:
+            if self._invalidated.get(key, self._forgotten_generation) <= generation:
+                self._set(key, value, expires_at)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._forgotten_generation = self._generation
+            self._invalidated.clear()
+            self._entries.clear()
 
-kdf = PBKDF2HMAC(
-    algorithm=hashes.SHA256(),
-    length=32,
-    iterations=100000,
-    salt=b'not important in this use case',
-    backend=default_backend()
-)
 
 class AuthTokenStorage:
     __instance = None
@@ -29,39 +197,220 @@ class AuthTokenStorage:
         if not cls.__instance:
             cls.__instance = object.__new__(cls)
 
-            if options['host'].startswith('redis://'):
-                cls.__instance.conn = redis.from_url(
-                    options['host'],
-                    db=options['database'],
-                    decode_responses=True
-                )
-            else:
-                cls.__instance.conn = redis.Redis(
-                    host=options['host'],
-                    port=options['port'],
-                    db=options['database'],
-                    decode_responses=True
-                )
-
-            cls.__instance.timeout = options['timeout']
-            cls.__instance.key = base64.urlsafe_b64encode(kdf.derive(options['secret'].encode('utf-8')))
+            cls.__instance.conn = get_connection(options)
+            cls.__instance._init(options)
 
         return cls.__instance
 
+    def _init(self, options):
+        self.timeout = options['timeout']
+        self.options = options
+        self._key = None
+        self._fernet = None
+
+        # token -> decoded data bag
+        self.decoded_tokens = ExpiringLRUCache(options.get('cache_size', 0))
+        # username -> the token found in redis
+        self.check_cache_ttl = _to_seconds(options.get('check_cache_ttl') or 0)
+        self.user_tokens = TokenChecksCache(
+            options.get('cache_size', 0) if self.check_cache_ttl > 0 else 0
+        )
+        self._listener = None
+        self._listener_lock = threading.Lock()
+
+    @property
+    def key(self):
+        # loaded on first use, so it doesn't slow down the worker's boot
+        if self._key is None:
+            self._key = load_token_key(self.options)
+        return self._key
+
+    @property
+    def fernet(self):
+        if self._fernet is None:
+            self._fernet = fernet.Fernet(self.key)
+        return self._fernet
+
     def generate_token(self, dataBag):
-        return fernet.Fernet(self.key).encrypt(json.dumps(dataBag).encode('utf-8')).decode('utf-8')
+        data = json_backend.dumps(dataBag).encode('utf-8')
+        with timed('token'):
+            return self.fernet.encrypt(data).decode('utf-8')
 
     def decode_token(self, token):
+        # tokens are never decrypted with a ttl, so a token decodes to the
+        # same bag forever: caching it only saves time. The bag is copied
+        # because callers are free to modify it.
+        dataBag = self.decoded_tokens.get(token)
+        if dataBag is not None:
+            return dict(dataBag)
+
         try:
-            return json.loads(fernet.Fernet(self.key).decrypt(token.encode('utf-8')).decode('utf-8'))
+            with timed('token'):
+                data = self.fernet.decrypt(token.encode('utf-8'))
         except fernet.InvalidToken:
             raise TokenInvalidError()
+        dataBag = json_backend.loads(data)
+
+        self.decoded_tokens.set(token, dataBag, time.monotonic() + _to_seconds(self.timeout))
+        return dict(dataBag)
 
     def refresh_user_token(self, username, token):
-        return self.conn.setex(self.prefix + username, self.timeout, token)
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.setex(self.prefix + username, self.timeout, token)
+        pipe.publish(INVALIDATION_CHANNEL, username)
+        try:
+            return pipe.execute()[0]
+        finally:
+            # once redis changed: a check that read it before won't cache
+            # what it read, the ones that read it after read the change
+            self.user_tokens.invalidate(username)
 
     def remove_user_token(self, username):
-        return self.conn.delete(self.prefix + username)
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.delete(self.prefix + username)
+        pipe.publish(INVALIDATION_CHANNEL, username)
+        try:
+            return pipe.execute()[0]
+        finally:
+            self.user_tokens.invalidate(username)
 
     def has_user_token(self, username, token):
-        return self.conn.get(self.prefix + username) == token
+        if not self.user_tokens.size:
+            return self.conn.get(self.prefix + username) == token
+
+        now = time.monotonic()
+        cached_token = self.user_tokens.get(username, now=now)
+        if cached_token is not None:
+            return cached_token == token
+
+        # remember the answer only while somebody is listening for the
+        # invalidations, and never past the expiration of the token in redis
+        listening = self._ensure_listening()
+        generation = self.user_tokens.generation()
+
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.get(self.prefix + username)
+        pipe.pttl(self.prefix + username)
+        stored_token, pttl = pipe.execute()
+
+        if listening:
+            self._remember_user_token(username, stored_token, pttl, now, generation)
+
+        return stored_token == token
+
+    def _remember_user_token(self, username, stored_token, pttl, now, generation):
+        if stored_token is not None and pttl > 0:
+            ttl = min(self.check_cache_ttl, pttl / 1000)
+            self.user_tokens.set_unless_invalidated(username, stored_token, now + ttl, generation)
+
+    def _ensure_listening(self):
+        listener = self._listener
+        if listener is not None and listener.is_alive() and listener.pid == os.getpid():
+            return True
+
+        with self._listener_lock:
+            if self._listener is listener:
+                # a dead listener (or one inherited by a forked worker) may
+                # have missed some invalidations
+                self.user_tokens.clear()
+                try:
+                    self._listener = _InvalidationListener(self.conn, self.user_tokens)
+                except redis.RedisError:
+                    logger.warning('Cannot listen for token invalidations', exc_info=True)
+                    self._listener = None
+                    return False
+            return True
+
+
+class AsyncAuthTokenStorage:
+    '''The token store of the async app.
+
+    Tokens are generated, decoded and cached by the AuthTokenStorage of
+    the process, only the commands sent to redis are awaited.
+    '''
+
+    def __init__(self, tokens, conn):
+        self.tokens = tokens
+        self.conn = conn
+
+    @classmethod
+    def from_options(cls, options):
+        return cls(AuthTokenStorage(options), get_async_connection(options))
+
+    def generate_token(self, dataBag):
+        return self.tokens.generate_token(dataBag)
+
+    def decode_token(self, token):
+        return self.tokens.decode_token(token)
+
+    async def refresh_user_token(self, username, token):
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.setex(self.tokens.prefix + username, self.tokens.timeout, token)
+        pipe.publish(INVALIDATION_CHANNEL, username)
+        try:
+            return (await pipe.execute())[0]
+        finally:
+            self.tokens.user_tokens.invalidate(username)
+
+    async def remove_user_token(self, username):
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.delete(self.tokens.prefix + username)
+        pipe.publish(INVALIDATION_CHANNEL, username)
+        try:
+            return (await pipe.execute())[0]
+        finally:
+            self.tokens.user_tokens.invalidate(username)
+
+    async def has_user_token(self, username, token):
+        tokens = self.tokens
+        key = tokens.prefix + username
+
+        if not tokens.user_tokens.size:
+            return await self.conn.get(key) == token
+
+        now = time.monotonic()
+        cached_token = tokens.user_tokens.get(username, now=now)
+        if cached_token is not None:
+            return cached_token == token
+
+        # the listener is a thread, shared with the sync app: subscribing
+        # blocks, but only once per process
+        listening = tokens._ensure_listening()
+        generation = tokens.user_tokens.generation()
+
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.pttl(key)
+        stored_token, pttl = await pipe.execute()
+
+        if listening:
+            tokens._remember_user_token(username, stored_token, pttl, now, generation)
+
+        return stored_token == token
+
+
+class _InvalidationListener(threading.Thread):
+    def __init__(self, conn, user_tokens):
+        super().__init__(name='token-invalidations', daemon=True)
+        self.pid = os.getpid()
+        self.user_tokens = user_tokens
+        self.pubsub = conn.pubsub(ignore_subscribe_messages=True)
+        # subscribe before returning, so that no invalidation is missed
+        # once the caller starts caching
+        self.pubsub.subscribe(INVALIDATION_CHANNEL)
+        self.start()
+
+    def run(self):
+        try:
+            while True:
+                # a short wait, so that the connection's socket_timeout
+                # never expires while nothing is published
+                message = self.pubsub.get_message(timeout=1)
+                if message and message['type'] == 'message':
+                    self.user_tokens.invalidate(message['data'])
+        except redis.RedisError:
+            logger.warning('Stopped listening for token invalidations', exc_info=True)
+        finally:
+            # nothing may be cached without a listener
+            self.user_tokens.clear()
+            self.pubsub.close()
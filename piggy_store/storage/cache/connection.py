@@ -0,0 +1,174 @@
+import asyncio
+from functools import lru_cache
+import threading
+import weakref
+
+import redis
+import redis.client
+
+from piggy_store.server_timing import timed
+
+# One connection pool per redis database, shared by the user cache, the
+# token store and the etag cache of the process. The pools themselves
+# notice when the process forks and drop the parent's connections.
+_pools = {}
+_pools_lock = threading.Lock()
+
+# The same for the async app, but per event loop: an asyncio connection
+# can't be used by another loop than the one that opened it.
+_async_pools = weakref.WeakKeyDictionary()
+
+
+class TimedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        with timed('redis'):
+            return super().execute(raise_on_error)
+
+    def immediate_execute_command(self, *args, **options):
+        with timed('redis'):
+            return super().immediate_execute_command(*args, **options)
+
+
+class TimedRedis(redis.Redis):
+    '''A client whose round trips are timed (see piggy_store.server_timing).'''
+
+    def execute_command(self, *args, **options):
+        with timed('redis'):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return TimedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+@lru_cache(maxsize=None)
+def _async_client_class():
+    # redis.asyncio is imported only by the async app
+    import redis.asyncio
+
+    class AsyncTimedPipeline(redis.asyncio.client.Pipeline):
+        async def execute(self, raise_on_error=True):
+            with timed('redis'):
+                return await super().execute(raise_on_error)
+
+        async def immediate_execute_command(self, *args, **options):
+            with timed('redis'):
+                return await super().immediate_execute_command(*args, **options)
+
+    class AsyncTimedRedis(redis.asyncio.Redis):
+        async def execute_command(self, *args, **options):
+            with timed('redis'):
+                return await super().execute_command(*args, **options)
+
+        def pipeline(self, transaction=True, shard_hint=None):
+            return AsyncTimedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+    return AsyncTimedRedis
+
+
+def _registry_key(options):
+    if options.get('unix_socket_path'):
+        address = options['unix_socket_path']
+    elif options['host'].startswith('redis://'):
+        address = options['host']
+    else:
+        address = '{}:{}'.format(options['host'], options['port'])
+
+    return (address, options['database'])
+
+
+def _build_connection_pool(options, redis_module=redis):
+    kwargs = {
+        'db': options['database'],
+        'max_connections': options['max_connections'],
+        # how long to wait for a free connection when all are in use
+        'timeout': options['pool_timeout'],
+        'socket_timeout': options['socket_timeout'],
+        'health_check_interval': options['health_check_interval'],
+        'decode_responses': True
+    }
+
+    if options.get('unix_socket_path'):
+        return redis_module.BlockingConnectionPool(
+            connection_class=redis_module.UnixDomainSocketConnection,
+            path=options['unix_socket_path'],
+            **kwargs
+        )
+
+    kwargs['socket_connect_timeout'] = options['socket_connect_timeout']
+    kwargs['socket_keepalive'] = options['socket_keepalive']
+
+    if options['host'].startswith('redis://'):
+        return redis_module.BlockingConnectionPool.from_url(options['host'], **kwargs)
+
+    return redis_module.BlockingConnectionPool(host=options['host'], port=options['port'], **kwargs)
+
+
+def get_connection_pool(options):
+    key = _registry_key(options)
+
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = _build_connection_pool(options)
+
+    return pool
+
+
+def get_connection(options):
+    return TimedRedis(connection_pool=get_connection_pool(options))
+
+
+def get_async_connection(options):
+    '''Return a redis.asyncio client for the running event loop.'''
+
+    import redis.asyncio
+
+    pools = _async_pools.setdefault(asyncio.get_running_loop(), {})
+    key = _registry_key(options)
+
+    pool = pools.get(key)
+    if pool is None:
+        pool = pools[key] = _build_connection_pool(options, redis.asyncio)
+
+    return _async_client_class()(connection_pool=pool)
+
+
+async def close_async_connections():
+    pools = _async_pools.pop(asyncio.get_running_loop(), {})
+    for pool in pools.values():
+        await pool.disconnect()
+
+
+def _get_pool_stats(pools):
+    stats = []
+    for (address, database), pool in list(pools.items()):
+        # a sync pool holds a queue.LifoQueue, an async one an asyncio.LifoQueue
+        queued = getattr(pool.pool, 'queue', None)
+        if queued is None:
+            queued = pool.pool._queue
+
+        created = len(pool._connections)
+        idle = sum(1 for connection in list(queued) if connection is not None)
+        stats.append({
+            'address': address,
+            'database': database,
+            'max_connections': pool.max_connections,
+            'created_connections': created,
+            'in_use_connections': created - idle,
+            'idle_connections': idle
+        })
+    return stats
+
+
+def get_pool_stats():
+    '''Return how the connections of every pool are being used.'''
+
+    return _get_pool_stats(_pools)
+
+
+def get_async_pool_stats():
+    '''Return how the connections of the running loop's pools are being used.'''
+
+    return _get_pool_stats(_async_pools.get(asyncio.get_running_loop(), {}))
@@ -0,0 +1,70 @@
+from piggy_store.storage.cache.connection import get_async_connection, get_connection
+
+
+class ETagStorage:
+    '''Remember the ETags that the file storage could not list.
+
+    Some S3 compatible servers (e.g. minio without erasure code) list
+    objects without their ETag. Entries are keyed by object name and last
+    modified time, so an overwritten object is never given a stale ETag.
+    '''
+
+    __instance = None
+    prefix = 'etag-'
+    timeout = 7 * 24 * 3600
+
+    def __new__(cls, options, **kwargs):
+        if not cls.__instance:
+            cls.__instance = object.__new__(cls)
+
+            cls.__instance.conn = get_connection(options)
+
+        return cls.__instance
+
+    def _key(self, object_name, last_modified):
+        return '{}{}@{}'.format(self.prefix, object_name, last_modified.timestamp())
+
+    def get_many(self, objects):
+        '''Return the cached ETags as a dict {object_name: etag}'''
+
+        objects = [o for o in objects if o.last_modified]
+        if not objects:
+            return {}
+
+        etags = self.conn.mget([self._key(o.object_name, o.last_modified) for o in objects])
+        return {o.object_name: etag for o, etag in zip(objects, etags) if etag}
+
+    def set_many(self, objects):
+        pipe = self.conn.pipeline(transaction=False)
+        for o in objects:
+            if o.last_modified and o.etag:
+                pipe.setex(self._key(o.object_name, o.last_modified), self.timeout, o.etag)
+        pipe.execute()
+
+
+class AsyncETagStorage(ETagStorage):
+    '''The same cache for the async app, that owns the connection.'''
+
+    def __new__(cls, conn):
+        instance = object.__new__(cls)
+        instance.conn = conn
+        return instance
+
+    @classmethod
+    def from_options(cls, options):
+        return cls(get_async_connection(options))
+
+    async def get_many(self, objects):
+        objects = [o for o in objects if o.last_modified]
+        if not objects:
+            return {}
+
+        etags = await self.conn.mget([self._key(o.object_name, o.last_modified) for o in objects])
+        return {o.object_name: etag for o, etag in zip(objects, etags) if etag}
+
+    async def set_many(self, objects):
+        pipe = self.conn.pipeline(transaction=False)
+        for o in objects:
+            if o.last_modified and o.etag:
+                pipe.setex(self._key(o.object_name, o.last_modified), self.timeout, o.etag)
+        await pipe.execute()
@@ -0,0 +1,100 @@
+from hashlib import sha256
+from hmac import compare_digest
+import time
+from uuid import uuid4
+
+from piggy_store.storage.cache.connection import get_async_connection, get_connection
+
+
+class JobStorage:
+    '''The state of the jobs run in background (see piggy_store.jobs).
+
+    It's kept in redis, so that any worker can tell how a job started by
+    another one is going. A job is forgotten a day after its last update.
+
+    Every update records a heartbeat: a job still running without one for
+    stale_after seconds died with its worker (e.g. killed by harakiri or
+    max-requests), and is reported failed.
+
+    A job is only shown to the token that started it.
+    '''
+
+    __instance = None
+    prefix = 'job-'
+    timeout = 24 * 3600
+    stale_after = 60
+
+    def __new__(cls, options, **kwargs):
+        if not cls.__instance:
+            cls.__instance = object.__new__(cls)
+
+            cls.__instance.conn = get_connection(options)
+
+        return cls.__instance
+
+    def create(self, kind, token):
+        job_id = uuid4().hex
+        self.update(job_id, **self._new_job(kind, token))
+        return job_id
+
+    def update(self, job_id, **fields):
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.hset(self.prefix + job_id, mapping={**fields, 'heartbeat': time.time()})
+        pipe.expire(self.prefix + job_id, self.timeout)
+        pipe.execute()
+
+    def get(self, job_id, token):
+        '''The state of the job, None if it's unknown or not the token's.'''
+
+        return self._parse(self.conn.hgetall(self.prefix + job_id), token)
+
+    def _new_job(self, kind, token):
+        # only a digest: the token outlives the job in the user's hands
+        return dict(kind=kind, state='running', progress=0, error='', owner=self._digest(token))
+
+    def _digest(self, token):
+        return sha256(token.encode('utf-8')).hexdigest()
+
+    def _parse(self, data, token):
+        if not data or not compare_digest(data.get('owner', ''), self._digest(token)):
+            return None
+
+        state = data['state']
+        error = data['error'] or None
+        if state == 'running' and time.time() - float(data.get('heartbeat', 0)) > self.stale_after:
+            state = 'failed'
+            error = 'The job stopped unexpectedly'
+
+        return {
+            'kind': data['kind'],
+            'state': state,
+            'progress': int(data['progress']),
+            'error': error
+        }
+
+
+class AsyncJobStorage(JobStorage):
+    '''The same states for the async app, that owns the connection.'''
+
+    def __new__(cls, conn):
+        instance = object.__new__(cls)
+        instance.conn = conn
+        return instance
+
+    @classmethod
+    def from_options(cls, options):
+        return cls(get_async_connection(options))
+
+    async def create(self, kind, token):
+        job_id = uuid4().hex
+        await self.update(job_id, **self._new_job(kind, token))
+        return job_id
+
+    async def update(self, job_id, **fields):
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.hset(self.prefix + job_id, mapping={**fields, 'heartbeat': time.time()})
+        pipe.expire(self.prefix + job_id, self.timeout)
+        await pipe.execute()
+
+    async def get(self, job_id, token):
+        return self._parse(await self.conn.hgetall(self.prefix + job_id), token)
@@ -0,0 +1,294 @@
+'''A cache kept in the memory of the process, instead of redis.
+
+Nothing is shared with the other processes, nor survives a restart: it's
+meant for the tests, the benchmarks and the deployments of a single
+worker. It stores what redis_storage does, with the same keys and
+expirations, and with the files of the users always listed from the
+bucket.
+'''
+
+import threading
+import time
+from datetime import timedelta
+from uuid import uuid4
+
+from piggy_store.storage.user_entity import User
+from piggy_store.exceptions import (
+    UserExistsError,
+    UserDoesNotExistError,
+    FileExistsError
+)
+from piggy_store.config import config
+from piggy_store.storage import EasyStorage, EasyStorageABC
+from piggy_store.storage.cache import authtoken_storage, etag_storage, job_storage
+from piggy_store.storage.cache.redis_storage import WARM_UP_LOCK_KEY, WARM_UP_LOCK_TIMEOUT
+from piggy_store.storage.cache.single_flight import SingleFlight
+
+# the filter would be no older than the cache it saves reads to
+UsersFilter = None
+
+# entries held before the expired ones are looked for
+MIN_SWEEP_SIZE = 1024
+
+
+class MemoryStore:
+    '''A thread-safe mapping whose entries may expire, as redis keys do.'''
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._sweep_at = MIN_SWEEP_SIZE
+
+    def _get(self, key, now):
+        # the lock is held
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= now:
+            del self._entries[key]
+            return None
+
+        return value
+
+    def _set(self, key, value, ttl, now):
+        if isinstance(ttl, timedelta):
+            ttl = ttl.total_seconds()
+        self._entries[key] = (now + ttl if ttl is not None else None, value)
+
+        # the expired entries that nobody reads go from time to time
+        if len(self._entries) >= self._sweep_at:
+            expired = [
+                k for k, (expires_at, _) in self._entries.items()
+                if expires_at is not None and expires_at <= now
+            ]
+            for k in expired:
+                del self._entries[k]
+            self._sweep_at = max(MIN_SWEEP_SIZE, 2 * len(self._entries))
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key, time.monotonic())
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            return [self._get(key, now) for key in keys]
+
+    def set(self, key, value, ttl=None, nx=False):
+        '''Set the value of key, for ttl seconds (forever if None).
+
+        With nx, an existing key is left alone. Return whether the value
+        was set.
+        '''
+
+        now = time.monotonic()
+        with self._lock:
+            if nx and self._get(key, now) is not None:
+                return False
+            self._set(key, value, ttl, now)
+            return True
+
+    def update(self, key, fields, ttl=None):
+        '''Merge fields into the dict at key, setting its ttl anew.'''
+
+        now = time.monotonic()
+        with self._lock:
+            self._set(key, {**(self._get(key, now) or {}), **fields}, ttl, now)
+
+    def delete(self, *keys):
+        '''Return how many of the keys existed.'''
+
+        now = time.monotonic()
+        with self._lock:
+            existing = [key for key in keys if self._get(key, now) is not None]
+            for key in existing:
+                del self._entries[key]
+            return len(existing)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# what redis is to redis_storage: one per process, shared by every storage
+store = MemoryStore()
+
+
+def cache_user(user, replace=False):
+    '''Cache the user, unless it's cached already (or replace is set).
+    Return whether it was cached.'''
+    return store.set(user.username, (user.challenge, user.answer), nx=not replace)
+
+
+def uncache_user(username):
+    store.delete(username)
+
+
+def read_cached_user(username):
+    '''Return (the cached user or None, whether the user is known not to exist).'''
+
+    data, unknown = store.get_many([username, 'nouser:' + username])
+    return (User(username, *data) if data else None), unknown is not None
+
+
+def remember_unknown_user(username):
+    # not for long: it may be a user that is being created
+    ttl = config['unknown_users_cache_ttl'].total_seconds()
+    if ttl > 0:
+        store.set('nouser:' + username, 1, ttl)
+
+
+def forget_unknown_user(username):
+    store.delete('nouser:' + username)
+
+
+class Storage(EasyStorageABC):
+    __instance = None
+
+    def __new__(cls, options, **kwargs):
+        if not cls.__instance:
+            cls.__instance = object.__new__(cls)
+
+            cls.user_lookups = SingleFlight()
+
+        return cls.__instance
+
+    def __init__(self, *args, **kwargs):
+        self.es = EasyStorage()
+
+    def add_user(self, user):
+        if not cache_user(user):
+            raise UserExistsError()
+        forget_unknown_user(user.username)
+
+        try:
+            return self.es.add_user(user)
+        except FileExistsError:
+            # see redis_storage.Storage.add_user
+            cache_user(self.es.find_user_by_username(user.username), replace=True)
+            raise UserExistsError()
+
+    def cache_users(self, users):
+        '''Cache many users, keeping the ones already cached. Return how
+        many were added.'''
+        return sum(cache_user(user) for user in users)
+
+    def claim_warm_up(self):
+        '''Return True unless the cache was warmed up recently.'''
+        return store.set(WARM_UP_LOCK_KEY, uuid4().hex, WARM_UP_LOCK_TIMEOUT, nx=True)
+
+    def remove_user(self, user, progress=None):
+        uncache_user(user.username)
+        self.es.remove_user(user, progress)
+        # a lookup may have cached the user again while its files were removed
+        uncache_user(user.username)
+
+    def count_user_files(self, user, up_to):
+        return self.es.count_user_files(user, up_to)
+
+    def find_user_by_username(self, username):
+        user, unknown = read_cached_user(username)
+
+        if user is None and not unknown:
+            # only one thread asks the bucket, the others wait for its answer
+            user = self.user_lookups.do(username, lambda: self._find_uncached_user(username))
+
+        if user is None:
+            raise UserDoesNotExistError()
+
+        return user
+
+    def _find_uncached_user(self, username):
+        user = self.es.find_user_by_username(username)
+        if user:
+            cache_user(user)
+        else:
+            remember_unknown_user(username)
+
+        return user
+
+    def get_user_files(self, user, start_after='', limit=None):
+        return self.es.get_user_files(user, start_after, limit)
+
+    def remove_file_by_filename(self, user, filename):
+        return self.es.remove_file_by_filename(user, filename)
+
+    def get_presigned_post_policy(self, user, filename):
+        return self.es.get_presigned_post_policy(user, filename)
+
+    def apply_file_event(self, event):
+        # the files aren't cached
+        pass
+
+    def get_presigned_retrieve_url(self, user, filename):
+        return self.es.get_presigned_retrieve_url(user, filename)
+
+    def get_presigned_upload(self, user, filename):
+        return self.es.get_presigned_upload(user, filename)
+
+
+class AuthTokenStorage(authtoken_storage.AuthTokenStorage):
+    '''The tokens of the users, in the store of the process.
+
+    They are generated and decoded as the ones kept in redis; checking one
+    never needs a cache of its own.
+    '''
+
+    __instance = None
+
+    def __new__(cls, options, **kwargs):
+        if not cls.__instance:
+            cls.__instance = object.__new__(cls)
+            cls.__instance._init(options)
+
+        return cls.__instance
+
+    def refresh_user_token(self, username, token):
+        return store.set(self.prefix + username, token, self.timeout)
+
+    def remove_user_token(self, username):
+        return store.delete(self.prefix + username)
+
+    def has_user_token(self, username, token):
+        return store.get(self.prefix + username) == token
+
+
+class ETagStorage(etag_storage.ETagStorage):
+    __instance = None
+
+    def __new__(cls, options, **kwargs):
+        if not cls.__instance:
+            cls.__instance = object.__new__(cls)
+
+        return cls.__instance
+
+    def get_many(self, objects):
+        objects = [o for o in objects if o.last_modified]
+        etags = store.get_many([self._key(o.object_name, o.last_modified) for o in objects])
+        return {o.object_name: etag for o, etag in zip(objects, etags) if etag}
+
+    def set_many(self, objects):
+        for o in objects:
+            if o.last_modified and o.etag:
+                store.set(self._key(o.object_name, o.last_modified), o.etag, self.timeout)
+
+
+class JobStorage(job_storage.JobStorage):
+    __instance = None
+
+    def __new__(cls, options, **kwargs):
+        if not cls.__instance:
+            cls.__instance = object.__new__(cls)
+
+        return cls.__instance
+
+    def update(self, job_id, **fields):
+        store.update(self.prefix + job_id, {**fields, 'heartbeat': time.time()}, self.timeout)
+
+    def get(self, job_id, token):
+        return self._parse(store.get(self.prefix + job_id), token)
@@ -4,31 +4,130 @@ from piggy_store.exceptions import (
     UserDoesNotExistError,
     FileExistsError
 )
+from piggy_store.config import config
 from piggy_store.storage import EasyStorage, EasyStorageABC
+from piggy_store.storage.cache import get_users_filter
+from piggy_store.storage.cache.authtoken_storage import AuthTokenStorage
+from piggy_store.storage.cache.connection import get_connection
+from piggy_store.storage.cache.etag_storage import ETagStorage
+from piggy_store.storage.cache.job_storage import JobStorage
+from piggy_store.storage.cache.users_filter import UsersFilter
+from piggy_store.storage.cache.single_flight import SingleFlight
+from piggy_store.storage.files import UPLOAD_URL_EXPIRE_AFTER
 
+from itertools import islice
+import json
+import time
+from uuid import uuid4
 import redis
 
+# Cache a user, unless it's cached already. Both fields are set at once, so
+# nobody can read a user without its answer.
+# Return 1 if the user has been added, 0 otherwise
+ADD_USER_SCRIPT = '''
+if redis.call('HSETNX', KEYS[1], 'challenge', ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'answer', ARGV[2])
+return 1
+'''
+
+# Read a page of the index of a user's files, in a single round trip.
+# Return -1 if an upload may be in progress, nil if there is no index,
+# a flat list of filename, metadata, filename, metadata... otherwise
+READ_FILES_INDEX_SCRIPT = '''
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    return -1
+end
+if redis.call('HEXISTS', KEYS[2], '') == 0 then
+    return nil
+end
+local names = redis.call('ZRANGEBYLEX', KEYS[1], ARGV[1], '+', 'LIMIT', 0, ARGV[2])
+if #names == 0 then
+    return {}
+end
+local metadata = redis.call('HMGET', KEYS[2], (unpack or table.unpack)(names))
+local page = {}
+for i, name in ipairs(names) do
+    page[#page + 1] = name
+    page[#page + 1] = metadata[i]
+end
+return page
+'''
+
+# Apply a change notified by the bucket to the index of a user's files.
+# A missing index is left alone, it will be rebuilt from the bucket.
+# A rebuild in progress is cancelled, it may not contain the change.
+APPLY_FILE_EVENT_SCRIPT = '''
+redis.call('DEL', KEYS[3])
+if redis.call('HEXISTS', KEYS[2], '') == 0 then
+    return 0
+end
+if ARGV[1] == 'created' then
+    redis.call('ZADD', KEYS[1], 0, ARGV[2])
+    redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+else
+    redis.call('ZREM', KEYS[1], ARGV[2])
+    redis.call('HDEL', KEYS[2], ARGV[2])
+end
+return 1
+'''
+
+# Members added to the index per command
+FILES_INDEX_CHUNK_SIZE = 1000
+# Held while the index is rebuilt, extended after every chunk
+FILES_INDEX_LOCK_TIMEOUT = 60
+
+# Delete a lock, if it's still the one we took
+RELEASE_LOCK_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+'''
+
+# Held by the worker that reads an uncached user from the bucket, while
+# the others wait for the user to appear in the cache
+USER_LOOKUP_LOCK_TIMEOUT = 5
+USER_LOOKUP_POLL_INTERVAL = 0.05
+
+# Held by the worker that warms up the cache, and kept afterwards: the
+# workers that start in the meantime don't warm it up again
+WARM_UP_LOCK_KEY = 'cache-warm-up:lock'
+WARM_UP_LOCK_TIMEOUT = 600
+
 
 class Storage(EasyStorageABC):
     __instance = None
 
+    # Besides the users, we cache the files of every user. Keys contain
+    # a ':', that a username can't contain, so they never clash with the
+    # users' keys.
+    #   files-index:<username>     sorted set of the filenames
+    #   files-meta:<username>      hash filename => [size, checksum]; the
+    #                              '' field tells that the index is complete
+    #   files-lock:<username>      the index is being rebuilt
+    #   files-index:<username>:<lock>, files-meta:<username>:<lock>
+    #                              the index being rebuilt, until complete
+    #   files-uploading:<username> an upload url was given recently, so the
+    #                              content of the bucket may change anytime
+    #   user-lookup:<username>     a worker is reading the user from the bucket
+    #   nouser:<username>          the user was not found in the bucket
+    #   cache-warm-up:lock         a worker warms up, or warmed up, the cache
+    files_index_timeout = 24 * 3600
+
     def __new__(cls, options, **kwargs):
         if not cls.__instance:
             cls.__instance = object.__new__(cls)
 
-            if options['host'].startswith('redis://'):
-                cls.conn = redis.from_url(
-                    options['host'],
-                    db=options['database'],
-                    decode_responses=True
-                )
-            else:
-                cls.conn = redis.Redis(
-                    host=options['host'],
-                    port=options['port'],
-                    db=options['database'],
-                    decode_responses=True
-                )
+            cls.conn = get_connection(options)
+
+            cls.add_user_to_cache = cls.conn.register_script(ADD_USER_SCRIPT)
+            cls.read_files_index = cls.conn.register_script(READ_FILES_INDEX_SCRIPT)
+            cls.update_files_index = cls.conn.register_script(APPLY_FILE_EVENT_SCRIPT)
+            cls.release_lock = cls.conn.register_script(RELEASE_LOCK_SCRIPT)
+
+            cls.user_lookups = SingleFlight()
 
         return cls.__instance
 
@@ -37,6 +136,7 @@ class Storage(EasyStorageABC):
 
     def add_user(self, user):
         self._add_user_to_cache(user)
+        self._forget_unknown_user(user.username)
 
         try:
             return self.es.add_user(user)
@@ -55,51 +155,271 @@ class Storage(EasyStorageABC):
     def _add_user_to_cache(self, user):
         """add the user to the cache atomically"""
 
-        fields_created = self.conn.hsetnx(user.username, 'challenge', user.challenge)
-        if fields_created == 0:
+        added = self.add_user_to_cache(keys=[user.username], args=[user.challenge, user.answer])
+        if added == 0:
             raise UserExistsError()
 
-        self.conn.hset(user.username, 'answer', user.answer)
-
     def _update_user_cache(self, user):
-        self.conn.hmset(user.username, {
+        self.conn.hset(user.username, mapping={
             'challenge': user.challenge,
             'answer': user.answer
         })
 
-    def remove_user(self, user):
+    def cache_users(self, users):
+        '''Cache many users in a single round trip, keeping the ones
+        already cached. Return how many were added.'''
+
+        pipe = self.conn.pipeline(transaction=False)
+        for user in users:
+            self.add_user_to_cache(keys=[user.username], args=[user.challenge, user.answer], client=pipe)
+        return sum(pipe.execute())
+
+    def claim_warm_up(self):
+        '''Return True unless the cache was warmed up recently.'''
+        return bool(self.conn.set(WARM_UP_LOCK_KEY, uuid4().hex, nx=True, ex=WARM_UP_LOCK_TIMEOUT))
+
+    def remove_user(self, user, progress=None):
         # XXX it's safe to call conn.delete() even if the key is missing
         self.conn.delete(user.username)
-        self.es.remove_user(user)
+        self.es.remove_user(user, progress)
+        # a lookup may have cached the user again while its files were removed
+        self.conn.delete(user.username)
+        self._invalidate_files_index(user.username)
 
-    def find_user_by_username(self, username):
-        user = None
+    def count_user_files(self, user, up_to):
+        return self.es.count_user_files(user, up_to)
 
-        # Do we have the user data already cached?
-        data = self.conn.hgetall(username)
+    def find_user_by_username(self, username):
+        # Do we have the user data already cached? Or do we know already
+        # that there's no such user?
+        user, unknown = self._read_cached_user(username)
 
-        if data:
-            user = User(username, data['challenge'], data['answer'])
-        else:
-            # Do we have the user data at all?
-            user = self.es.find_user_by_username(username)
-            if user:
-                # found, let's cache it
-                self._add_user_to_cache(user)
+        if user is None and not unknown:
+            # Do we have the user data at all? Only one thread per process
+            # asks, the others wait for its answer
+            user = self.user_lookups.do(username, lambda: self._find_uncached_user(username))
 
         if user is None:
             raise UserDoesNotExistError()
 
         return user
 
-    def get_user_files(self, user):
-        return self.es.get_user_files(user)
+    def _read_cached_user(self, username):
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.hgetall(username)
+        pipe.exists('nouser:' + username)
+        data, unknown = pipe.execute()
+
+        return (User(username, data['challenge'], data['answer']) if data else None), bool(unknown)
+
+    def _find_uncached_user(self, username):
+        users_filter = get_users_filter()
+        if users_filter and not users_filter.might_exist(username):
+            return None
+
+        # and only one worker reads the bucket, the others wait for the user
+        # to be cached (or for the lock to go, if the user doesn't exist)
+        lock_key = 'user-lookup:' + username
+        lock_token = uuid4().hex
+        deadline = time.monotonic() + USER_LOOKUP_LOCK_TIMEOUT
+
+        while not self.conn.set(lock_key, lock_token, nx=True, ex=USER_LOOKUP_LOCK_TIMEOUT):
+            time.sleep(USER_LOOKUP_POLL_INTERVAL)
+
+            user, unknown = self._read_cached_user(username)
+            if user or unknown:
+                return user
+
+            if time.monotonic() > deadline:
+                # the other worker is too slow, don't wait any longer
+                lock_token = None
+                break
+
+        try:
+            user = self.es.find_user_by_username(username)
+            if user:
+                # found, let's cache it (unless somebody else just did)
+                self.add_user_to_cache(keys=[user.username], args=[user.challenge, user.answer])
+            else:
+                self._remember_unknown_user(username)
+        finally:
+            if lock_token:
+                self.release_lock(keys=[lock_key], args=[lock_token])
+
+        return user
+
+    def _remember_unknown_user(self, username):
+        # not for long: it may be a user that is being created
+        ttl = int(config['unknown_users_cache_ttl'].total_seconds())
+        if ttl > 0:
+            self.conn.setex('nouser:' + username, ttl, 1)
+
+    def _forget_unknown_user(self, username):
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.delete('nouser:' + username)
+        users_filter = get_users_filter()
+        if users_filter:
+            users_filter.add(username, pipe)
+        pipe.execute()
+
+    def get_user_files(self, user, start_after='', limit=None):
+        page = self.read_files_index(
+            keys=self._files_index_keys(user.username),
+            args=['(' + start_after if start_after else '-', limit if limit is not None else -1]
+        )
+
+        if page == -1:
+            # an upload may complete anytime, the bucket is the only truth
+            return self.es.get_user_files(user, start_after, limit)
+
+        if page is None:
+            entries = self._index_user_files(user, start_after, limit)
+        else:
+            entries = [
+                (filename, *json.loads(metadata))
+                for filename, metadata in zip(page[::2], page[1::2])
+            ]
+
+        return self.es.build_user_files(user, entries)
+
+    def _files_index_keys(self, username):
+        return [
+            'files-index:' + username,
+            'files-meta:' + username,
+            'files-uploading:' + username
+        ]
+
+    def _index_user_files(self, user, start_after='', limit=None):
+        '''Yield (filename, size, checksum) for the files of the user after
+        start_after, up to limit, while indexing all of them.
+
+        The listing goes from the bucket to redis a chunk at a time, into
+        keys of its own that replace the index once complete: neither the
+        memory nor the redis commands grow with the number of files. The
+        page is yielded as it's listed, but for its last entry, held until
+        the index is complete: the caller won't ask for anything after it.
+        '''
+
+        index_key, meta_key, _ = self._files_index_keys(user.username)
+        lock_key = 'files-lock:' + user.username
+
+        # If the index is invalidated while we read the bucket (e.g. a file
+        # is deleted) the lock is deleted too, and we won't store what
+        # would already be a stale listing
+        lock_token = uuid4().hex
+        self.conn.set(lock_key, lock_token, ex=FILES_INDEX_LOCK_TIMEOUT)
+        # a ':' is in no username, nor in the keys of the other rebuilds
+        partial_index_key = index_key + ':' + lock_token
+        partial_meta_key = meta_key + ':' + lock_token
+
+        entries = self.es.list_user_file_keys(user)
+        num_indexed = num_listed = 0
+        last_entry = None
+        indexed = False
+        try:
+            while True:
+                chunk = list(islice(entries, FILES_INDEX_CHUNK_SIZE))
+                if not chunk:
+                    break
+
+                pipe = self.conn.pipeline(transaction=False)
+                pipe.zadd(partial_index_key, {filename: 0 for filename, _, _ in chunk})
+                pipe.hset(partial_meta_key, mapping={
+                    filename: json.dumps([size, checksum]) for filename, size, checksum in chunk
+                })
+                for key in (partial_index_key, partial_meta_key, lock_key):
+                    pipe.expire(key, FILES_INDEX_LOCK_TIMEOUT)
+                pipe.execute()
+                num_indexed += len(chunk)
+
+                for entry in chunk:
+                    if entry[0] <= start_after or (limit is not None and num_listed >= limit):
+                        continue
+                    num_listed += 1
+                    if num_listed == limit:
+                        last_entry = entry
+                    else:
+                        yield entry
+
+            indexed = self._replace_files_index(
+                user.username, lock_token, partial_index_key, partial_meta_key, num_indexed
+            )
+        finally:
+            if not indexed:
+                self.conn.delete(partial_index_key, partial_meta_key)
+
+        if last_entry is not None:
+            yield last_entry
+
+    def _replace_files_index(self, username, lock_token, partial_index_key, partial_meta_key, num_indexed):
+        '''Make the complete index the one read, unless it was invalidated
+        meanwhile. Return whether it was.'''
+
+        index_key, meta_key, _ = self._files_index_keys(username)
+        lock_key = 'files-lock:' + username
+
+        with self.conn.pipeline() as pipe:
+            try:
+                pipe.watch(lock_key)
+                if pipe.get(lock_key) != lock_token:
+                    return False
+
+                pipe.multi()
+                if num_indexed:
+                    pipe.rename(partial_index_key, index_key)
+                    pipe.rename(partial_meta_key, meta_key)
+                else:
+                    pipe.delete(index_key, meta_key)
+                pipe.hset(meta_key, '', '')
+                pipe.expire(index_key, self.files_index_timeout)
+                pipe.expire(meta_key, self.files_index_timeout)
+                pipe.delete(lock_key)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def _invalidate_files_index(self, username):
+        index_key, meta_key, _ = self._files_index_keys(username)
+        self.conn.delete(index_key, meta_key, 'files-lock:' + username)
+
+    def _mark_files_uploading(self, username):
+        index_key, meta_key, uploading_key = self._files_index_keys(username)
+
+        pipe = self.conn.pipeline()
+        pipe.setex(uploading_key, UPLOAD_URL_EXPIRE_AFTER, 1)
+        pipe.delete(index_key, meta_key, 'files-lock:' + username)
+        pipe.execute()
 
     def remove_file_by_filename(self, user, filename):
-        return self.es.remove_file_by_filename(user, filename)
+        result = self.es.remove_file_by_filename(user, filename)
+        self._invalidate_files_index(user.username)
+        return result
 
     def get_presigned_post_policy(self, user, filename):
+        if not config['events']['enabled']:
+            # we won't know when the upload completes
+            self._mark_files_uploading(user.username)
         return self.es.get_presigned_post_policy(user, filename)
 
+    def apply_file_event(self, event):
+        index_key, meta_key, _ = self._files_index_keys(event['username'])
+
+        if event['action'] == 'created':
+            metadata = json.dumps([event['size'], event['checksum']])
+        else:
+            metadata = ''
+
+        self.update_files_index(
+            keys=[index_key, meta_key, 'files-lock:' + event['username']],
+            args=[event['action'], event['filename'], metadata]
+        )
+
     def get_presigned_retrieve_url(self, user, filename):
         return self.es.get_presigned_retrieve_url(user, filename)
+
+    def get_presigned_upload(self, user, filename):
+        if not config['events']['enabled']:
+            # we won't know when the upload completes
+            self._mark_files_uploading(user.username)
+        return self.es.get_presigned_upload(user, filename)
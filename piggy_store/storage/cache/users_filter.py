@@ -0,0 +1,109 @@
+import hashlib
+import math
+
+from piggy_store.storage.cache.connection import get_async_connection, get_connection
+
+# Set the bits in every filter that exists: a filter is either complete or
+# missing, never made of the users added since it was created
+ADD_SCRIPT = '''
+for _, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        for _, offset in ipairs(ARGV) do
+            redis.call('SETBIT', key, offset, 1)
+        end
+    end
+end
+'''
+
+
+class UsersFilter:
+    '''A Bloom filter of the usernames, in redis.
+
+    It tells for sure that a user doesn't exist, so that looking for it
+    in the bucket can be avoided. Until it's built (see rebuild) every
+    user may exist.
+    '''
+
+    __instance = None
+
+    def __new__(cls, options, capacity, error_rate, **kwargs):
+        if not cls.__instance:
+            cls.__instance = object.__new__(cls)
+
+            cls.__instance.conn = get_connection(options)
+            cls.__instance._init(capacity, error_rate)
+
+        return cls.__instance
+
+    def _init(self, capacity, error_rate):
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        # a filter of another size reads as missing, until it's rebuilt
+        self.key = 'users-filter:{}:{}'.format(self.num_bits, self.num_hashes)
+        self.building_key = self.key + ':building'
+        self.add_to_filters = self.conn.register_script(ADD_SCRIPT)
+
+    def _offsets(self, username):
+        digest = hashlib.sha256(username.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def might_exist(self, username):
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.exists(self.key)
+        for offset in self._offsets(username):
+            pipe.getbit(self.key, offset)
+        exists, *bits = pipe.execute()
+        return not exists or all(bits)
+
+    def add(self, username, pipe=None):
+        self.add_to_filters(keys=[self.key, self.building_key], args=self._offsets(username), client=pipe)
+
+    def rebuild(self, usernames):
+        '''Build the filter anew from every username. Return how many.'''
+
+        # the users added meanwhile go in the new filter too
+        self.conn.setbit(self.building_key, self.num_bits - 1, 0)
+
+        bitmap = bytearray(math.ceil(self.num_bits / 8))
+        num_users = 0
+        for username in usernames:
+            for offset in self._offsets(username):
+                # redis numbers the bits from the most significant one
+                bitmap[offset // 8] |= 0x80 >> (offset % 8)
+            num_users += 1
+
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.set(self.building_key + ':bits', bytes(bitmap))
+        pipe.bitop('OR', self.building_key, self.building_key, self.building_key + ':bits')
+        pipe.delete(self.building_key + ':bits')
+        pipe.rename(self.building_key, self.key)
+        pipe.execute()
+
+        return num_users
+
+
+class AsyncUsersFilter(UsersFilter):
+    '''The same filter for the async app, that owns the connection.'''
+
+    def __new__(cls, conn, capacity, error_rate):
+        instance = object.__new__(cls)
+        instance.conn = conn
+        instance._init(capacity, error_rate)
+        return instance
+
+    @classmethod
+    def from_options(cls, options, capacity, error_rate):
+        return cls(get_async_connection(options), capacity, error_rate)
+
+    async def might_exist(self, username):
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.exists(self.key)
+        for offset in self._offsets(username):
+            pipe.getbit(self.key, offset)
+        exists, *bits = await pipe.execute()
+        return not exists or all(bits)
+
+    async def add(self, username, pipe=None):
+        await self.add_to_filters(keys=[self.key, self.building_key], args=self._offsets(username), client=pipe)
@@ -1,5 +1,12 @@
+from datetime import timedelta
+from functools import lru_cache
 from importlib import import_module
+import json
+
+from flask import g, has_request_context
+
 from piggy_store.config import config
+from piggy_store.storage.user_entity import User
 
 # hereon I write "directory" but I mean "prefix" in an S3 context
 
@@ -8,12 +15,44 @@ from piggy_store.config import config
 ADMIN_DIR = 'admin$/'
 USERS_DIR = 'users/'
 
+# In ADMIN_DIR, the users' records (and the challenge files they replaced)
+USER_RECORDS_PREFIX = 'users/'
+CHALLENGE_FILES_PREFIX = 'challenge_'
+
+# How long a client has to start an upload once it got the upload url
+UPLOAD_URL_EXPIRE_AFTER = timedelta(minutes=5)
+
+
+@lru_cache(maxsize=None)
+def _get_file_storage_module(module_name):
+    return import_module(module_name)
 
-def access_user_storage(username):
-    file_storage_module = import_module(config['storage']['files']['module'])
 
+def _request_scoped(key, build):
+    # Within a request every call gets the same storage, instead of
+    # building one per call: a request needs the user's storage a few times
+    if not has_request_context():
+        return build()
+
+    storages = g.setdefault('file_storages', {})
+    storage = storages.get(key)
+    if storage is None:
+        storage = storages[key] = build()
+    return storage
+
+
+def access_user_storage(username):
     # add a pending / to avoid that a username can be the prefix of another one
     directory = USERS_DIR + username + '/'
+    return _request_scoped(directory, lambda: _build_storage(directory))
+
+
+def access_admin_storage():
+    return _request_scoped(ADMIN_DIR, lambda: _build_storage(ADMIN_DIR))
+
+
+def _build_storage(directory):
+    file_storage_module = _get_file_storage_module(config['storage']['files']['module'])
 
     storage = file_storage_module.Storage(directory, config['storage']['files']['params'])
     storage.init()
@@ -21,21 +60,82 @@ def access_user_storage(username):
     return storage
 
 
-def access_admin_storage():
-    file_storage_module = import_module(config['storage']['files']['module'])
+def async_access_user_storage(username):
+    file_storage_module = _get_file_storage_module(config['storage']['files']['async_module'])
+
+    directory = USERS_DIR + username + '/'
+
+    storage = file_storage_module.Storage(directory, config['storage']['files']['params'])
+    storage.init()
+
+    return storage
+
+
+def async_access_admin_storage():
+    file_storage_module = _get_file_storage_module(config['storage']['files']['async_module'])
     storage = file_storage_module.Storage(ADMIN_DIR, config['storage']['files']['params'])
     storage.init()
 
     return storage
 
 
+def files_served_by_the_app():
+    '''Whether the files are uploaded to and downloaded from the application
+    itself (see local_storage), instead of the storage.'''
+    file_storage_module = _get_file_storage_module(config['storage']['files']['module'])
+    return getattr(file_storage_module, 'SERVED_BY_THE_APP', False)
+
+
+async def close_async_files_clients():
+    file_storage_module = _get_file_storage_module(config['storage']['files']['async_module'])
+    await file_storage_module.close_clients()
+
+
+def parse_user_object_name(object_name):
+    '''Return (username, filename) for an object in a user's directory.
+
+    Return None for any other object.
+    '''
+
+    if not object_name.startswith(USERS_DIR):
+        return None
+
+    username, _, filename = object_name[len(USERS_DIR):].partition('/')
+    if not username or not filename:
+        return None
+
+    return username, filename
+
+
 def compose_challenge_file_filename(username, answer):
-    return 'challenge_{}_{}'.format(username, answer)
+    return '{}{}_{}'.format(CHALLENGE_FILES_PREFIX, username, answer)
 
 
 def parse_challenge_file_filename(filename):
-    challenge_fixed_string, username, answer = filename.split('_', 2)
+    # from the right: a username may contain _, the answer (32 hex
+    # characters) never does
+    username, answer = filename[len(CHALLENGE_FILES_PREFIX):].rsplit('_', 1)
     return {
         'username': username,
         'answer': answer
     }
+
+
+def compose_user_record_filename(username):
+    return '{}{}.json'.format(USER_RECORDS_PREFIX, username)
+
+
+def parse_user_record_filename(filename):
+    return filename[len(USER_RECORDS_PREFIX):-len('.json')]
+
+
+def compose_user_record(user):
+    return json.dumps({
+        'challenge': user.challenge,
+        'answer': user.answer
+    }, separators=(',', ':'))
+
+
+def parse_user_record(username, content):
+    record = json.loads(content.decode('utf-8'))
+    return User(username, record['challenge'], record['answer'])
@@ -0,0 +1,121 @@
+'''The local file storage for the async app.
+
+The same storage as local_storage, with the disk read and written in the
+default executor, so that the event loop never waits for it.
+'''
+
+import asyncio
+from functools import partial
+from itertools import islice
+
+from piggy_store.server_timing import timed
+from piggy_store.storage.files.local_storage import DELETE_BATCH_SIZE, Storage as SyncStorage
+
+# entries of the index read per call to the executor
+LISTING_PAGE_SIZE = 1000
+
+
+async def _run(func, *args):
+    # the executor's thread doesn't time anything, it's not in a request
+    with timed('disk'):
+        return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args))
+
+
+async def close_clients():
+    # no connection to close
+    pass
+
+
+class Storage:
+    '''The async counterpart of local_storage.Storage.'''
+
+    def __init__(self, user_dir, options):
+        self.user_dir = user_dir
+        self.opts = options
+        self.offline = SyncStorage(user_dir, options)
+
+    def init(self):
+        self.offline.init()
+
+    async def check_bucket(self):
+        await _run(self.offline.check_bucket)
+
+    def build_file(self, filename, raw_file=None):
+        return self.offline.build_file(filename, raw_file)
+
+    async def add_file(self, f):
+        return await _run(self.offline.add_file, f)
+
+    async def put_file(self, f):
+        return await _run(self.offline.put_file, f)
+
+    async def get_files_list(self, prefix='', start_after=''):
+        presign_get = self.offline.local_bucket.prepare_get(self.opts['download_url_expire_after'])
+
+        keys = self.list_file_keys(prefix, start_after)
+        try:
+            async for filename, size, checksum in keys:
+                yield self.build_file(filename, dict(size=size, checksum=checksum, sign_url=presign_get))
+        finally:
+            await keys.aclose()
+
+    async def list_file_keys(self, prefix='', start_after='', backfill_etags=False):
+        entries = self.offline.list_file_keys(prefix, start_after)
+        try:
+            while True:
+                page = await _run(lambda: list(islice(entries, LISTING_PAGE_SIZE)))
+                if not page:
+                    break
+                for entry in page:
+                    yield entry
+        finally:
+            entries.close()
+
+    def build_files(self, entries):
+        return self.offline.build_files(entries)
+
+    def get_presigned_post_policy(self, f):
+        return self.offline.get_presigned_post_policy(f)
+
+    def get_presigned_retrieve_url(self, f):
+        return self.offline.get_presigned_retrieve_url(f)
+
+    def get_presigned_upload(self, f):
+        return self.offline.get_presigned_upload(f)
+
+    async def remove_file(self, f):
+        await _run(self.offline.remove_file, f)
+
+    async def remove_multiple(self, files, progress=None):
+        batch = []
+        num_removed = 0
+        async for f in files:
+            batch.append(f)
+            if len(batch) < DELETE_BATCH_SIZE:
+                continue
+
+            await _run(self.offline.remove_multiple, batch)
+            num_removed += len(batch)
+            batch = []
+            if progress:
+                progress(num_removed)
+
+        if batch:
+            await _run(self.offline.remove_multiple, batch)
+            if progress:
+                progress(num_removed + len(batch))
+
+    async def remove_all(self, progress=None):
+        await _run(self.offline.remove_all, progress)
+
+    async def count_files(self, up_to):
+        return await _run(self.offline.count_files, up_to)
+
+    async def get_file_content(self, f):
+        return await _run(self.offline.get_file_content, f)
+
+    async def get_file_content_if_exists(self, f):
+        return await _run(self.offline.get_file_content_if_exists, f)
+
+    async def get_first_matching_file(self, prefix):
+        return await _run(self.offline.get_first_matching_file, prefix)
@@ -0,0 +1,406 @@
+'''The S3 file storage for the async app.
+
+Requests are signed by minio's helpers and sent with an httpx async
+client, so that waiting for S3 never blocks the event loop. Anything
+that needs no request (presigning urls and POST policies) is done by the
+same code as the sync storage.
+'''
+
+import asyncio
+from datetime import datetime
+import os
+import weakref
+
+import certifi
+import httpx
+from minio.credentials import Credentials, Static
+from minio.definitions import Object
+from minio.error import AccessDenied, NoSuchBucket, NoSuchKey, ResponseError
+from minio.helpers import get_md5_base64digest, get_sha256_hexdigest, get_target_url
+from minio.parsers import parse_list_objects_v2, parse_multi_object_delete_response
+from minio.signer import sign_v4
+from minio.xml_marshal import xml_marshal_delete_objects
+
+from piggy_store.server_timing import timed
+from piggy_store.exceptions import (
+    FileExistsError,
+    MultipleFilesRemoveError,
+    BucketAccessTimeoutError,
+    BucketAccessDeniedError,
+    BucketDoesNotExistError,
+    BucketWriteError
+)
+from piggy_store.storage.cache import get_async_etag_storage
+from piggy_store.storage.files.file_entity import FileDTO
+from piggy_store.storage.files.s3_storage import (
+    DELETE_BATCH_SIZE,
+    ETAG_BACKFILL_BATCH_SIZE,
+    Storage as SyncStorage,
+    _registry_key,
+    get_signer
+)
+
+# One client (and so one pool of connections) per set of credentials and
+# event loop, like the sync storage does per process.
+_clients = weakref.WeakKeyDictionary()
+
+
+class _ResponseAdapter:
+    # what minio's ResponseError reads from a urllib3 response
+    def __init__(self, response):
+        self.status = response.status_code
+        self.reason = response.reason_phrase
+        self.data = response.content
+        self.headers = response.headers
+
+
+class AsyncS3Client:
+    def __init__(self, options):
+        self.endpoint_url = ('https://' if options['secure'] else 'http://') + options['host']
+        self.region = options['region'] or 'us-east-1'
+        self.credentials = Credentials(provider=Static(options['access_key'], options['secret_key']))
+
+        timeout = options['connection_timeout']
+        self.http = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout) if timeout else httpx.Timeout(None),
+            limits=httpx.Limits(
+                max_connections=options['connection_pool_size'],
+                max_keepalive_connections=options['connection_pool_size']
+            ),
+            verify=os.environ.get('SSL_CERT_FILE') or certifi.where(),
+            transport=httpx.AsyncHTTPTransport(retries=3)
+        )
+
+    async def request(self, method, bucket_name, object_name=None, query=None, body=b'', headers=None):
+        url = get_target_url(
+            self.endpoint_url,
+            bucket_name=bucket_name,
+            object_name=object_name,
+            bucket_region=self.region,
+            query=query
+        )
+
+        signed_headers = sign_v4(
+            method,
+            url,
+            self.region,
+            dict(headers or {}),
+            self.credentials,
+            get_sha256_hexdigest(body),
+            datetime.utcnow()
+        )
+
+        with timed('s3'):
+            response = await self.http.request(method, url, content=body, headers=signed_headers)
+
+        if response.status_code not in (200, 204, 206):
+            raise ResponseError(_ResponseAdapter(response), method, bucket_name, object_name).get_exception()
+
+        return response
+
+    async def bucket_exists(self, bucket_name):
+        try:
+            await self.request('HEAD', bucket_name)
+        except NoSuchBucket:
+            return False
+        return True
+
+    async def stat_object(self, bucket_name, object_name):
+        response = await self.request('HEAD', bucket_name, object_name)
+        return Object(
+            bucket_name,
+            object_name,
+            response.headers.get('last-modified'),
+            response.headers.get('etag', '').replace('"', ''),
+            int(response.headers.get('content-length', '0')),
+            content_type=response.headers.get('content-type', '')
+        )
+
+    async def put_object(self, bucket_name, object_name, content):
+        response = await self.request('PUT', bucket_name, object_name, body=content, headers={
+            'Content-Type': 'application/octet-stream',
+            'Content-Md5': get_md5_base64digest(content)
+        })
+        return response.headers.get('etag', '').replace('"', '')
+
+    async def get_object(self, bucket_name, object_name):
+        response = await self.request('GET', bucket_name, object_name)
+        return response.content
+
+    async def remove_object(self, bucket_name, object_name):
+        await self.request('DELETE', bucket_name, object_name)
+
+    async def remove_objects(self, bucket_name, object_names):
+        '''Remove up to DELETE_BATCH_SIZE objects, return the errors.'''
+
+        content = xml_marshal_delete_objects(object_names)
+        response = await self.request('POST', bucket_name, query={'delete': ''}, body=content, headers={
+            'Content-Md5': get_md5_base64digest(content)
+        })
+        return parse_multi_object_delete_response(response.content)
+
+    async def list_objects_v2(self, bucket_name, prefix='', start_after=''):
+        query = {
+            'list-type': '2',
+            'start-after': start_after,
+            'prefix': prefix
+        }
+
+        is_truncated = True
+        while is_truncated:
+            response = await self.request('GET', bucket_name, query=query)
+            objects, is_truncated, continuation_token = parse_list_objects_v2(
+                response.content, bucket_name=bucket_name
+            )
+            if continuation_token:
+                query['continuation-token'] = continuation_token
+
+            for obj in objects:
+                yield obj
+
+    async def aclose(self):
+        await self.http.aclose()
+
+
+def get_client(options):
+    clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    key = _registry_key(options)
+
+    client = clients.get(key)
+    if client is None:
+        client = clients[key] = AsyncS3Client(options)
+
+    return client
+
+
+async def close_clients():
+    clients = _clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.aclose()
+
+
+class Storage:
+    '''The async counterpart of s3_storage.Storage.
+
+    Same methods, same results, but every one that talks with S3 is a
+    coroutine (or an async generator for the listings).
+    '''
+
+    def __init__(self, user_dir, options):
+        self.client = None
+        self.signer = None
+        self.user_dir = user_dir
+        self.bucket = options['bucket']
+        self.opts = options
+        # presigning needs no request to S3, the sync storage does it
+        self.offline = SyncStorage(user_dir, options)
+
+    def init(self):
+        self.client = get_client(self.opts)
+        self.signer = get_signer(self.opts)
+        self.offline.init()
+
+    async def check_bucket(self):
+        try:
+            if not await self.client.bucket_exists(self.bucket):
+                raise BucketDoesNotExistError(self.bucket)
+        except AccessDenied:
+            raise BucketAccessDeniedError()
+        except httpx.TransportError:
+            raise BucketAccessTimeoutError()
+
+        f = self.build_file('.check-bucket-permissions')
+
+        try:
+            try: await self.add_file(f)
+            except FileExistsError: pass
+            await self.remove_file(f)
+        except ResponseError:
+            raise BucketWriteError()
+
+    def build_file(self, filename, raw_file=None):
+        return FileDTO(**(raw_file or {}), object_name=self.user_dir + filename)
+
+    async def add_file(self, f):
+        try:
+            await self.client.stat_object(self.bucket, f.object_name)
+        except NoSuchKey:
+            etag = await self.client.put_object(self.bucket, f.object_name, f.content or b'')
+            return f.clone(
+                checksum=etag,
+                url=self.get_presigned_retrieve_url(f)
+            )
+        else:
+            raise FileExistsError()
+
+    async def get_files_list(self, prefix='', start_after=''):
+        presign_get = self.signer.prepare_get(self.opts['download_url_expire_after'])
+
+        keys = self.list_file_keys(prefix, start_after, backfill_etags=True)
+        try:
+            async for filename, size, etag in keys:
+                object_name = self.user_dir + filename
+                yield FileDTO(
+                    object_name=object_name,
+                    size=size,
+                    checksum=etag,
+                    sign_url=presign_get
+                )
+        finally:
+            await keys.aclose()
+
+    async def list_file_keys(self, prefix='', start_after='', backfill_etags=False):
+        objects = self.client.list_objects_v2(
+            self.bucket,
+            self.user_dir + prefix,
+            start_after=self.user_dir + start_after if start_after else ''
+        )
+        skip = len(self.user_dir)
+
+        if not backfill_etags:
+            async for obj in objects:
+                yield obj.object_name[skip:], obj.size, obj.etag
+            return
+
+        batch = []
+        async for obj in objects:
+            batch.append(obj)
+            if len(batch) < ETAG_BACKFILL_BATCH_SIZE:
+                continue
+
+            await self._backfill_etags(batch)
+            for obj in batch:
+                yield obj.object_name[skip:], obj.size, obj.etag
+            batch = []
+
+        if batch:
+            await self._backfill_etags(batch)
+            for obj in batch:
+                yield obj.object_name[skip:], obj.size, obj.etag
+
+    def build_files(self, entries):
+        return self.offline.build_files(entries)
+
+    async def _backfill_etags(self, objects):
+        missing = [obj for obj in objects if not obj.etag]
+        if not missing:
+            return
+
+        etag_storage = get_async_etag_storage()
+        cached_etags = await etag_storage.get_many(missing)
+
+        to_stat = []
+        for obj in missing:
+            obj.etag = cached_etags.get(obj.object_name)
+            if not obj.etag:
+                to_stat.append(obj)
+
+        if not to_stat:
+            return
+
+        semaphore = asyncio.Semaphore(self.opts['stat_concurrency'])
+
+        async def stat(obj):
+            async with semaphore:
+                return await self.client.stat_object(self.bucket, obj.object_name)
+
+        for obj, stat_obj in zip(to_stat, await asyncio.gather(*map(stat, to_stat))):
+            obj.etag = stat_obj.etag
+
+        await etag_storage.set_many(to_stat)
+
+    def get_presigned_post_policy(self, f):
+        return self.offline.get_presigned_post_policy(f)
+
+    def get_presigned_retrieve_url(self, f):
+        return self.offline.get_presigned_retrieve_url(f)
+
+    def get_presigned_upload(self, f):
+        return self.offline.get_presigned_upload(f)
+
+    async def remove_file(self, f):
+        await self.client.remove_object(self.bucket, f.object_name)
+
+    async def remove_multiple(self, files, progress=None):
+        await self._remove_object_names((f.object_name async for f in files), progress)
+
+    async def remove_all(self, progress=None):
+        await self._remove_object_names(
+            (self.user_dir + filename async for filename, _, _ in self.list_file_keys()),
+            progress
+        )
+
+    async def count_files(self, up_to):
+        num_files = 0
+        keys = self.list_file_keys()
+        try:
+            async for _ in keys:
+                if num_files == up_to:
+                    break
+                num_files += 1
+        finally:
+            await keys.aclose()
+        return num_files
+
+    async def _remove_object_names(self, object_names, progress=None):
+        # see s3_storage.Storage._remove_object_names
+        errors = []
+        num_removed = 0
+        pending = set()
+
+        async def remove_batch(batch):
+            return batch, await self.client.remove_objects(self.bucket, batch)
+
+        async def wait_first():
+            nonlocal pending, num_removed
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                batch, batch_errors = task.result()
+                num_removed += len(batch) - len(batch_errors)
+                errors.extend((FileDTO(object_name=e.object_name), e) for e in batch_errors)
+
+            if progress:
+                progress(num_removed)
+
+        try:
+            batch = []
+            async for object_name in object_names:
+                batch.append(object_name)
+                if len(batch) < DELETE_BATCH_SIZE:
+                    continue
+
+                pending.add(asyncio.ensure_future(remove_batch(batch)))
+                batch = []
+                if len(pending) >= self.opts['delete_concurrency']:
+                    await wait_first()
+
+            if batch:
+                pending.add(asyncio.ensure_future(remove_batch(batch)))
+
+            while pending:
+                await wait_first()
+        finally:
+            for task in pending:
+                task.cancel()
+
+        if errors:
+            raise MultipleFilesRemoveError(errors)
+
+    async def get_file_content(self, f):
+        return await self.client.get_object(self.bucket, f.object_name)
+
+    async def get_file_content_if_exists(self, f):
+        try:
+            return await self.get_file_content(f)
+        except NoSuchKey:
+            return None
+
+    async def get_first_matching_file(self, prefix):
+        keys = self.list_file_keys(prefix=prefix)
+        try:
+            async for filename, size, etag in keys:
+                return self.build_file(filename, dict(size=size, checksum=etag))
+        finally:
+            await keys.aclose()
+
+        return None
@@ -1,16 +1,24 @@
 class FileDTO:
+    # a listing holds thousands of them: no __dict__ per file
+    __slots__ = ('object_name', 'checksum', 'size', 'content', 'path_separator', 'filename', '_url', '_sign_url')
+
     def __init__(self,
                  object_name=None,
                  checksum=None,
                  size=None,
                  url=None,
                  content=None,
-                 path_separator='/'):
+                 path_separator='/',
+                 sign_url=None):
 
         self.object_name = object_name
         self.checksum = checksum
-        self.url = url
         self.path_separator = path_separator
+        self.filename = object_name.rpartition(path_separator)[2] if object_name else ''
+        # sign_url(object_name) gives the url when it's first read, so
+        # that no url is signed for a file that's never serialized
+        self._url = url
+        self._sign_url = sign_url
 
         if content and isinstance(content, str):
             content = content.encode('utf-8')
@@ -18,31 +26,41 @@ class FileDTO:
         self.content = content
         self.size = size or (len(content) if content else 0)
 
+    @property
+    def url(self):
+        if self._url is None and self._sign_url is not None:
+            self._url = self._sign_url(self.object_name)
+            self._sign_url = None
+        return self._url
+
     def as_dict(self):
         return {
-            'filename': self.get_filename(),
+            'filename': self.filename,
             'checksum': self.checksum,
             'size': self.size,
             'url': self.url
         }
 
     def clone(self, **kwargs):
-        raw_file = dict(
-            object_name=self.object_name,
-            checksum=self.checksum,
-            size=self.size,
-            url=self.url,
-            content=self.content,
-            path_separator=self.path_separator
-        )
+        f = FileDTO.__new__(FileDTO)
+        for attr in self.__slots__:
+            setattr(f, attr, getattr(self, attr))
 
         for k, v in kwargs.items():
-            raw_file[k] = v
+            if k == 'url':
+                f._url, f._sign_url = v, None
+            elif k == 'content' and isinstance(v, str):
+                f.content = v.encode('utf-8')
+            else:
+                setattr(f, k, v)
+
+        if 'object_name' in kwargs or 'path_separator' in kwargs:
+            f.filename = f.object_name.rpartition(f.path_separator)[2] if f.object_name else ''
 
-        return FileDTO(**raw_file)
+        return f
 
     def get_filename(self):
-        return self.object_name.rsplit(self.path_separator)[-1] if self.object_name else ''
+        return self.filename
 
     def __repr__(self):
-        return '<FileDTO filename:{} checksum:{}>'.format(self.get_filename(), self.checksum)
+        return '<FileDTO filename:{} checksum:{}>'.format(self.filename, self.checksum)
@@ -0,0 +1,426 @@
+'''The file storage on a local directory, for development and for the
+deployments of a single node, with no S3 server to run.
+
+Every file is stored under the hash of its object name, so that any name
+is valid and none can reach outside the directory. The names, sizes and
+MD5s of the files of a directory (a user's or the admin's) are kept in
+its index: a sorted file, memory-mapped to be listed.
+
+The urls to upload and to download a file are signed with an HMAC of
+the storage's secret, and served by the application itself (see
+piggy_store.local_files), as S3 would: downloads are sent by the WSGI
+server with sendfile, or by nginx with X-Accel-Redirect.
+'''
+
+import base64
+import bisect
+import calendar
+from contextlib import contextmanager
+from datetime import datetime
+import fcntl
+import hashlib
+import hmac
+from itertools import islice
+import json
+import mmap
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import quote, unquote, urlencode
+
+from piggy_store.config import ConfigError, config
+from piggy_store.exceptions import (
+    FileExistsError,
+    BucketDoesNotExistError,
+    BucketWriteError
+)
+from piggy_store.server_timing import timed
+from piggy_store.storage.files import UPLOAD_URL_EXPIRE_AFTER
+from piggy_store.storage.files.file_entity import FileDTO
+from piggy_store.storage.files.storage import Storage as BaseStorage
+
+# the files are uploaded and downloaded by the application (see local_files)
+SERVED_BY_THE_APP = True
+FILES_PATH = '/local-files/'
+
+# accepted size of an upload, in bytes, as for the POST policies of S3
+MIN_UPLOAD_SIZE = 10
+MAX_UPLOAD_SIZE = 1024 * 1024
+# and of the whole request: the file plus the other fields of the form
+MAX_UPLOAD_REQUEST_SIZE = MAX_UPLOAD_SIZE + 16 * 1024
+
+# how many files are removed per rewrite of the index
+DELETE_BATCH_SIZE = 1000
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(options):
+    key = (options.get('path'), options.get('base_url'))
+
+    local_bucket = _buckets.get(key)
+    if local_bucket is None:
+        with _buckets_lock:
+            local_bucket = _buckets.get(key)
+            if local_bucket is None:
+                local_bucket = _buckets[key] = LocalBucket(options)
+
+    return local_bucket
+
+
+def _same_signature(expected, signature):
+    return hmac.compare_digest(expected.encode('utf-8'), signature.encode('utf-8'))
+
+
+def _timestamp(request_date):
+    return calendar.timegm(request_date.utctimetuple())
+
+
+class LocalBucket:
+    '''The directory of the files, shared by the Storages of the process.'''
+
+    def __init__(self, options):
+        try:
+            self.root = options['path']
+            self.base_url = options['base_url'].rstrip('/')
+        except KeyError as e:
+            raise ConfigError('A config key is missing: storage.files.params.{}'.format(e.args[0]))
+
+        self.objects_dir = os.path.join(self.root, 'objects')
+        self.indexes_dir = os.path.join(self.root, 'indexes')
+        self.x_accel_redirect = options.get('x_accel_redirect')
+
+        secret = options.get('secret') or config['secret']
+        self._key = hashlib.sha256(b'piggy-store local files\0' + secret.encode('utf-8')).digest()
+
+    def relative_object_path(self, object_name):
+        digest = hashlib.sha256(object_name.encode('utf-8')).hexdigest()
+        return 'objects/{}/{}'.format(digest[:2], digest)
+
+    def object_path(self, object_name):
+        return os.path.join(self.root, self.relative_object_path(object_name))
+
+    def index(self, directory):
+        digest = hashlib.sha256(directory.encode('utf-8')).hexdigest()
+        return DirectoryIndex(os.path.join(self.indexes_dir, digest))
+
+    def put(self, index, object_name, filename, content, overwrite=False):
+        '''Store a file and add it to the index. Return its MD5.'''
+
+        with timed('disk'):
+            return self._put(index, object_name, filename, content, overwrite)
+
+    def _put(self, index, object_name, filename, content, overwrite):
+        path = self.object_path(object_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # written aside, so that the file is never read half written
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(content)
+
+            etag = hashlib.md5(content).hexdigest()
+            with index.lock():
+                entries = index.read_entries()
+                i = bisect.bisect_left(entries, (filename, ))
+                exists = i < len(entries) and entries[i][0] == filename
+                if exists and not overwrite:
+                    raise FileExistsError()
+
+                os.replace(tmp_path, path)
+                if exists:
+                    entries[i] = (filename, len(content), etag)
+                else:
+                    entries.insert(i, (filename, len(content), etag))
+                index.write_entries(entries)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        return etag
+
+    def remove(self, index, directory, filenames):
+        with timed('disk'), index.lock():
+            removed = set(filenames)
+            index.write_entries([entry for entry in index.read_entries() if entry[0] not in removed])
+
+            for filename in removed:
+                try:
+                    os.unlink(self.object_path(directory + filename))
+                except FileNotFoundError:
+                    pass
+
+    def sign(self, message):
+        return hmac.new(self._key, message.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def prepare_get(self, expires, request_date=None):
+        '''Return a function that signs a download url for an object name.'''
+
+        request_date = request_date or datetime.utcnow()
+        expires_at = str(_timestamp(request_date) + int(expires.total_seconds()))
+        url_prefix = self.base_url + FILES_PATH + '?'
+        sign = self.sign
+
+        def sign_get(object_name):
+            return url_prefix + urlencode([
+                ('key', object_name),
+                ('expires', expires_at),
+                ('signature', sign('GET\n' + expires_at + '\n' + object_name))
+            ])
+
+        return sign_get
+
+    def is_valid_download(self, object_name, expires, signature, now=None):
+        if not expires.isdigit() or int(expires) < (time.time() if now is None else now):
+            return False
+        return _same_signature(self.sign('GET\n' + expires + '\n' + object_name), signature)
+
+    def presign_post_policy(self, object_name, request_date=None):
+        '''Return (url, form data) of an upload, as S3 does.'''
+
+        request_date = request_date or datetime.utcnow()
+        policy = base64.b64encode(json.dumps({
+            'key': object_name,
+            'expires': _timestamp(request_date + UPLOAD_URL_EXPIRE_AFTER),
+            'content_length_range': [MIN_UPLOAD_SIZE, MAX_UPLOAD_SIZE]
+        }).encode('utf-8')).decode('ascii')
+
+        return self.base_url + FILES_PATH, {
+            'key': object_name,
+            'policy': policy,
+            'signature': self.sign('POST\n' + policy)
+        }
+
+    def get_upload_policy(self, form, now=None):
+        '''Return the policy of the upload form, None if invalid.
+
+        It's checked before the file is read: then allows_size tells if
+        the file has the size the policy accepts.
+        '''
+
+        policy = form.get('policy', '')
+        if not _same_signature(self.sign('POST\n' + policy), form.get('signature', '')):
+            return None
+
+        policy = json.loads(base64.b64decode(policy))
+        if policy['expires'] < (time.time() if now is None else now):
+            return None
+        if form.get('key') != policy['key']:
+            return None
+
+        return policy
+
+    def allows_size(self, policy, size):
+        min_size, max_size = policy['content_length_range']
+        return min_size <= size <= max_size
+
+
+class DirectoryIndex:
+    '''The sorted (filename, size, etag) of the files of a directory.
+
+    A line per file, its filename quoted. It's rewritten as a whole (and
+    replaced, so that the readers keep the version they mapped) under a
+    lock shared by the processes.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    @contextmanager
+    def lock(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.lock', 'ab') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _parse(line):
+        filename, size, etag = line.decode('utf-8').rstrip('\n').split('\t')
+        return unquote(filename), int(size), etag
+
+    def read_entries(self):
+        try:
+            with open(self.path, 'rb') as fp:
+                return [self._parse(line) for line in fp]
+        except FileNotFoundError:
+            return []
+
+    def write_entries(self, entries):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                for filename, size, etag in entries:
+                    fp.write('{}\t{}\t{}\n'.format(quote(filename, safe='/ '), size, etag).encode('utf-8'))
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def iter_entries(self, prefix='', start_after=''):
+        '''Yield the entries after start_after, whose filename starts with prefix.'''
+
+        try:
+            fp = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+
+        with fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                return
+
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                def skip(filename):
+                    return filename < prefix or filename <= start_after
+
+                pos = self._bisect(mm, skip)
+                while pos < len(mm):
+                    end = mm.find(b'\n', pos) + 1
+                    entry = self._parse(mm[pos:end])
+                    if not entry[0].startswith(prefix):
+                        break
+                    yield entry
+                    pos = end
+
+    def _bisect(self, mm, skip):
+        # the offset of the first line not to skip: lo is always the start
+        # of a line, the lines before lo are skipped and the ones from hi on
+        # are not
+        lo, hi = 0, len(mm)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = mm.rfind(b'\n', lo, mid) + 1 or lo
+            end = mm.find(b'\n', start) + 1
+            if skip(self._parse(mm[start:end])[0]):
+                lo = end
+            else:
+                hi = start
+        return lo
+
+
+class Storage(BaseStorage):
+    def __init__(self, user_dir, options):
+        self.local_bucket = None
+        self.index = None
+        self.user_dir = user_dir
+        self.opts = options
+
+    def init(self):
+        self.local_bucket = get_bucket(self.opts)
+        self.index = self.local_bucket.index(self.user_dir)
+
+    def check_bucket(self):
+        if not os.path.isdir(self.local_bucket.root):
+            raise BucketDoesNotExistError(self.local_bucket.root)
+
+        f = self.build_file('.check-bucket-permissions')
+
+        try:
+            try: self.add_file(f)
+            except FileExistsError: pass
+            self.remove_file(f)
+        except OSError:
+            raise BucketWriteError()
+
+    def build_file(self, filename, raw_file=None):
+        return FileDTO(**(raw_file or {}), object_name=self.user_dir + filename)
+
+    def _filename(self, f):
+        return f.object_name[len(self.user_dir):]
+
+    def add_file(self, f):
+        etag = self.local_bucket.put(self.index, f.object_name, self._filename(f), f.content or b'')
+        return f.clone(
+            checksum=etag,
+            url=self.get_presigned_retrieve_url(f)
+        )
+
+    def put_file(self, f):
+        '''Store the file, replacing any other with the same name.'''
+
+        etag = self.local_bucket.put(self.index, f.object_name, self._filename(f), f.content or b'', overwrite=True)
+        return f.clone(checksum=etag)
+
+    def get_files_list(self, prefix='', start_after=''):
+        return self.build_files(self.list_file_keys(prefix, start_after))
+
+    def list_file_keys(self, prefix='', start_after='', backfill_etags=False):
+        '''Yield (filename, size, etag) for every file of the directory.
+
+        The etags are in the index, there's nothing to backfill.
+        '''
+
+        return self.index.iter_entries(prefix, start_after)
+
+    def build_files(self, entries):
+        presign_get = self.local_bucket.prepare_get(self.opts['download_url_expire_after'])
+
+        for filename, size, checksum in entries:
+            yield FileDTO(
+                object_name=self.user_dir + filename,
+                size=size,
+                checksum=checksum,
+                sign_url=presign_get
+            )
+
+    def get_presigned_post_policy(self, f, request_date=None):
+        with timed('presign'):
+            return self.local_bucket.presign_post_policy(f.object_name, request_date)
+
+    def get_presigned_retrieve_url(self, f, request_date=None):
+        with timed('presign'):
+            return self.local_bucket.prepare_get(self.opts['download_url_expire_after'], request_date)(f.object_name)
+
+    def get_presigned_upload(self, f):
+        request_date = datetime.utcnow()
+        upload_url, form_data = self.get_presigned_post_policy(f, request_date)
+        return upload_url, form_data, self.get_presigned_retrieve_url(f, request_date)
+
+    def remove_file(self, f):
+        self.local_bucket.remove(self.index, self.user_dir, [self._filename(f)])
+
+    def remove_multiple(self, files, progress=None):
+        self._remove_filenames((self._filename(f) for f in files), progress)
+
+    def remove_all(self, progress=None):
+        # listed upfront: the index is rewritten while removing
+        self._remove_filenames([filename for filename, _, _ in self.list_file_keys()], progress)
+
+    def count_files(self, up_to):
+        return sum(1 for _ in islice(self.list_file_keys(), up_to))
+
+    def _remove_filenames(self, filenames, progress=None):
+        filenames = iter(filenames)
+        num_removed = 0
+
+        while True:
+            batch = list(islice(filenames, DELETE_BATCH_SIZE))
+            if not batch:
+                break
+
+            self.local_bucket.remove(self.index, self.user_dir, batch)
+            num_removed += len(batch)
+            if progress:
+                progress(num_removed)
+
+    def get_file_content(self, f):
+        with timed('disk'), open(self.local_bucket.object_path(f.object_name), 'rb') as fp:
+            return fp.read()
+
+    def get_file_content_if_exists(self, f):
+        try:
+            return self.get_file_content(f)
+        except FileNotFoundError:
+            return None
+
+    def get_first_matching_file(self, prefix):
+        for filename, size, etag in self.list_file_keys(prefix=prefix):
+            return self.build_file(filename, dict(size=size, checksum=etag))
+
+        return None
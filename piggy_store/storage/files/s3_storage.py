@@ -1,8 +1,17 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextvars import copy_context
 from io import BytesIO
+from itertools import islice
 from datetime import datetime, timedelta
+import os
+import socket
+import threading
 
+import certifi
 from minio import Minio, PostPolicy
 from minio.error import NoSuchKey, AccessDenied
+import urllib3
+from urllib3.connection import HTTPConnection
 from urllib3.exceptions import MaxRetryError
 
 from piggy_store.exceptions import (
@@ -13,25 +22,122 @@ from piggy_store.exceptions import (
     BucketDoesNotExistError,
     BucketWriteError
 )
+from piggy_store.server_timing import timed
+from piggy_store.storage.cache import get_etag_storage
+from piggy_store.storage.files import UPLOAD_URL_EXPIRE_AFTER
 from piggy_store.storage.files.file_entity import FileDTO
+from piggy_store.storage.files.signer import PresignedUrlSigner
 from piggy_store.storage.files.storage import Storage as BaseStorage
 
+# How many listed objects at most are checked together for a missing etag
+ETAG_BACKFILL_BATCH_SIZE = 100
+
+# The most keys a DeleteObjects request can hold
+DELETE_BATCH_SIZE = 1000
+
+# One Minio client (and so one urllib3 connection pool) per set of
+# credentials, shared by every Storage instance of the process.
+_clients = {}
+_signers = {}
+_clients_lock = threading.Lock()
+
+
+def _forget_clients():
+    # a forked worker must not reuse the sockets opened by its parent
+    global _clients_lock
+    _clients.clear()
+    _signers.clear()
+    _clients_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_clients)
+
+
+class TimedPoolManager(urllib3.PoolManager):
+    # every request of the Minio client (its request() calls urlopen())
+    def urlopen(self, method, url, redirect=True, **kw):
+        with timed('s3'):
+            return super().urlopen(method, url, redirect, **kw)
+
+
+def _build_http_client(options):
+    socket_options = list(HTTPConnection.default_socket_options)
+    if options['tcp_keepalive']:
+        socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+
+    timeout = options['connection_timeout']
+
+    return TimedPoolManager(
+        timeout=urllib3.Timeout(connect=timeout, read=timeout) if timeout else urllib3.Timeout.DEFAULT_TIMEOUT,
+        maxsize=options['connection_pool_size'],
+        # wait for a free connection instead of opening (and then
+        # discarding) one more than the pool can hold
+        block=True,
+        socket_options=socket_options,
+        cert_reqs='CERT_REQUIRED',
+        ca_certs=os.environ.get('SSL_CERT_FILE') or certifi.where(),
+        retries=urllib3.Retry(
+            total=5,
+            backoff_factor=0.2,
+            status_forcelist=[500, 502, 503, 504]
+        )
+    )
+
+
+def _registry_key(options):
+    return (
+        options['host'],
+        options['access_key'],
+        options['secret_key'],
+        options['secure'],
+        options['region']
+    )
+
+
+def get_client(options):
+    key = _registry_key(options)
+
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = Minio(
+                    options['host'],
+                    access_key=options['access_key'],
+                    secret_key=options['secret_key'],
+                    secure=options['secure'],
+                    region=options['region'],
+                    http_client=_build_http_client(options)
+                )
+
+    return client
+
+
+def get_signer(options):
+    key = _registry_key(options) + (options['bucket'], )
+
+    signer = _signers.get(key)
+    if signer is None:
+        with _clients_lock:
+            signer = _signers.get(key)
+            if signer is None:
+                signer = _signers[key] = PresignedUrlSigner.from_options(options)
+
+    return signer
+
 
 class Storage(BaseStorage):
     def __init__(self, user_dir, options):
         self.client = None
+        self.signer = None
         self.user_dir = user_dir
         self.bucket = options['bucket']
         self.opts = options
 
     def init(self):
-        self.client = Minio(
-            self.opts['host'],
-            access_key=self.opts['access_key'],
-            secret_key=self.opts['secret_key'],
-            secure=self.opts['secure'],
-            region=self.opts['region']
-        )
+        self.client = get_client(self.opts)
+        self.signer = get_signer(self.opts)
 
     def check_bucket(self):
         try:
@@ -71,44 +177,124 @@ class Storage(BaseStorage):
         else:
             raise FileExistsError()
 
-    def get_files_list(self, prefix=''):
-        # XXX self.client list may fail, as list_objects and temprary url
-        for obj in self.client.list_objects_v2(self.bucket, self.user_dir + prefix, recursive=True):
-            if not obj.etag:
-                # e.g. minio without 'erasure'
-                obj.etag = self.client.stat_object(self.bucket, obj.object_name).etag
+    def get_files_list(self, prefix='', start_after=''):
+        return self.build_files(self.list_file_keys(prefix, start_after, backfill_etags=True))
+
+    def list_file_keys(self, prefix='', start_after='', backfill_etags=False):
+        '''Yield (filename, size, etag) for every file of the directory.
+
+        No url is signed and no FileDTO is built, for the callers that need
+        just the names. The etag may be None unless backfill_etags is set.
+        '''
+
+        # XXX self.client list may fail
+        objects = iter(self.client.list_objects_v2(
+            self.bucket,
+            self.user_dir + prefix,
+            recursive=True,
+            start_after=self.user_dir + start_after if start_after else ''
+        ))
+        skip = len(self.user_dir)
+
+        if not backfill_etags:
+            for obj in objects:
+                yield obj.object_name[skip:], obj.size, obj.etag
+            return
+
+        while True:
+            batch = list(islice(objects, ETAG_BACKFILL_BATCH_SIZE))
+            if not batch:
+                break
+
+            self._backfill_etags(batch)
+
+            for obj in batch:
+                yield obj.object_name[skip:], obj.size, obj.etag
+
+    def build_files(self, entries):
+        '''Build the files of a listing, e.g. one saved elsewhere.
 
+        entries is an iterable of (filename, size, checksum), like the one
+        of list_file_keys.
+        '''
+
+        presign_get = self.signer.prepare_get(self.opts['download_url_expire_after'])
+
+        for filename, size, checksum in entries:
+            object_name = self.user_dir + filename
             yield FileDTO(
-                object_name=obj.object_name,
-                size=obj.size,
-                checksum=obj.etag,
-                url=self.get_presigned_retrieve_url(obj)
+                object_name=object_name,
+                size=size,
+                checksum=checksum,
+                sign_url=presign_get
             )
 
-    def get_presigned_post_policy(self, f):
+    def _backfill_etags(self, objects):
+        # e.g. minio without 'erasure' lists the objects without their etag
+        missing = [obj for obj in objects if not obj.etag]
+        if not missing:
+            return
+
+        etag_storage = get_etag_storage()
+        cached_etags = etag_storage.get_many(missing)
+
+        to_stat = []
+        for obj in missing:
+            obj.etag = cached_etags.get(obj.object_name)
+            if not obj.etag:
+                to_stat.append(obj)
+
+        if not to_stat:
+            return
+
+        def stat(obj):
+            return self.client.stat_object(self.bucket, obj.object_name)
+
+        max_workers = min(self.opts['stat_concurrency'], len(to_stat))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # in a copy of the context of the request, to time the calls
+            # with the request's (a context is entered by a thread at once)
+            futures = [executor.submit(copy_context().run, stat, obj) for obj in to_stat]
+            for obj, future in zip(to_stat, futures):
+                obj.etag = future.result().etag
+
+        etag_storage.set_many(to_stat)
+
+    def get_presigned_post_policy(self, f, request_date=None):
         # presigned POST formdata for an object name, expires in 5 minutes.
         # Use POST policy instead of the simpler presigned_put_object because
         # it allows to set an upper limit on the uploaded file size.
 
+        request_date = request_date or datetime.utcnow()
+
         post_policy = PostPolicy()
         post_policy.set_bucket_name(self.bucket)
         post_policy.set_key(f.object_name)
         # content length accepted range, in bytes
         post_policy.set_content_length_range(10, 1024 * 1024)
+        post_policy.set_expires(request_date + UPLOAD_URL_EXPIRE_AFTER)
 
-        expires_date = datetime.utcnow() + timedelta(minutes=5)
-        post_policy.set_expires(expires_date)
-
-        url_str, signed_form_data = self.client.presigned_post_policy(post_policy)
-        return url_str, signed_form_data
+        with timed('presign'):
+            return self.signer.presign_post_policy(post_policy, request_date)
 
-    def get_presigned_retrieve_url(self, f):
+    def get_presigned_retrieve_url(self, f, request_date=None):
         # presigned GET object URL for an object name.
-        return self.client.presigned_get_object(
-            self.bucket,
-            f.object_name,
-            self.opts['download_url_expire_after']
-        )
+        with timed('presign'):
+            return self.signer.presign_get(
+                f.object_name,
+                self.opts['download_url_expire_after'],
+                request_date
+            )
+
+    def get_presigned_upload(self, f):
+        '''Return (upload url, form data, retrieve url) of a file.
+
+        Both are signed with the same date, and so with the same key.
+        '''
+
+        request_date = datetime.utcnow()
+        upload_url, form_data = self.get_presigned_post_policy(f, request_date)
+        return upload_url, form_data, self.get_presigned_retrieve_url(f, request_date)
 
     def remove_file(self, f):
         self.client.remove_object(
@@ -116,14 +302,59 @@ class Storage(BaseStorage):
             f.object_name
         )
 
-    def remove_multiple(self, files):
+    def remove_multiple(self, files, progress=None):
+        self._remove_object_names((f.object_name for f in files), progress)
+
+    def remove_all(self, progress=None):
+        '''Remove every file of the directory.
+
+        progress, if given, is called with the number of files removed so far
+        after every batch.
+        '''
+
+        self._remove_object_names(
+            (self.user_dir + filename for filename, _, _ in self.list_file_keys()),
+            progress
+        )
+
+    def count_files(self, up_to):
+        '''Count the files of the directory, stopping at up_to.'''
+
+        return sum(1 for _ in islice(self.list_file_keys(), up_to))
+
+    def _remove_object_names(self, object_names, progress=None):
+        # Up to delete_concurrency DeleteObjects requests are in flight,
+        # while the next batch is read from object_names: neither the
+        # listing nor the deletion waits for the other to complete.
+
+        def remove_batch(batch):
+            return batch, list(self.client.remove_objects(self.bucket, batch))
+
+        object_names = iter(object_names)
         errors = []
-        files = [f for f in files]
-        for i, error in enumerate(self.client.remove_objects(
-            self.bucket,
-            (f.object_name for f in files)
-        )):
-            errors.append((files[i], error))
+        num_removed = 0
+        pending = set()
+
+        with ThreadPoolExecutor(max_workers=self.opts['delete_concurrency']) as executor:
+            while True:
+                while len(pending) < self.opts['delete_concurrency']:
+                    batch = list(islice(object_names, DELETE_BATCH_SIZE))
+                    if not batch:
+                        break
+                    # timed with the request, as the stats of _backfill_etags
+                    pending.add(executor.submit(copy_context().run, remove_batch, batch))
+
+                if not pending:
+                    break
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch, batch_errors = future.result()
+                    num_removed += len(batch) - len(batch_errors)
+                    errors.extend((FileDTO(object_name=e.object_name), e) for e in batch_errors)
+
+                if progress:
+                    progress(num_removed)
 
         if errors:
             raise MultipleFilesRemoveError(errors)
@@ -136,10 +367,15 @@ class Storage(BaseStorage):
         content.seek(0)
         return content.read()
 
-    def get_first_matching_file(self, prefix):
-        f = None
+    def get_file_content_if_exists(self, f):
+        try:
+            return self.get_file_content(f)
+        except NoSuchKey:
+            return None
 
-        for f in self.get_files_list(prefix=prefix):
-            break
+    def get_first_matching_file(self, prefix):
+        # the file is only read, it needs no url
+        for filename, size, etag in self.list_file_keys(prefix=prefix):
+            return self.build_file(filename, dict(size=size, checksum=etag))
 
-        return f
+        return None
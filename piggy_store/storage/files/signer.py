@@ -0,0 +1,165 @@
+from datetime import datetime
+import hashlib
+import hmac
+
+from minio.compat import queryencode, urlsplit
+from minio.error import InvalidArgumentError
+from minio.helpers import encode_object_name, get_target_url
+from minio.signer import generate_signing_key, remove_default_port
+
+# The maximum expiration accepted by S3 for a presigned url, in seconds
+MAX_EXPIRES = 7 * 24 * 3600
+
+SIGN_V4_ALGORITHM = 'AWS4-HMAC-SHA256'
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+
+
+class PresignedUrlSigner:
+    '''Sign S3 GET urls and POST policies (AWS signature version 4)
+    without a Minio client.
+
+    The output is byte-identical to Minio.presigned_get_object and
+    Minio.presigned_post_policy, but the signing key is derived once per
+    day instead of once per url and all the parts of the url that do not
+    depend on the object are computed upfront.
+    '''
+
+    def __init__(self, endpoint_url, bucket, region, access_key, secret_key, session_token=None):
+        self.region = region or 'us-east-1'
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.session_token = session_token
+
+        # e.g. http://localhost:9000/bucket-test/
+        self.bucket_url = get_target_url(endpoint_url, bucket_name=bucket, bucket_region=self.region)
+
+        parsed_url = urlsplit(self.bucket_url)
+        self.bucket_path = parsed_url.path
+        self.canonical_headers = 'host:' + remove_default_port(parsed_url)
+
+        # (day, signing key)
+        self._signing_key = (None, None)
+
+    @classmethod
+    def from_options(cls, options):
+        scheme = 'https://' if options['secure'] else 'http://'
+        return cls(
+            scheme + options['host'],
+            options['bucket'],
+            options['region'],
+            options['access_key'],
+            options['secret_key']
+        )
+
+    def get_signing_key(self, request_date):
+        day = request_date.strftime('%Y%m%d')
+        cached_day, signing_key = self._signing_key
+
+        if cached_day != day:
+            signing_key = generate_signing_key(request_date, self.region, self.secret_key)
+            self._signing_key = (day, signing_key)
+
+        return signing_key
+
+    def presign_get(self, object_name, expires, request_date=None):
+        return self.prepare_get(expires, request_date)(object_name)
+
+    def presign_get_many(self, object_names, expires, request_date=None):
+        return map(self.prepare_get(expires, request_date), object_names)
+
+    def prepare_get(self, expires, request_date=None):
+        '''Return a function that presigns a GET url for an object name.
+
+        Every url signed by the returned function shares the same request
+        date, so everything but the object's path is computed only once.
+        '''
+
+        if not self.access_key or not self.secret_key:
+            raise InvalidArgumentError('Invalid access_key and secret_key.')
+
+        expires = int(expires.total_seconds())
+        if expires < 1 or expires > MAX_EXPIRES:
+            raise InvalidArgumentError(
+                'Expires param valid values are between 1 sec to {0} secs'.format(MAX_EXPIRES))
+
+        request_date = request_date or datetime.utcnow()
+        iso8601_date = request_date.strftime('%Y%m%dT%H%M%SZ')
+        scope = '/'.join([request_date.strftime('%Y%m%d'), self.region, 's3', 'aws4_request'])
+
+        # already sorted by name, as required by the canonical request
+        query = [
+            ('X-Amz-Algorithm', SIGN_V4_ALGORITHM),
+            ('X-Amz-Credential', self.access_key + '/' + scope),
+            ('X-Amz-Date', iso8601_date),
+            ('X-Amz-Expires', str(expires)),
+        ]
+        if self.session_token:
+            query.append(('X-Amz-Security-Token', self.session_token))
+        query.append(('X-Amz-SignedHeaders', 'host'))
+
+        query_string = '&'.join(k + '=' + queryencode(v) for k, v in query)
+        canonical_suffix = '\n'.join([
+            '',
+            query_string.replace('%7E', '~'),
+            self.canonical_headers,
+            '',
+            'host',
+            UNSIGNED_PAYLOAD
+        ])
+        string_to_sign_prefix = '\n'.join([SIGN_V4_ALGORITHM, iso8601_date, scope, ''])
+        url_prefix = self.bucket_url
+        canonical_path_prefix = 'GET\n' + self.bucket_path
+        url_suffix = '?' + query_string + '&X-Amz-Signature='
+
+        signing_key = self.get_signing_key(request_date)
+        sha256 = hashlib.sha256
+        new_hmac = hmac.new
+
+        def sign(object_name):
+            path = encode_object_name(object_name)
+
+            canonical_request = canonical_path_prefix + path.replace('%7E', '~') + canonical_suffix
+            string_to_sign = string_to_sign_prefix + sha256(canonical_request.encode('utf-8')).hexdigest()
+            signature = new_hmac(signing_key, string_to_sign.encode('utf-8'), sha256).hexdigest()
+
+            return url_prefix + path + url_suffix + signature
+
+        return sign
+
+    def presign_post_policy(self, post_policy, request_date=None):
+        '''Return (url, form data) of a POST upload, as Minio does.'''
+
+        post_policy.is_valid()
+
+        request_date = request_date or datetime.utcnow()
+        iso8601_date = request_date.strftime('%Y%m%dT%H%M%SZ')
+        scope = '/'.join([request_date.strftime('%Y%m%d'), self.region, 's3', 'aws4_request'])
+        credential = self.access_key + '/' + scope
+
+        policy = [
+            ('eq', '$x-amz-date', iso8601_date),
+            ('eq', '$x-amz-algorithm', SIGN_V4_ALGORITHM),
+            ('eq', '$x-amz-credential', credential),
+        ]
+        if self.session_token:
+            policy.append(('eq', '$x-amz-security-token', self.session_token))
+
+        post_policy_base64 = post_policy.base64(extras=policy)
+        signature = hmac.new(
+            self.get_signing_key(request_date),
+            post_policy_base64.encode('utf-8'),
+            hashlib.sha256
+        ).hexdigest()
+
+        form_data = {
+            'policy': post_policy_base64,
+            'x-amz-algorithm': SIGN_V4_ALGORITHM,
+            'x-amz-credential': credential,
+            'x-amz-date': iso8601_date,
+            'x-amz-signature': signature,
+        }
+        if self.session_token:
+            form_data['x-amz-security-token'] = self.session_token
+
+        post_policy.form_data.update(form_data)
+        return self.bucket_url, post_policy.form_data
@@ -10,7 +10,15 @@ class Storage(metaclass=ABCMeta):
         raise NotImplementedError()
 
     @abstractmethod
-    def get_files_list(self):
+    def get_files_list(self, prefix='', start_after=''):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def list_file_keys(self, prefix='', start_after='', backfill_etags=False):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def build_files(self, entries):
         raise NotImplementedError()
 
     @abstractmethod
@@ -21,10 +29,22 @@ class Storage(metaclass=ABCMeta):
     def get_presigned_retrieve_url(self, file_instance):
         raise NotImplementedError()
 
+    @abstractmethod
+    def get_presigned_upload(self, file_instance):
+        raise NotImplementedError()
+
     @abstractmethod
     def remove_file(self, file_instance):
         raise NotImplementedError
 
     @abstractmethod
-    def remove_multiple(self, files_iterator):
+    def remove_multiple(self, files_iterator, progress=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_all(self, progress=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def count_files(self, up_to):
         raise NotImplementedError
@@ -1,4 +1,5 @@
 import re
+from urllib.parse import unquote_plus
 
 from piggy_store.exceptions import (
     TokenInvalidError,
@@ -8,8 +9,11 @@ from piggy_store.exceptions import (
     FieldEmptyError,
     FieldLengthError,
     FieldMaxLengthError,
-    FieldHexError
+    FieldHexError,
+    FieldRangeError
 )
+from piggy_store.pagination import MAX_PAGE_SIZE, decode_cursor
+from piggy_store.storage.files import parse_user_object_name
 
 
 def new_user_validator(payload):
@@ -62,6 +66,20 @@ def request_upload_url_validator(payload):
     )
 
 
+def list_user_files_validator(payload):
+    limit = payload.get('limit', MAX_PAGE_SIZE)
+    cursor = payload.get('cursor', '')
+
+    limit = _validate_is_integer('limit', limit)
+    _validate_is_in_range('limit', limit, 1, MAX_PAGE_SIZE)
+    _validate_is_string('cursor', cursor)
+
+    return dict(
+        limit=limit,
+        cursor=decode_cursor(cursor) if cursor else ''
+    )
+
+
 def file_delete_validator(payload):
     _validate_has_attrs(payload, ['filename'])
     _validate_is_string('filename', payload['filename'])
@@ -72,6 +90,54 @@ def file_delete_validator(payload):
     )
 
 
+def s3_events_validator(payload, bucket):
+    '''Extract the changes to the users' files from S3 bucket notifications.
+
+    Events for other buckets, for objects outside of the users' directory
+    or of unknown type are ignored.
+    '''
+
+    _validate_has_attrs(payload, ['Records'])
+    _validate_is_list('Records', payload['Records'])
+
+    events = []
+    for record in payload['Records']:
+        try:
+            event_name = record['eventName']
+            s3 = record['s3']
+            bucket_name = s3['bucket']['name']
+            # S3 sends the keys url-encoded
+            object_name = unquote_plus(s3['object']['key'])
+        except (TypeError, KeyError):
+            continue
+
+        if bucket_name != bucket or not isinstance(event_name, str):
+            continue
+
+        parsed = parse_user_object_name(object_name)
+        if parsed is None:
+            continue
+
+        username, filename = parsed
+
+        if event_name.startswith('s3:ObjectCreated:'):
+            events.append(dict(
+                action='created',
+                username=username,
+                filename=filename,
+                size=s3['object'].get('size', 0),
+                checksum=(s3['object'].get('eTag') or '').strip('"')
+            ))
+        elif event_name.startswith('s3:ObjectRemoved:'):
+            events.append(dict(
+                action='removed',
+                username=username,
+                filename=filename
+            ))
+
+    return events
+
+
 def _validate_has_attrs(data, attrs):
     for attr_name in attrs:
         if data.get(attr_name) is None:
@@ -83,6 +149,24 @@ def _validate_is_string(field_name, wannabetext):
         raise FieldTypeError(field_name, 'string')
 
 
+def _validate_is_list(field_name, wannabelist):
+    if not isinstance(wannabelist, list):
+        raise FieldTypeError(field_name, 'list')
+
+
+def _validate_is_integer(field_name, wannabenumber):
+    # query string values are always strings
+    try:
+        return int(wannabenumber)
+    except (TypeError, ValueError):
+        raise FieldTypeError(field_name, 'integer')
+
+
+def _validate_is_in_range(field_name, number, min_value, max_value):
+    if not min_value <= number <= max_value:
+        raise FieldRangeError(field_name, min_value, max_value)
+
+
 def _validate_username_format(username):
     if not re.match('^[a-z0-9][a-z0-9_-]*$', username):
         raise UsernameFormatError()
@@ -0,0 +1,58 @@
+'''Load every user in the cache, e.g. after redis restarted.
+
+Otherwise every login misses the cache and reads the bucket, all at once.
+'''
+
+from itertools import islice
+import logging
+import threading
+from time import monotonic
+
+from piggy_store.storage import EasyStorage
+from piggy_store.storage.cache import get_cache_storage
+
+logger = logging.getLogger(__name__)
+
+# users cached per round trip to redis
+WARM_UP_BATCH_SIZE = 1000
+
+
+def warm_cache(concurrency=8, report=None):
+    '''Cache every user. Return (users read, users added, seconds taken).
+
+    report, if given, is called the same way after every batch.
+    '''
+
+    cache_storage = get_cache_storage()
+    users = EasyStorage().list_users(concurrency)
+
+    start = monotonic()
+    num_read = num_added = 0
+    while True:
+        batch = list(islice(users, WARM_UP_BATCH_SIZE))
+        if not batch:
+            break
+
+        num_read += len(batch)
+        num_added += cache_storage.cache_users(batch)
+        if report:
+            report(num_read, num_added, monotonic() - start)
+
+    return num_read, num_added, monotonic() - start
+
+
+def warm_cache_in_background(concurrency=8):
+    '''Warm up the cache in a thread, unless another worker did it recently.'''
+
+    def run():
+        try:
+            if not get_cache_storage().claim_warm_up():
+                return
+            num_read, num_added, elapsed = warm_cache(concurrency)
+            logger.info('Cache warmed up: %d users read, %d added in %.1fs', num_read, num_added, elapsed)
+        except Exception:
+            logger.exception('Cannot warm up the cache')
+
+    thread = threading.Thread(target=run, name='cache-warm-up', daemon=True)
+    thread.start()
+    return thread
@@ -11,6 +11,7 @@ import unittest
 from unittest.mock import patch, Mock
 import base64
 import json
+import time
 import urllib
 from datetime import datetime
 from hashlib import md5
@@ -100,8 +101,8 @@ class Navigator:
         res = self.upload_file_with_form_data(upload_url, form_data, file_content)
         assert res.status_code == 204
 
-    def list_files(self, token):
-        return self.cli.get('/files/', headers={
+    def list_files(self, token, **qs):
+        return self.cli.get('/files/', query_string=qs, headers={
             'Authorization': 'Bearer ' + token
         }, content_type='application/json')
 
@@ -112,6 +113,23 @@ class Navigator:
             'Authorization': 'Bearer ' + token
         }, content_type='application/json')
 
+    def send_s3_events(self, auth_token, records):
+        return self.cli.post('/events/s3', data=json.dumps({
+            'Records': records
+        }), headers={
+            'Authorization': 'Bearer ' + auth_token
+        }, content_type='application/json')
+
+    def get_job_status(self, url, token):
+        return self.cli.get(urllib.parse.urlsplit(url).path, headers={
+            'Authorization': 'Bearer ' + token
+        })
+
+    def connection_pools_status(self, auth_token):
+        return self.cli.get('/status/connection-pools', headers={
+            'Authorization': 'Bearer ' + auth_token
+        })
+
     def delete_user(self, token):
         return self.cli.delete('/users/', headers={
             'Authorization': 'Bearer ' + token
@@ -196,11 +214,51 @@ def bucket_teardown():
         miniocli.remove_bucket(bucket_name)
 
 
-@pytest.fixture(scope='module')
-def cli():
+class AsgiTestClient:
+    '''Give starlette's TestClient the interface of flask's test client.'''
+
+    def __init__(self, client):
+        self.client = client
+
+    def open(self, method, path, query_string=None, data=None, headers=None, content_type=None):
+        headers = dict(headers or {})
+        if content_type:
+            headers['Content-Type'] = content_type
+
+        r = self.client.request(method, path, params=query_string, content=data, headers=headers)
+        r.data = r.content
+        return r
+
+    def get(self, path, **kwargs):
+        return self.open('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open('POST', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.open('DELETE', path, **kwargs)
+
+
+@pytest.fixture(scope='module', params=['wsgi', 'asgi'])
+def cli(request):
     bucket_name = config['storage']['files']['params']['bucket']
     bucket_init(bucket_name)
-    return Navigator(create_app(config).test_client())
+
+    if request.param == 'wsgi':
+        navigator = Navigator(create_app(config).test_client())
+        navigator.mode = 'wsgi'
+        yield navigator
+        return
+
+    pytest.importorskip('starlette')
+    from starlette.testclient import TestClient
+    from piggy_store.asgi import create_asgi_app
+
+    # entering the client runs the lifespan of the app
+    with TestClient(create_asgi_app(config), base_url='http://localhost') as client:
+        navigator = Navigator(AsgiTestClient(client))
+        navigator.mode = 'asgi'
+        yield navigator
 
 
 class TestPiggyStoreApp:
@@ -212,6 +270,12 @@ class TestPiggyStoreApp:
         bucket_init(bucket_name)
         request.addfinalizer(bucket_teardown)
 
+    @pytest.fixture(autouse=True)
+    def skip_wsgi_only(self, request, cli):
+        # these tests patch the Minio client, that the async app doesn't use
+        if cli.mode != 'wsgi' and request.node.get_closest_marker('wsgi_only'):
+            pytest.skip('patches the sync S3 client')
+
     def _test_cors(self, r):
         assert r.headers.get('Content-Type') == 'application/json'
         assert r.headers.get('Access-Control-Allow-Origin') == '*'
@@ -340,6 +404,255 @@ class TestPiggyStoreApp:
             }
         }
 
+    def test_users_stored_as_challenge_files_are_found_and_migrated(self, cli):
+        from io import BytesIO
+        from piggy_store.admin import main as admin_main
+
+        bucket_name = config['storage']['files']['params']['bucket']
+        legacy_object_name = 'admin$/challenge_{}_{}'.format(FOO_USERNAME, FOO_ANSWER)
+        content = FOO_ENC_CHALLENGE.encode('utf-8')
+        miniocli.put_object(bucket_name, legacy_object_name, BytesIO(content), len(content))
+
+        r = cli.get_auth_challenge(FOO_USERNAME)
+        assert r.status_code == 200
+        assert json.loads(r.data.decode('utf-8'))['content']['challenge'] == FOO_ENC_CHALLENGE
+
+        # the username is taken
+        rediscli.delete(FOO_USERNAME)
+        r = cli.create_user_foo()
+        assert r.status_code == 409
+
+        assert admin_main(['migrate-users', '--delete-old'], config) == 0
+        assert [o.object_name for o in miniocli.list_objects_v2(bucket_name, 'admin$/', recursive=True)] == [
+            'admin$/users/foo.json'
+        ]
+
+        rediscli.delete(FOO_USERNAME)
+        with patch.dict(config, {'legacy_challenge_files': False}):
+            r = cli.answer_auth_challenge(FOO_USERNAME, FOO_ANSWER)
+            assert r.status_code == 200
+
+    def test_challenge_files_of_usernames_with_underscores(self, cli):
+        from io import BytesIO
+        from piggy_store.admin import main as admin_main
+
+        # foo_bar's file is listed first among the ones prefixed by challenge_foo_
+        bucket_name = config['storage']['files']['params']['bucket']
+        legacy_users = [('foo', 'f' * 32, 'challenge of foo'), ('foo_bar', FOO_ANSWER, 'challenge of foo_bar')]
+        for username, answer, challenge in legacy_users:
+            content = challenge.encode('utf-8')
+            object_name = 'admin$/challenge_{}_{}'.format(username, answer)
+            miniocli.put_object(bucket_name, object_name, BytesIO(content), len(content))
+
+        r = cli.get_auth_challenge('foo')
+        assert json.loads(r.data.decode('utf-8'))['content']['challenge'] == 'challenge of foo'
+        rediscli.delete('foo', 'foo_bar')
+
+        assert admin_main(['migrate-users', '--delete-old'], config) == 0
+        assert [o.object_name for o in miniocli.list_objects_v2(bucket_name, 'admin$/', recursive=True)] == [
+            'admin$/users/foo.json',
+            'admin$/users/foo_bar.json'
+        ]
+
+        with patch.dict(config, {'legacy_challenge_files': False}):
+            for username, answer, challenge in legacy_users:
+                r = cli.get_auth_challenge(username)
+                assert json.loads(r.data.decode('utf-8'))['content']['challenge'] == challenge
+                assert cli.answer_auth_challenge(username, answer).status_code == 200
+
+    def test_migration_skips_the_files_that_are_not_challenge_files(self, cli):
+        from io import BytesIO
+        from piggy_store.admin import main as admin_main
+
+        bucket_name = config['storage']['files']['params']['bucket']
+        object_names = [
+            'admin$/challenge_foo_notes.txt',
+            'admin$/challenge_nounderscore',
+            'admin$/challenge_{}_{}'.format(FOO_USERNAME, FOO_ANSWER)
+        ]
+        for object_name in object_names:
+            content = FOO_ENC_CHALLENGE.encode('utf-8')
+            miniocli.put_object(bucket_name, object_name, BytesIO(content), len(content))
+
+        assert admin_main(['migrate-users', '--delete-old'], config) == 0
+        # the junk is neither taken for a user nor deleted
+        assert [o.object_name for o in miniocli.list_objects_v2(bucket_name, 'admin$/', recursive=True)] == [
+            'admin$/challenge_foo_notes.txt',
+            'admin$/challenge_nounderscore',
+            'admin$/users/foo.json'
+        ]
+
+    def test_warm_cache(self, cli, capsys):
+        from piggy_store.admin import main as admin_main
+        from piggy_store.warmup import warm_cache_in_background
+
+        assert cli.create_user_foo().status_code == 200
+        assert cli.create_new_user(FOOBAR_USERNAME, 'other challenge', FOO_ANSWER).status_code == 200
+
+        # e.g. redis restarted
+        rediscli.flushdb()
+
+        assert admin_main(['warm-cache'], config) == 0
+        assert '2 users read, 2 added' in capsys.readouterr().out
+        assert rediscli.hgetall(FOO_USERNAME) == {'challenge': FOO_ENC_CHALLENGE, 'answer': FOO_ANSWER}
+        assert rediscli.hgetall(FOOBAR_USERNAME) == {'challenge': 'other challenge', 'answer': FOO_ANSWER}
+
+        # the cached users are kept
+        assert admin_main(['warm-cache'], config) == 0
+        assert '2 users read, 0 added' in capsys.readouterr().out
+
+        # at startup, only the first worker warms up the cache
+        rediscli.flushdb()
+        warm_cache_in_background().join()
+        assert rediscli.exists(FOO_USERNAME)
+
+        rediscli.delete(FOO_USERNAME)
+        warm_cache_in_background().join()
+        assert not rediscli.exists(FOO_USERNAME)
+
+    def test_warm_cache_from_challenge_files(self, cli, capsys):
+        from io import BytesIO
+        from piggy_store.admin import main as admin_main
+
+        bucket_name = config['storage']['files']['params']['bucket']
+        for object_name, challenge in [
+            ('admin$/challenge_foo_bar_{}'.format(FOO_ANSWER), 'challenge of foo_bar'),
+            # not a user's
+            ('admin$/challenge_foo_notes.txt', 'not a challenge')
+        ]:
+            content = challenge.encode('utf-8')
+            miniocli.put_object(bucket_name, object_name, BytesIO(content), len(content))
+
+        assert admin_main(['warm-cache'], config) == 0
+        assert '1 users read, 1 added' in capsys.readouterr().out
+        assert rediscli.hgetall('foo_bar') == {'challenge': 'challenge of foo_bar', 'answer': FOO_ANSWER}
+        assert not rediscli.exists('foo')
+
+    def test_uncached_user_is_read_from_the_bucket_once(self, cli):
+        import threading
+        from piggy_store.storage import EasyStorage
+        from piggy_store.storage.cache import get_cache_storage, single_flight
+
+        assert cli.create_user_foo().status_code == 200
+        rediscli.delete(FOO_USERNAME)
+
+        cache_storage = get_cache_storage()
+        leader_reading = threading.Event()
+        release = threading.Event()
+        followers_waiting = threading.Semaphore(0)
+        original_find_user_by_username = EasyStorage.find_user_by_username
+
+        def slow_find_user_by_username(self, username):
+            leader_reading.set()
+            release.wait(5)
+            return original_find_user_by_username(self, username)
+
+        class WaitedEvent(threading.Event):
+            def wait(self, timeout=None):
+                followers_waiting.release()
+                return super().wait(timeout)
+
+        class CountedCall(single_flight._Call):
+            def __init__(self):
+                super().__init__()
+                self.done = WaitedEvent()
+
+        found = []
+
+        def lookup():
+            found.append(cache_storage.find_user_by_username(FOO_USERNAME).challenge)
+
+        with patch.object(EasyStorage, 'find_user_by_username', autospec=True,
+                          side_effect=slow_find_user_by_username) as mocked_find, \
+                patch.object(single_flight, '_Call', CountedCall):
+            threads = [threading.Thread(target=lookup) for i in range(5)]
+            for t in threads:
+                t.start()
+            # one reads the bucket, the others wait for it
+            assert leader_reading.wait(5)
+            for t in threads[1:]:
+                assert followers_waiting.acquire(timeout=5)
+            release.set()
+            for t in threads:
+                t.join()
+
+            assert found == [FOO_ENC_CHALLENGE] * 5
+            assert mocked_find.call_count == 1
+
+            # another worker is reading the user: wait for it to cache the user
+            rediscli.delete(FOO_USERNAME)
+            rediscli.set('user-lookup:' + FOO_USERNAME, 'another worker', ex=5)
+            threading.Timer(0.2, lambda: rediscli.hset(FOO_USERNAME, mapping={
+                'challenge': 'cached by another worker',
+                'answer': FOO_ANSWER
+            })).start()
+
+            assert cache_storage.find_user_by_username(FOO_USERNAME).challenge == 'cached by another worker'
+            assert mocked_find.call_count == 1
+
+    def test_unknown_users_are_remembered_until_created(self, cli):
+        from piggy_store.storage import EasyStorage
+
+        r = cli.get_auth_challenge(FOO_USERNAME)
+        assert r.status_code == 401
+        assert rediscli.ttl('nouser:' + FOO_USERNAME) > 0
+
+        with patch.object(EasyStorage, 'find_user_by_username') as mocked_find:
+            r = cli.get_auth_challenge(FOO_USERNAME)
+            assert r.status_code == 401
+            assert not mocked_find.called
+
+        assert cli.create_user_foo().status_code == 200
+        assert not rediscli.exists('nouser:' + FOO_USERNAME)
+
+        r = cli.get_auth_challenge(FOO_USERNAME)
+        assert r.status_code == 200
+
+    def test_users_filter(self, cli, capsys):
+        from piggy_store.admin import main as admin_main
+        from piggy_store.exceptions import UserDoesNotExistError
+        from piggy_store.storage import EasyStorage
+        from piggy_store.storage.cache import get_cache_storage
+
+        cache_storage = get_cache_storage()
+
+        with patch.dict(config['users_filter'], {'enabled': True}):
+            assert cli.create_user_foo().status_code == 200
+
+            assert admin_main(['rebuild-users-filter'], config) == 0
+            assert '1 users in the filter' in capsys.readouterr().out
+
+            rediscli.delete(FOO_USERNAME)
+            with patch.object(EasyStorage, 'find_user_by_username', autospec=True,
+                              side_effect=EasyStorage.find_user_by_username) as mocked_find:
+                assert cache_storage.find_user_by_username(FOO_USERNAME).challenge == FOO_ENC_CHALLENGE
+                assert mocked_find.call_count == 1
+
+                # surely not a user, the bucket is not asked
+                with pytest.raises(UserDoesNotExistError):
+                    cache_storage.find_user_by_username(FOOBAR_USERNAME)
+                assert mocked_find.call_count == 1
+
+            # new users are added to the filter
+            assert cli.create_new_user(FOOBAR_USERNAME, FOO_ENC_CHALLENGE, FOO_ANSWER).status_code == 200
+            rediscli.delete(FOOBAR_USERNAME)
+            assert cache_storage.find_user_by_username(FOOBAR_USERNAME).challenge == FOO_ENC_CHALLENGE
+
+    def test_users_filter_of_challenge_files(self, cli, capsys):
+        from io import BytesIO
+        from piggy_store.admin import main as admin_main
+        from piggy_store.storage.cache import get_cache_storage
+
+        bucket_name = config['storage']['files']['params']['bucket']
+        content = FOO_ENC_CHALLENGE.encode('utf-8')
+        miniocli.put_object(bucket_name, 'admin$/challenge_a_b_{}'.format(FOO_ANSWER), BytesIO(content), len(content))
+
+        with patch.dict(config['users_filter'], {'enabled': True}):
+            assert admin_main(['rebuild-users-filter'], config) == 0
+            assert '1 users in the filter' in capsys.readouterr().out
+
+            assert get_cache_storage().find_user_by_username('a_b').answer == FOO_ANSWER
+
     def test_get_auth_challenge_succeed(self, cli):
         r = cli.create_user_foo()
         assert r.status_code == 200
@@ -483,6 +796,28 @@ class TestPiggyStoreApp:
                     }
                 }
 
+    @pytest.mark.wsgi_only
+    def test_request_upload_url_builds_the_user_storage_once(self, cli):
+        from piggy_store.storage.files.s3_storage import Storage
+
+        r = cli.create_user_foo()
+        token = json.loads(r.data.decode('utf-8'))['content']['token']
+
+        with patch.object(Storage, 'init', autospec=True, side_effect=Storage.init) as mocked_init:
+            r = cli.request_upload_url(token)
+            assert r.status_code == 200
+            assert [call[0][0].user_dir for call in mocked_init.call_args_list] == ['users/foo/']
+
+    def test_new_user_record_is_not_read_back(self, cli):
+        from piggy_store.storage.files import async_s3_storage, s3_storage
+
+        with patch.object(s3_storage.Storage, 'get_file_content') as mocked_get, \
+                patch.object(async_s3_storage.Storage, 'get_file_content') as mocked_async_get:
+            assert cli.create_user_foo().status_code == 200
+
+        assert not mocked_get.called
+        assert not mocked_async_get.called
+
     def test_request_upload_url_field_filename_is_empty(self, cli):
         r = cli.create_user_foo()
         assert r.status_code == 200
@@ -586,6 +921,72 @@ class TestPiggyStoreApp:
             ]
         }
 
+    def test_list_files_paginated(self, cli):
+        r = cli.create_user_foo()
+        assert r.status_code == 200
+        decoded_data = json.loads(r.data.decode('utf-8'))
+        token = decoded_data['content']['token']
+
+        for fname in ('file1', 'file2', 'file3'):
+            cli.upload_file_to_user(token, fname, b'content ' + fname.encode('utf-8'))
+
+        r = cli.list_files(token, limit=2)
+        assert r.status_code == 200
+        decoded_data = json.loads(r.data.decode('utf-8'))
+        assert ['file1', 'file2'] == [f['content']['filename'] for f in decoded_data['content']]
+
+        next_page = urllib.parse.urlsplit(decoded_data['links']['next']['href'])
+        assert next_page.path == '/files/'
+        qs = dict(urllib.parse.parse_qsl(next_page.query))
+        assert qs['limit'] == '2'
+
+        r = cli.list_files(token, **qs)
+        assert r.status_code == 200
+        decoded_data = json.loads(r.data.decode('utf-8'))
+        assert ['file3'] == [f['content']['filename'] for f in decoded_data['content']]
+        assert 'links' not in decoded_data
+
+    def test_list_files_paginated_with_nested_filenames(self, cli):
+        r = cli.create_user_foo()
+        assert r.status_code == 200
+        decoded_data = json.loads(r.data.decode('utf-8'))
+        token = decoded_data['content']['token']
+
+        for fname in ('a/z.txt', 'b.txt', 'c.txt'):
+            cli.upload_file_to_user(token, fname, b'content ' + fname.encode('utf-8'))
+
+        # the cursor is the key in the user's directory, not its last part
+        listed = []
+        qs = {'limit': 1}
+        for _ in range(4):
+            r = cli.list_files(token, **qs)
+            assert r.status_code == 200
+            decoded_data = json.loads(r.data.decode('utf-8'))
+            listed.extend(f['content']['filename'] for f in decoded_data['content'])
+            if 'links' not in decoded_data:
+                break
+            qs = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(decoded_data['links']['next']['href']).query))
+
+        assert listed == ['z.txt', 'b.txt', 'c.txt']
+
+    def test_list_files_limit_out_of_range(self, cli):
+        r = cli.create_user_foo()
+        assert r.status_code == 200
+        decoded_data = json.loads(r.data.decode('utf-8'))
+        token = decoded_data['content']['token']
+
+        for limit in (0, 1001):
+            r = cli.list_files(token, limit=limit)
+            assert r.status_code == 409
+            assert json.loads(r.data.decode('utf-8')) == {
+                'status': 409,
+                'error': {
+                    'code': 1021,
+                    'message': 'Expected limit to be between 1 and 1000'
+                }
+            }
+
+    @pytest.mark.wsgi_only
     def test_list_files_does_not_produce_correctly_an_etag(self, cli):
         r = cli.create_user_foo()
         assert r.status_code == 200
@@ -648,6 +1049,184 @@ class TestPiggyStoreApp:
                     ]
                 }
 
+    @pytest.mark.wsgi_only
+    def test_list_files_missing_etags_are_fetched_once(self, cli):
+        r = cli.create_user_foo()
+        assert r.status_code == 200
+        decoded_data = json.loads(r.data.decode('utf-8'))
+        token = decoded_data['content']['token']
+
+        cli.upload_file_to_user(token, 'filexyz', b'some content')
+        cli.upload_file_to_user(token, 'fileabc', b'other content')
+
+        from minio.definitions import Object
+        from minio import Minio
+        last_modified = datetime(2020, 4, 1)
+
+        def list_objects_without_etags(*args, **kwargs):
+            # new objects at every call, the listing fills in their etag
+            return [
+                Object('xxx bucket name unused here', 'users/foo/fileabc', last_modified, None, 13),
+                Object('xxx bucket name unused here', 'users/foo/filexyz', last_modified, None, 12),
+            ]
+
+        with patch.object(Minio, 'list_objects_v2', side_effect=list_objects_without_etags), \
+                patch.object(Minio, 'stat_object', autospec=True, side_effect=Minio.stat_object) as mocked_stat_object:
+            for i in range(2):
+                r = cli.list_files(token)
+                assert r.status_code == 200
+                decoded_data = json.loads(r.data.decode('utf-8'))
+                assert [f['content']['checksum'] for f in decoded_data['content']] == [
+                    md5(b'other content').hexdigest(),
+                    md5(b'some content').hexdigest()
+                ]
+
+            # the etags were cached after the first listing
+            assert mocked_stat_object.call_count == 2
+
+    @pytest.mark.wsgi_only
+    def test_list_files_is_served_from_the_cache(self, cli):
+        r = cli.create_user_foo()
+        assert r.status_code == 200
+        decoded_data = json.loads(r.data.decode('utf-8'))
+        token = decoded_data['content']['token']
+
+        cli.upload_file_to_user(token, 'file1', b'content 01')
+        cli.upload_file_to_user(token, 'file2', b'content 02')
+
+        # while an upload may be in progress the cache is not used
+        assert rediscli.exists('files-uploading:foo')
+        rediscli.delete('files-uploading:foo')
+
+        r = cli.list_files(token)
+        assert r.status_code == 200
+        from_bucket = json.loads(r.data.decode('utf-8'))
+        assert rediscli.zrange('files-index:foo', 0, -1) == ['file1', 'file2']
+
+        from minio import Minio
+        with patch.object(Minio, 'list_objects_v2') as mocked_list_objects_v2:
+            r = cli.list_files(token)
+            assert r.status_code == 200
+            from_cache = json.loads(r.data.decode('utf-8'))
+            assert not mocked_list_objects_v2.called
+
+        def strip_urls(data):
+            for f in data['content']:
+                f['content']['url'] = f['content']['url'].split('?', 1)[0]
+                f['links']['read']['href'] = f['links']['read']['href'].split('?', 1)[0]
+            return data
+
+        assert strip_urls(from_cache) == strip_urls(from_bucket)
+
+        r = cli.list_files(token, limit=1, cursor=base64.urlsafe_b64encode(b'file1').decode('ascii'))
+        assert r.status_code == 200
+        decoded_data = json.loads(r.data.decode('utf-8'))
+        assert ['file2'] == [f['content']['filename'] for f in decoded_data['content']]
+
+        # deleting a file invalidates the cache
+        r = cli.delete_file(token, 'file1')
+        assert r.status_code == 200
+        assert not rediscli.exists('files-index:foo')
+
+    def test_files_index_is_built_while_the_first_page_is_listed(self, cli):
+        from io import BytesIO
+        from piggy_store.storage.cache import async_redis_storage, redis_storage
+
+        r = cli.create_user_foo()
+        assert r.status_code == 200
+        token = json.loads(r.data.decode('utf-8'))['content']['token']
+
+        bucket_name = config['storage']['files']['params']['bucket']
+        filenames = ['file{}'.format(i) for i in range(5)]
+        for filename in filenames:
+            miniocli.put_object(bucket_name, 'users/foo/' + filename, BytesIO(b'content'), len(b'content'))
+
+        # a chunk of the listing written to redis at a time
+        with patch.object(redis_storage, 'FILES_INDEX_CHUNK_SIZE', 2), \
+                patch.object(async_redis_storage, 'FILES_INDEX_CHUNK_SIZE', 2):
+            r = cli.list_files(token, limit=2, cursor=base64.urlsafe_b64encode(b'file0').decode('ascii'))
+
+        assert r.status_code == 200
+        decoded_data = json.loads(r.data.decode('utf-8'))
+        assert [f['content']['filename'] for f in decoded_data['content']] == ['file1', 'file2']
+        assert 'next' in decoded_data['links']
+
+        assert rediscli.zrange('files-index:foo', 0, -1) == filenames
+        assert sorted(rediscli.hkeys('files-meta:foo')) == [''] + filenames
+        assert sorted(rediscli.keys('files-*')) == ['files-index:foo', 'files-meta:foo']
+
+    def test_s3_events_are_disabled_by_default(self, cli):
+        r = cli.send_s3_events('whatever', [])
+        assert r.status_code == 404
+
+    @pytest.mark.wsgi_only
+    def test_s3_events_update_the_cached_files_list(self, cli):
+        def s3_record(event_name, object_name, size=None, etag=None):
+            return {
+                'eventName': event_name,
+                's3': {
+                    'bucket': {'name': config['storage']['files']['params']['bucket']},
+                    'object': {'key': urllib.parse.quote_plus(object_name), 'size': size, 'eTag': etag}
+                }
+            }
+
+        with patch.dict(config['events'], {'enabled': True, 'auth_token': 'events-token'}):
+            r = cli.create_user_foo()
+            assert r.status_code == 200
+            decoded_data = json.loads(r.data.decode('utf-8'))
+            token = decoded_data['content']['token']
+
+            cli.upload_file_to_user(token, 'file1', b'content 01')
+
+            # when events are enabled uploads don't bypass the cache
+            assert not rediscli.exists('files-uploading:foo')
+
+            r = cli.list_files(token)
+            assert r.status_code == 200
+            # the index is complete once the listing is
+            assert len(json.loads(r.data.decode('utf-8'))['content']) == 1
+            assert rediscli.zrange('files-index:foo', 0, -1) == ['file1']
+
+            r = cli.send_s3_events('wrong-token', [])
+            assert r.status_code == 409
+
+            r = cli.send_s3_events('events-token', [
+                s3_record('s3:ObjectCreated:Post', 'users/foo/file 2', 10, '9c9be3db53720543385e02239e6f5dee'),
+                s3_record('s3:ObjectRemoved:Delete', 'users/foo/file1'),
+                s3_record('s3:ObjectCreated:Post', 'admin$/ignored'),
+            ])
+            assert r.status_code == 200
+
+            from minio import Minio
+            with patch.object(Minio, 'list_objects_v2') as mocked_list_objects_v2:
+                r = cli.list_files(token)
+                assert r.status_code == 200
+                assert not mocked_list_objects_v2.called
+
+            decoded_data = json.loads(r.data.decode('utf-8'))
+            assert [(f['content']['filename'], f['content']['size'], f['content']['checksum'])
+                    for f in decoded_data['content']] == [('file 2', 10, '9c9be3db53720543385e02239e6f5dee')]
+
+    def test_connection_pools_status(self, cli):
+        r = cli.connection_pools_status('whatever')
+        assert r.status_code == 404
+
+        with patch.dict(config['status'], {'auth_token': 'status-token'}):
+            r = cli.connection_pools_status('wrong-token')
+            assert r.status_code == 409
+
+            # the users, the tokens and the etags share a single pool
+            cli.create_user_foo()
+            r = cli.connection_pools_status('status-token')
+            assert r.status_code == 200
+
+            decoded_data = json.loads(r.data.decode('utf-8'))
+            [pool] = decoded_data['content']['redis']
+            assert pool['address'] == 'localhost:6379'
+            assert pool['max_connections'] == 20
+            assert pool['created_connections'] >= 1
+            assert pool['in_use_connections'] + pool['idle_connections'] == pool['created_connections']
+
     def test_delete_file(self, cli):
         r = cli.create_user_foo()
         assert r.status_code == 200
@@ -934,6 +1513,90 @@ class TestPiggyStoreApp:
             }
         }
 
+    def test_user_lookup_and_deletion_sign_no_url(self, cli):
+        r = cli.create_user_foo()
+        assert r.status_code == 200
+        decoded_data = json.loads(r.data.decode('utf-8'))
+        token = decoded_data['content']['token']
+
+        cli.upload_file_to_user(token, 'file1', b'content 01')
+        rediscli.delete(FOO_USERNAME)
+
+        from piggy_store.storage.files.signer import PresignedUrlSigner
+        with patch.object(PresignedUrlSigner, 'prepare_get') as mocked_prepare_get, \
+                patch.object(PresignedUrlSigner, 'presign_get') as mocked_presign_get:
+            # the user is not cached, so it's looked up in the bucket
+            r = cli.get_auth_challenge(FOO_USERNAME)
+            assert r.status_code == 200
+
+            r = cli.delete_user(token)
+            assert r.status_code == 200
+
+            assert not mocked_prepare_get.called
+            assert not mocked_presign_get.called
+
+    def test_delete_user_with_many_files_in_background(self, cli):
+        r = cli.create_user_foo()
+        assert r.status_code == 200
+        decoded_data = json.loads(r.data.decode('utf-8'))
+        token = decoded_data['content']['token']
+
+        cli.upload_file_to_user(token, 'file1', b'content 01')
+        cli.upload_file_to_user(token, 'file2', b'content 02')
+
+        with patch.dict(config, {'delete_user_in_background_after': 1}):
+            r = cli.delete_user(token)
+
+        assert r.status_code == 202
+        decoded_data = json.loads(r.data.decode('utf-8'))
+        assert decoded_data['status'] == 202
+        assert decoded_data['links']['job_status']['rel'] == 'job'
+
+        for i in range(50):
+            r = cli.get_job_status(decoded_data['links']['job_status']['href'], token)
+            assert r.status_code == 200
+            job = json.loads(r.data.decode('utf-8'))['content']
+            if job['state'] != 'running':
+                break
+            time.sleep(0.1)
+
+        assert job == {'kind': 'delete-user', 'state': 'done', 'progress': 2, 'error': None}
+
+        # the files first, then the user
+        assert not list(miniocli.list_objects_v2(config['storage']['files']['params']['bucket'], 'users/foo/'))
+        r = cli.get_auth_challenge(FOO_USERNAME)
+        assert r.status_code == 401
+
+        r = cli.get_job_status('/jobs/unknown', token)
+        assert r.status_code == 404
+
+        # only the token that started the job can see it
+        r = cli.create_user_foo()
+        assert r.status_code == 200
+        other_token = json.loads(r.data.decode('utf-8'))['content']['token']
+        r = cli.get_job_status(decoded_data['links']['job_status']['href'], other_token)
+        assert r.status_code == 404
+
+    @pytest.mark.wsgi_only
+    def test_deletes_made_by_the_threads_of_the_executor_are_timed(self, cli):
+        from piggy_store import server_timing
+        from piggy_store.storage.files import access_user_storage
+
+        r = cli.create_user_foo()
+        assert r.status_code == 200
+        token = json.loads(r.data.decode('utf-8'))['content']['token']
+        cli.upload_file_to_user(token, 'file1', b'content 01')
+
+        file_storage = access_user_storage(FOO_USERNAME)
+        timings = server_timing.start()
+        file_storage.remove_multiple([file_storage.build_file('file1')])
+        server_timing.stop(timings)
+
+        # the DeleteObjects request, sent from a thread of the executor
+        assert timings.metrics['s3'][1] == 1
+        assert not list(miniocli.list_objects_v2(config['storage']['files']['params']['bucket'], 'users/foo/'))
+
+    @pytest.mark.wsgi_only
     def test_delete_user_fail_to_delete_multiple_files(self, cli):
         r = cli.create_user_foo()
         assert r.status_code == 200
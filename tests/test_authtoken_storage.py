@@ -0,0 +1,132 @@
+import os
+import pytest
+from unittest.mock import Mock, patch
+
+from piggy_store.storage.cache import authtoken_storage
+from piggy_store.storage.cache.authtoken_storage import (
+    AuthTokenStorage,
+    ExpiringLRUCache,
+    TokenChecksCache,
+    derive_token_key,
+    load_token_key
+)
+
+SECRET = 'not-so-secret-test-secret'
+
+
+@pytest.fixture(scope='module')
+def derived_key():
+    return derive_token_key(SECRET)
+
+
+def test_key_from_config(derived_key):
+    with patch.object(authtoken_storage, 'derive_token_key') as mocked_derive:
+        assert derived_key == load_token_key({'secret': SECRET, 'key': derived_key.decode('ascii')})
+        assert not mocked_derive.called
+
+
+def test_key_from_file(tmpdir, derived_key):
+    key_file = tmpdir.join('key')
+    key_file.write(derived_key + b'\n', mode='wb')
+
+    with patch.object(authtoken_storage, 'derive_token_key') as mocked_derive:
+        assert derived_key == load_token_key({'secret': SECRET, 'key_file': str(key_file)})
+        assert not mocked_derive.called
+
+
+def test_key_is_derived_once_per_cache_dir(tmpdir, derived_key):
+    options = {'secret': SECRET, 'key_cache_dir': str(tmpdir)}
+
+    with patch.object(authtoken_storage, 'derive_token_key', wraps=derive_token_key) as mocked_derive:
+        assert derived_key == load_token_key(options)
+        assert derived_key == load_token_key(options)
+        assert mocked_derive.call_count == 1
+
+        # a different secret can't use the cached key
+        other_key = load_token_key({**options, 'secret': 'another secret'})
+        assert other_key != derived_key
+        assert mocked_derive.call_count == 2
+
+    assert len(os.listdir(str(tmpdir))) == 2
+
+
+def test_expiring_lru_cache_expires_entries():
+    cache = ExpiringLRUCache(10)
+    cache.set('foo', 'bar', expires_at=100)
+
+    assert cache.get('foo', now=99) == 'bar'
+    assert cache.get('foo', now=100) is None
+    assert len(cache) == 0
+
+
+def test_expiring_lru_cache_evicts_the_least_recently_used():
+    cache = ExpiringLRUCache(2)
+    cache.set('a', 1, expires_at=100)
+    cache.set('b', 2, expires_at=100)
+    cache.get('a', now=0)
+    cache.set('c', 3, expires_at=100)
+
+    assert cache.get('a', now=0) == 1
+    assert cache.get('b', now=0) is None
+    assert cache.get('c', now=0) == 3
+
+
+def test_expiring_lru_cache_of_size_zero_holds_nothing():
+    cache = ExpiringLRUCache(0)
+    cache.set('foo', 'bar', expires_at=100)
+
+    assert cache.get('foo', now=0) is None
+
+
+def test_token_checks_cache_ignores_what_was_read_before_an_invalidation():
+    cache = TokenChecksCache(10)
+
+    generation = cache.generation()
+    cache.invalidate('foo')
+    cache.set_unless_invalidated('foo', 'old token', 100, generation)
+    assert cache.get('foo', now=0) is None
+
+    # the other usernames are cached
+    cache.set_unless_invalidated('bar', 'token', 100, generation)
+    assert cache.get('bar', now=0) == 'token'
+
+    generation = cache.generation()
+    cache.set_unless_invalidated('foo', 'new token', 100, generation)
+    assert cache.get('foo', now=0) == 'new token'
+
+    generation = cache.generation()
+    cache.clear()
+    cache.set_unless_invalidated('bar', 'token', 100, generation)
+    assert cache.get('bar', now=0) is None
+
+
+def test_token_checks_cache_forgets_invalidations_safely():
+    cache = TokenChecksCache(2)
+
+    generation = cache.generation()
+    for username in ['a', 'b', 'c']:
+        cache.invalidate(username)
+
+    # a's invalidation is forgotten, but not that it may be newer
+    cache.set_unless_invalidated('a', 'token', 100, generation)
+    assert cache.get('a', now=0) is None
+
+
+def test_token_check_racing_a_logout_is_not_cached():
+    tokens = object.__new__(AuthTokenStorage)
+    tokens.conn = Mock()
+    tokens._init({'timeout': 3600, 'cache_size': 10, 'check_cache_ttl': 60})
+
+    def execute():
+        if tokens.conn.pipeline.return_value.execute.call_count == 1:
+            # the token is read, then the user logs out before it's cached
+            tokens.remove_user_token('foo')
+            return ['token', 3600000]
+        return [1, 1]
+
+    tokens.conn.pipeline.return_value.execute.side_effect = execute
+
+    with patch.object(tokens, '_ensure_listening', return_value=True):
+        assert tokens.has_user_token('foo', 'token')
+
+    assert tokens.user_tokens.get('foo') is None
@@ -17,12 +17,37 @@ def get_minimal_loadable_config():
             'max_content_length': '1MB'
         },
         'auth_token_expire_after': '2h',
+        'auth_token_key': None,
+        'auth_token_key_file': None,
+        'auth_token_key_cache_dir': None,
+        'auth_token_cache_size': 10000,
+        'auth_token_check_cache_ttl': '5s',
+        'delete_user_in_background_after': 10000,
+        'legacy_challenge_files': True,
+        'warm_cache_on_startup': False,
+        'unknown_users_cache_ttl': '1m',
+        'users_filter': {
+            'enabled': False,
+            'capacity': 1000000,
+            'error_rate': 0.01
+        },
+        'json_backend': 'auto',
         'server': {
             'host': '',
             'port': 443,
             'name': '',
         },
         'users_whitelist': [],
+        'events': {
+            'enabled': False,
+            'auth_token': None
+        },
+        'status': {
+            'auth_token': None
+        },
+        'server_timing': {
+            'breakdown': True
+        },
         'sentry': {
             'dsn':  ''
         },
@@ -90,7 +115,28 @@ def test_error_on_missing_keys(config_mod, required_key):
     'debug',
     'uploads.max_content_length',
     'auth_token_expire_after',
-    'users_whitelist'
+    'users_whitelist',
+    'auth_token_key',
+    'auth_token_key_file',
+    'auth_token_key_cache_dir',
+    'auth_token_cache_size',
+    'auth_token_check_cache_ttl',
+    'delete_user_in_background_after',
+    'legacy_challenge_files',
+    'warm_cache_on_startup',
+    'unknown_users_cache_ttl',
+    'users_filter',
+    'users_filter.enabled',
+    'users_filter.capacity',
+    'users_filter.error_rate',
+    'json_backend',
+    'events',
+    'events.enabled',
+    'events.auth_token',
+    'status',
+    'status.auth_token',
+    'server_timing',
+    'server_timing.breakdown'
 ])
 def test_config_keys_with_defaults(config_mod, defaulted_key):
     # remove a key and check that it comes back with a default value
@@ -144,3 +190,51 @@ def test_size_from_human_to_bytes(config_mod, humansize, expected):
 ])
 def test_time_delta_from_human_to_timedelta(config_mod, humandelta, expected):
     assert expected == config_mod._time_delta_from_human_to_timedelta(humandelta)
+
+def test_files_storage_connection_pool_defaults(config_mod):
+    config = config_mod._sanitize_config(get_minimal_loadable_config())
+
+    params = config['storage']['files']['params']
+    assert params['connection_pool_size'] == 10
+    assert params['connection_timeout'] is None
+    assert params['tcp_keepalive'] is True
+    assert params['stat_concurrency'] == 8
+    assert params['delete_concurrency'] == 4
+
+def test_events_require_an_auth_token(config_mod):
+    config = get_minimal_loadable_config()
+    config['events'] = {'enabled': True}
+
+    with pytest.raises(config_mod.ConfigError) as exc_info:
+        config_mod._sanitize_config(config)
+
+    exc_info.match('events.auth_token')
+
+def test_cache_storage_connection_pool_defaults(config_mod):
+    config = config_mod._sanitize_config(get_minimal_loadable_config())
+
+    params = config['storage']['cache']['params']
+    assert params['unix_socket_path'] is None
+    assert params['max_connections'] == 20
+    assert params['pool_timeout'] == 5
+    assert params['socket_timeout'] is None
+    assert params['socket_connect_timeout'] is None
+    assert params['socket_keepalive'] is True
+    assert params['health_check_interval'] == 30
+
+
+def test_async_storage_modules_defaults(config_mod):
+    config = config_mod._sanitize_config(get_minimal_loadable_config())
+
+    assert config['storage']['cache']['async_module'] == 'piggy_store.storage.cache.async_redis_storage'
+    assert config['storage']['files']['async_module'] == 'piggy_store.storage.files.async_s3_storage'
+
+    config = get_minimal_loadable_config()
+    config['storage']['files']['module'] = 'piggy_store.storage.files.local_storage'
+    config = config_mod._sanitize_config(config)
+    assert config['storage']['files']['async_module'] == 'piggy_store.storage.files.async_local_storage'
+
+    config = get_minimal_loadable_config()
+    config['storage']['cache']['module'] = 'piggy_store.storage.cache.memory_storage'
+    config = config_mod._sanitize_config(config)
+    assert config['storage']['cache']['async_module'] == 'piggy_store.storage.cache.async_memory_storage'
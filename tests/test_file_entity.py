@@ -0,0 +1,39 @@
+from piggy_store.storage.files.file_entity import FileDTO
+
+
+def test_filename():
+    assert FileDTO(object_name='users/foo/dir/file.txt').filename == 'file.txt'
+    assert FileDTO(object_name='users\\foo\\file.txt', path_separator='\\').get_filename() == 'file.txt'
+    assert FileDTO().filename == ''
+
+
+def test_url_is_signed_once_when_read():
+    signed = []
+
+    def sign_url(object_name):
+        signed.append(object_name)
+        return 'http://signed/' + object_name
+
+    f = FileDTO(object_name='users/foo/file.txt', size=3, checksum='abc', sign_url=sign_url)
+    assert signed == []
+
+    assert f.as_dict() == {
+        'filename': 'file.txt',
+        'checksum': 'abc',
+        'size': 3,
+        'url': 'http://signed/users/foo/file.txt'
+    }
+    assert f.url == 'http://signed/users/foo/file.txt'
+    assert signed == ['users/foo/file.txt']
+
+
+def test_clone():
+    f = FileDTO(object_name='users/foo/file.txt', content='foo', sign_url=lambda name: 'http://signed/')
+    clone = f.clone(checksum='abc', url='http://other/')
+
+    assert (clone.filename, clone.checksum, clone.size, clone.content, clone.url) == \
+        ('file.txt', 'abc', 3, b'foo', 'http://other/')
+    assert f.checksum is None
+    assert f.url == 'http://signed/'
+
+    assert f.clone(object_name='users/foo/other.txt').filename == 'other.txt'
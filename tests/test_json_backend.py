@@ -0,0 +1,62 @@
+from datetime import datetime
+import pytest
+
+from flask import Flask, json
+from flask_json import FlaskJSON
+
+from piggy_store import json_backend
+from piggy_store.config import ConfigError
+
+PAYLOAD = {
+    'content': {
+        'filename': 'fèè/bar.txt',
+        'checksum': 'd41d8cd98f00b204e9800998ecf8427e',
+        'size': 1024,
+        'url': 'http://localhost:9000/bucket/foo/bar.txt?X-Amz-Signature=abc'
+    },
+    'links': {
+        'delete': {'rel': 'file', 'href': 'http://localhost/files/'}
+    },
+    'when': datetime(2020, 1, 2, 3, 4, 5)
+}
+
+
+@pytest.fixture(params=['json', 'orjson'])
+def backend(request):
+    if request.param == 'orjson':
+        pytest.importorskip('orjson')
+
+    previous = json_backend.current_json_backend()
+    yield json_backend.use_json_backend(request.param)
+    json_backend._backend = previous
+
+
+def test_backends_round_trip(backend):
+    data = {k: v for k, v in PAYLOAD.items() if k != 'when'}
+    assert backend.loads(backend.dumps(data)) == data
+    assert backend.loads(backend.dumpb(data)) == data
+    assert json_backend.loads(json_backend.dumps(data)) == data
+
+
+def test_flask_encoder_is_the_same_for_every_backend(backend):
+    app = Flask(__name__)
+    FlaskJSON(app)
+    app.json_encoder = json_backend.JSONEncoder
+
+    with app.app_context():
+        encoded = json.dumps(PAYLOAD)
+
+    assert json.loads(encoded) == {
+        **{k: v for k, v in PAYLOAD.items() if k != 'when'},
+        'when': '2020-01-02T03:04:05'
+    }
+
+
+def test_auto_backend():
+    expected = 'json' if json_backend.orjson is None else 'orjson'
+    assert json_backend.get_json_backend('auto').name == expected
+
+
+def test_unknown_backend():
+    with pytest.raises(ConfigError):
+        json_backend.get_json_backend('simplejson')
@@ -0,0 +1,164 @@
+import os
+import pytest
+from datetime import datetime, timedelta
+from io import BytesIO
+from unittest.mock import patch
+from urllib.parse import parse_qsl, urlsplit
+
+from flask import Flask
+
+from piggy_store.config import config, load as load_config
+from piggy_store.exceptions import FileExistsError
+from piggy_store.storage.files.local_storage import (
+    MAX_UPLOAD_REQUEST_SIZE,
+    MAX_UPLOAD_SIZE,
+    LocalBucket,
+    Storage
+)
+
+config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'config.tests.yml')
+
+if not config:
+    config = load_config(config_path)
+
+CONTENT = b'some content'
+
+
+@pytest.fixture
+def options(tmpdir):
+    return {
+        'path': str(tmpdir),
+        'base_url': 'http://localhost',
+        'secret': 'test secret',
+        'download_url_expire_after': timedelta(days=1)
+    }
+
+
+def _storage(options, user_dir='users/foo/'):
+    storage = Storage(user_dir, options)
+    storage.init()
+    return storage
+
+
+@pytest.fixture
+def storage(options):
+    return _storage(options)
+
+
+def test_add_list_and_remove(storage):
+    filenames = ['b', 'a/../../x', 'tab\there', 'new\nline', 'à', 'a']
+    for filename in filenames:
+        f = storage.add_file(storage.build_file(filename, dict(content=filename + ' content')))
+        assert f.checksum and f.url
+
+    with pytest.raises(FileExistsError):
+        storage.add_file(storage.build_file('a', dict(content=CONTENT)))
+
+    assert [filename for filename, _, _ in storage.list_file_keys()] == sorted(filenames)
+    listed = [f.filename for f in storage.get_files_list(start_after='a/../../x')]
+    assert listed == ['b', 'new\nline', 'tab\there', 'à']
+    assert storage.get_file_content(storage.build_file('a/../../x')) == b'a/../../x content'
+
+    # nothing is shared with another directory
+    assert list(_storage(storage.opts, 'users/bar/').list_file_keys()) == []
+
+    storage.remove_file(storage.build_file('b'))
+    assert storage.get_file_content_if_exists(storage.build_file('b')) is None
+    assert storage.count_files(100) == len(filenames) - 1
+
+    storage.remove_all()
+    assert storage.count_files(100) == 0
+
+
+def test_listing_from_the_middle(storage):
+    filenames = ['{}/{:03d}'.format(prefix, i) for prefix in ('a', 'b', 'c') for i in range(0, 300, 3)]
+    with storage.index.lock():
+        storage.index.write_entries([(filename, 1, 'etag') for filename in sorted(filenames)])
+
+    for prefix in ['', 'a/', 'b/', 'b/1', 'c/299', 'd']:
+        for start_after in ['', 'a/', 'b/150', 'b/151', 'c/297', 'z']:
+            expected = [
+                filename for filename in sorted(filenames)
+                if filename.startswith(prefix) and filename > start_after
+            ]
+            listed = [filename for filename, _, _ in storage.list_file_keys(prefix, start_after)]
+            assert listed == expected, (prefix, start_after)
+
+
+def test_signed_download_urls(storage):
+    f = storage.build_file('file')
+    local_bucket = storage.local_bucket
+
+    query = dict(parse_qsl(urlsplit(storage.get_presigned_retrieve_url(f)).query))
+    assert query['key'] == 'users/foo/file'
+    assert local_bucket.is_valid_download(query['key'], query['expires'], query['signature'])
+    assert not local_bucket.is_valid_download('users/bar/file', query['expires'], query['signature'])
+    assert not local_bucket.is_valid_download(query['key'], str(int(query['expires']) + 1), query['signature'])
+
+    # expired
+    query = dict(parse_qsl(urlsplit(storage.get_presigned_retrieve_url(f, datetime(2020, 1, 1))).query))
+    assert not local_bucket.is_valid_download(query['key'], query['expires'], query['signature'])
+
+
+@pytest.fixture
+def app(options):
+    from piggy_store.local_files import blueprint
+
+    app = Flask(__name__)
+    app.register_blueprint(blueprint)
+
+    with patch.dict(config['storage']['files'], {
+        'module': 'piggy_store.storage.files.local_storage',
+        'params': options
+    }):
+        yield app
+
+
+def test_upload_and_download(app, storage):
+    upload_url, form_data, retrieve_url = storage.get_presigned_upload(storage.build_file('file'))
+    cli = app.test_client()
+
+    def upload(content, **fields):
+        return cli.post(urlsplit(upload_url).path, data={
+            **form_data,
+            **fields,
+            'file': (BytesIO(content), 'file')
+        })
+
+    assert upload(CONTENT, key='users/foo/other').status_code == 403
+    assert upload(b'too short').status_code == 403
+    assert upload(b'x' * (MAX_UPLOAD_SIZE + 1)).status_code == 403
+
+    # the file of a forged form is not even read
+    with patch.object(LocalBucket, 'allows_size') as mocked_allows_size:
+        assert upload(CONTENT, signature='0').status_code == 403
+    assert not mocked_allows_size.called
+
+    assert upload(b'x' * MAX_UPLOAD_REQUEST_SIZE).status_code == 413
+
+    r = upload(CONTENT)
+    assert r.status_code == 204
+    assert r.headers['ETag'] == '"{}"'.format(next(storage.list_file_keys())[2])
+
+    # an upload replaces the file
+    assert upload(CONTENT * 2).status_code == 204
+
+    url = urlsplit(retrieve_url)
+    r = cli.get(url.path + '?' + url.query)
+    assert r.status_code == 200
+    assert r.data == CONTENT * 2
+
+    assert cli.get(url.path + '?' + url.query.replace('signature=', 'signature=0')).status_code == 403
+
+
+def test_download_through_nginx(app, storage):
+    storage.opts['x_accel_redirect'] = '/internal/'
+    storage.local_bucket.x_accel_redirect = '/internal/'
+    storage.add_file(storage.build_file('file', dict(content=CONTENT)))
+
+    url = urlsplit(storage.get_presigned_retrieve_url(storage.build_file('file')))
+    r = app.test_client().get(url.path + '?' + url.query)
+
+    assert r.status_code == 200
+    assert r.data == b''
+    assert r.headers['X-Accel-Redirect'] == '/internal/' + storage.local_bucket.relative_object_path('users/foo/file')
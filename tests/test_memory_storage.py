@@ -0,0 +1,187 @@
+import asyncio
+import os
+import pytest
+import time
+from datetime import timedelta
+from unittest.mock import patch
+
+from piggy_store.config import config, load as load_config
+from piggy_store.exceptions import UserDoesNotExistError, UserExistsError
+from piggy_store.storage.cache import (
+    get_async_cache_storage,
+    get_async_token_storage,
+    get_cache_storage,
+    get_job_storage,
+    get_token_storage,
+    get_users_filter
+)
+from piggy_store.storage.cache.memory_storage import MemoryStore, store
+from piggy_store.storage.user_entity import User
+
+config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'config.tests.yml')
+
+if not config:
+    config = load_config(config_path)
+
+FOO = User('foo', 'foo challenge', 'a' * 32)
+
+
+@pytest.fixture(autouse=True)
+def memory_config(tmpdir):
+    # nothing out of the process: the cache in memory, the files on disk
+    with patch.dict(config['storage']['cache'], {
+        'module': 'piggy_store.storage.cache.memory_storage',
+        'async_module': 'piggy_store.storage.cache.async_memory_storage'
+    }), patch.dict(config['storage']['files'], {
+        'module': 'piggy_store.storage.files.local_storage',
+        'async_module': 'piggy_store.storage.files.async_local_storage',
+        'params': {
+            'path': str(tmpdir),
+            'base_url': 'http://localhost',
+            'download_url_expire_after': timedelta(minutes=5)
+        }
+    }):
+        store.clear()
+        yield
+        store.clear()
+
+
+def test_memory_store():
+    s = MemoryStore()
+
+    assert s.set('a', 1)
+    assert not s.set('a', 2, nx=True)
+    assert s.get('a') == 1
+
+    s.update('b', {'x': 1})
+    s.update('b', {'y': 2})
+    assert s.get_many(['a', 'b', 'c']) == [1, {'x': 1, 'y': 2}, None]
+
+    # expired right away
+    s.set('c', 1, ttl=0)
+    assert s.get('c') is None
+    assert s.set('c', 2, ttl=timedelta(hours=1), nx=True)
+
+    assert s.delete('a', 'c', 'missing') == 2
+    assert s.get_many(['a', 'c']) == [None, None]
+
+
+def test_memory_store_drops_the_expired_entries():
+    s = MemoryStore()
+    for i in range(5000):
+        s.set(i, i, ttl=0)
+
+    assert len(s) < 5000
+
+
+def test_users():
+    db = get_cache_storage()
+
+    assert db.add_user(FOO) == FOO.challenge
+    with pytest.raises(UserExistsError):
+        db.add_user(FOO)
+    assert db.find_user_by_username('foo').answer == FOO.answer
+
+    # e.g. the process restarted: the user is found in the bucket
+    store.clear()
+    assert db.find_user_by_username('foo').challenge == FOO.challenge
+    store.clear()
+    with pytest.raises(UserExistsError):
+        db.add_user(User('foo', 'another challenge', 'b' * 32))
+    assert db.find_user_by_username('foo').challenge == FOO.challenge
+
+    db.remove_user(db.find_user_by_username('foo'))
+    with pytest.raises(UserDoesNotExistError):
+        db.find_user_by_username('foo')
+
+
+def test_unknown_users_are_remembered_until_created():
+    db = get_cache_storage()
+
+    with pytest.raises(UserDoesNotExistError):
+        db.find_user_by_username('foo')
+    assert store.get('nouser:foo')
+
+    db.add_user(FOO)
+    assert db.find_user_by_username('foo').answer == FOO.answer
+
+
+def test_no_users_filter():
+    with patch.dict(config['users_filter'], {'enabled': True}):
+        assert get_users_filter() is None
+
+
+def test_user_files():
+    db = get_cache_storage()
+    db.add_user(FOO)
+
+    upload_url, form_data, retrieve_url = db.get_presigned_upload(FOO, 'file')
+    assert upload_url == 'http://localhost/local-files/'
+    assert [f.filename for f in db.get_user_files(FOO)] == []
+    assert db.count_user_files(FOO, 10) == 0
+
+
+def test_tokens():
+    tokens = get_token_storage()
+    token = tokens.generate_token({'username': 'foo'})
+
+    assert tokens.decode_token(token) == {'username': 'foo'}
+    assert not tokens.has_user_token('foo', token)
+
+    tokens.refresh_user_token('foo', token)
+    assert tokens.has_user_token('foo', token)
+    assert not tokens.has_user_token('foo', tokens.generate_token({'username': 'foo'}))
+
+    assert tokens.remove_user_token('foo') == 1
+    assert not tokens.has_user_token('foo', token)
+
+    with patch.object(tokens, 'timeout', 0):
+        tokens.refresh_user_token('foo', token)
+        assert not tokens.has_user_token('foo', token)
+
+
+def test_jobs():
+    jobs = get_job_storage()
+    job_id = jobs.create('delete-user', 'token')
+
+    assert jobs.get(job_id, 'token') == {'kind': 'delete-user', 'state': 'running', 'progress': 0, 'error': None}
+    jobs.update(job_id, progress=10)
+    assert jobs.get(job_id, 'token')['progress'] == 10
+    assert jobs.get('unknown', 'token') is None
+    assert jobs.get(job_id, 'another token') is None
+
+
+def test_jobs_without_a_heartbeat_failed():
+    jobs = get_job_storage()
+    job_id = jobs.create('delete-user', 'token')
+
+    with patch('time.time', return_value=time.time() + jobs.stale_after + 1):
+        assert jobs.get(job_id, 'token') == {
+            'kind': 'delete-user',
+            'state': 'failed',
+            'progress': 0,
+            'error': 'The job stopped unexpectedly'
+        }
+
+    jobs.update(job_id, state='done')
+    with patch('time.time', return_value=time.time() + jobs.stale_after + 1):
+        assert jobs.get(job_id, 'token')['state'] == 'done'
+
+
+def test_async_storages_share_the_cache_of_the_process():
+    async def run():
+        db = get_async_cache_storage()
+        tokens = get_async_token_storage()
+
+        assert await db.add_user(FOO) == FOO.challenge
+        with pytest.raises(UserExistsError):
+            await db.add_user(FOO)
+
+        token = tokens.generate_token({'username': 'foo'})
+        await tokens.refresh_user_token('foo', token)
+        return token
+
+    token = asyncio.run(run())
+
+    assert get_cache_storage().find_user_by_username('foo').answer == FOO.answer
+    assert get_token_storage().has_user_token('foo', token)
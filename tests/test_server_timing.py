@@ -0,0 +1,79 @@
+import os
+import re
+from datetime import timedelta
+from unittest.mock import patch
+
+import pytest
+
+from piggy_store import server_timing
+from piggy_store.config import config, load as load_config
+from piggy_store.server_timing import Timings, timed
+from piggy_store.storage.cache.memory_storage import store
+
+config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'config.tests.yml')
+
+if not config:
+    config = load_config(config_path)
+
+
+def test_header():
+    timings = Timings()
+    timings.add('redis', 0.001)
+    timings.add('redis', 0.002)
+    timings.add('s3', 0.0105)
+
+    assert re.fullmatch(
+        r'redis;dur=3\.000;desc="2 calls", s3;dur=10\.500;desc="1 call", total;dur=\d+\.\d{3}',
+        timings.header()
+    )
+
+
+def test_nothing_is_timed_outside_of_a_request():
+    with timed('redis'):
+        pass
+
+    timings = server_timing.start()
+    with timed('redis'):
+        pass
+    assert server_timing.stop(timings).startswith('redis;dur=')
+
+    with timed('redis'):
+        pass
+    assert timings.metrics['redis'][1] == 1
+
+
+def test_no_breakdown():
+    with patch.dict(config['server_timing'], {'breakdown': False}):
+        timings = server_timing.start()
+        with timed('redis'):
+            pass
+
+        assert server_timing.stop(timings).startswith('total;dur=')
+
+
+@pytest.fixture
+def client(tmpdir):
+    from piggy_store.app import create_app
+
+    with patch.dict(config['storage']['cache'], {
+        'module': 'piggy_store.storage.cache.memory_storage'
+    }), patch.dict(config['storage']['files'], {
+        'module': 'piggy_store.storage.files.local_storage',
+        'params': {
+            'path': str(tmpdir),
+            'base_url': 'http://localhost',
+            'download_url_expire_after': timedelta(minutes=5)
+        }
+    }):
+        store.clear()
+        yield create_app(config).test_client()
+        store.clear()
+
+
+def test_response_header(client):
+    r = client.post('/users/', json={'username': 'foo', 'challenge': 'challenge', 'answer': 'a' * 32})
+    assert r.status_code == 200
+
+    metrics = dict(m.split(';', 1) for m in r.headers['Server-Timing'].split(', '))
+    assert {'disk', 'presign', 'token', 'json'} <= metrics.keys()
+    assert list(metrics)[-1] == 'total'
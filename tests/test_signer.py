@@ -0,0 +1,97 @@
+import pytest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from minio import Minio, PostPolicy
+
+from piggy_store.storage.files.signer import PresignedUrlSigner
+
+ACCESS_KEY = 'test_s3_access_key'
+SECRET_KEY = 'test_s3_secret_key'
+
+
+@pytest.mark.parametrize('host,secure,region,bucket', [
+    ('localhost:9000', False, 'us-east-1', 'bucket-test'),
+    ('localhost:80', False, 'us-east-1', 'bucket-test'),
+    ('s3.amazonaws.com', True, 'eu-west-1', 'bucket-test'),
+    ('s3.amazonaws.com', True, 'eu-west-1', 'bucket.with.dots'),
+])
+@pytest.mark.parametrize('object_name', [
+    'users/foo/file1',
+    'users/foo/with spaces and ~tilde',
+    'users/foo/?#&=+%',
+    'users/foo/àèìòù',
+    'admin$/challenge_foo_' + 'a' * 32,
+])
+def test_presigned_get_matches_minio(host, secure, region, bucket, object_name):
+    client = Minio(host, access_key=ACCESS_KEY, secret_key=SECRET_KEY, secure=secure, region=region)
+    signer = PresignedUrlSigner.from_options(dict(
+        host=host,
+        secure=secure,
+        region=region,
+        bucket=bucket,
+        access_key=ACCESS_KEY,
+        secret_key=SECRET_KEY
+    ))
+
+    request_date = datetime(2020, 4, 1, 23, 59, 59)
+    expires = timedelta(minutes=5)
+
+    expected = client.presigned_get_object(bucket, object_name, expires, request_date=request_date)
+    assert expected == signer.presign_get(object_name, expires, request_date)
+
+
+def test_signing_key_is_derived_once_per_day():
+    signer = PresignedUrlSigner('http://localhost:9000', 'bucket-test', 'us-east-1', ACCESS_KEY, SECRET_KEY)
+
+    key = signer.get_signing_key(datetime(2020, 4, 1, 0, 0, 1))
+    assert key is signer.get_signing_key(datetime(2020, 4, 1, 23, 59, 59))
+    assert key != signer.get_signing_key(datetime(2020, 4, 2, 0, 0, 0))
+
+
+def test_presign_get_many():
+    signer = PresignedUrlSigner('http://localhost:9000', 'bucket-test', 'us-east-1', ACCESS_KEY, SECRET_KEY)
+    request_date = datetime(2020, 4, 1)
+    expires = timedelta(days=1)
+
+    names = ['users/foo/file{}'.format(i) for i in range(3)]
+    assert list(signer.presign_get_many(names, expires, request_date)) == \
+        [signer.presign_get(name, expires, request_date) for name in names]
+
+
+def _post_policy(bucket, object_name):
+    post_policy = PostPolicy()
+    post_policy.set_bucket_name(bucket)
+    post_policy.set_key(object_name)
+    post_policy.set_content_length_range(10, 1024 * 1024)
+    post_policy.set_expires(datetime(2020, 4, 2, 0, 4, 59))
+    return post_policy
+
+
+@pytest.mark.parametrize('host,secure,region', [
+    ('localhost:9000', False, 'us-east-1'),
+    ('s3.amazonaws.com', True, 'eu-west-1'),
+])
+def test_presigned_post_policy_matches_minio(host, secure, region):
+    bucket = 'bucket-test'
+    object_name = 'users/foo/àèìòù'
+    client = Minio(host, access_key=ACCESS_KEY, secret_key=SECRET_KEY, secure=secure, region=region)
+    signer = PresignedUrlSigner.from_options(dict(
+        host=host,
+        secure=secure,
+        region=region,
+        bucket=bucket,
+        access_key=ACCESS_KEY,
+        secret_key=SECRET_KEY
+    ))
+
+    request_date = datetime(2020, 4, 1, 23, 59, 59)
+
+    class FrozenDatetime(datetime):
+        @classmethod
+        def utcnow(cls):
+            return request_date
+
+    with patch('minio.api.datetime', FrozenDatetime):
+        expected = client.presigned_post_policy(_post_policy(bucket, object_name))
+
+    assert expected == signer.presign_post_policy(_post_policy(bucket, object_name), request_date)
@@ -0,0 +1,115 @@
+import asyncio
+import threading
+import pytest
+
+from piggy_store.storage.cache.single_flight import AsyncSingleFlight, SingleFlight
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    single_flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_lookup():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return 'result'
+
+    results = []
+
+    def lookup():
+        results.append(single_flight.do('foo', slow_lookup))
+
+    leader = threading.Thread(target=lookup)
+    leader.start()
+    started.wait()
+
+    followers = [threading.Thread(target=lookup) for i in range(4)]
+    for t in followers:
+        t.start()
+
+    release.set()
+    for t in [leader] + followers:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == ['result'] * 5
+
+    # once done, the next call runs again
+    assert single_flight.do('foo', lambda: 'again') == 'again'
+
+
+def test_single_flight_shares_the_error():
+    single_flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def failing_lookup():
+        started.set()
+        release.wait()
+        raise ValueError('boom')
+
+    errors = []
+
+    def lookup():
+        try:
+            single_flight.do('foo', failing_lookup)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=lookup)]
+    threads[0].start()
+    started.wait()
+    threads.append(threading.Thread(target=lookup))
+    threads[1].start()
+
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert len(errors) == 2
+
+
+def test_single_flight_keys_are_independent():
+    single_flight = SingleFlight()
+    assert single_flight.do('foo', lambda: single_flight.do('bar', lambda: 'bar')) == 'bar'
+
+
+def test_async_single_flight_coalesces_concurrent_calls():
+    calls = []
+
+    async def slow_lookup():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'result'
+
+    async def main():
+        single_flight = AsyncSingleFlight()
+        results = await asyncio.gather(*(single_flight.do('foo', slow_lookup) for i in range(5)))
+        assert await single_flight.do('foo', slow_lookup) == 'result'
+        return results
+
+    assert asyncio.run(main()) == ['result'] * 5
+    assert len(calls) == 2
+
+
+def test_async_single_flight_survives_a_cancelled_leader():
+    async def slow_lookup():
+        await asyncio.sleep(0.01)
+        return 'result'
+
+    async def main():
+        single_flight = AsyncSingleFlight()
+        leader = asyncio.ensure_future(single_flight.do('foo', slow_lookup))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(single_flight.do('foo', slow_lookup))
+        await asyncio.sleep(0)
+
+        leader.cancel()
+        assert await follower == 'result'
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+
+    asyncio.run(main())